@@ -0,0 +1,134 @@
+'''
+Validation for float32 accumulation (unwise_coadd.py --float32-acc).
+
+Simulates round-2 frames with bright sources, accumulates them with
+float64 and with float32 (compensated) coaddacc, and checks the
+difference in the coadd image, inverse-variance and per-pixel std
+against the tolerances below.  With --compare, checks a pair of real
+coadds (run with and without --float32-acc) instead.
+
+Tolerances, with sig = the coadd noise 1/sqrt(invvar64):
+  img:    |img32 - img64|       <= 1e-3 sig + 1e-5 |img64|
+  invvar: |invvar32 - invvar64| <= 1e-5 invvar64
+  std:    |std32 - std64|       <= 1e-3 max(std64, sig)
+
+The image and weight sums are not compensated, so bright pixels carry
+an error of some float32 ulps, growing slowly with the number of frames
+(the 1e-5 term).  The sums of squares are, since the per-pixel std is a
+difference of nearly equal numbers there.  The float32 accumulators
+take 32 bytes per pixel, versus 48 for float64, plus the int16 counts.
+'''
+import matplotlib
+if __name__ == '__main__':
+    matplotlib.use('Agg')
+import numpy as np
+import sys
+
+import fitsio
+
+from unwise_coadd import (coaddacc, coadd_finish_arrays, _round2_acc_arrays,
+                          Duck)
+
+def compare(img64, iv64, std64, img32, iv32, std32):
+    '''
+    Returns a dict of the maximum difference of each quantity, as a
+    fraction of its tolerance.
+    '''
+    ok = (iv64 > 0)
+    sig = 1. / np.sqrt(iv64[ok])
+    img64 = img64[ok].astype(float)
+    std64 = std64[ok].astype(float)
+    d = dict()
+    d['img'] = np.max(np.abs(img32[ok] - img64) /
+                      (1e-3 * sig + 1e-5 * np.abs(img64)))
+    d['invvar'] = np.max(np.abs(iv32[ok] - iv64[ok]) / (1e-5 * iv64[ok]))
+    d['std'] = np.max(np.abs(std32[ok] - std64) /
+                      (1e-3 * np.maximum(std64, sig)))
+    return d
+
+def report(name, d):
+    fail = False
+    for k in ['img', 'invvar', 'std']:
+        bad = (d[k] > 1.)
+        fail = fail or bad
+        print '%-10s %-7s max diff / tolerance: %.3g%s' % (
+            name, k, d[k], ('  FAILED' if bad else ''))
+    return fail
+
+def simulate(H=512, W=512, nframes=500, zpscale=1., seed=42):
+    '''
+    Returns ((img,invvar,std), (imgb,invvarb,stdb)) for float64 and
+    float32 accumulation of the same simulated frames.
+    '''
+    rng = np.random.RandomState(seed)
+    yy,xx = np.mgrid[:H,:W]
+    # sky-subtracted truth: faint background plus sources up to 1e5 sigma
+    truth = np.zeros((H,W), np.float32)
+    for i in range(100):
+        x,y = rng.uniform(0, W), rng.uniform(0, H)
+        flux = 10.**rng.uniform(0, 5)
+        truth += flux * np.exp(-0.5 * ((xx-x)**2 + (yy-y)**2) / 1.5**2)
+    accs = [coaddacc(H, W), coaddacc(H, W, acc32=True)]
+    tinyw = 1e-16
+    for i in range(nframes):
+        h,w = rng.randint(H/4, H+1), rng.randint(W/4, W+1)
+        y0,x0 = rng.randint(0, H-h+1), rng.randint(0, W-w+1)
+        slc = slice(y0, y0+h), slice(x0, x0+w)
+        sig1 = rng.uniform(0.5, 2.)
+        # zeropoint scaling; tiny W4-like weights for scale >> 1
+        scale = zpscale * rng.uniform(0.9, 1.1)
+        rimg = ((truth[slc] + rng.normal(scale=sig1, size=(h,w)).astype(np.float32))
+                * np.float32(scale))
+        wt = 1. / (sig1 * scale)**2
+        masks = (1 + 2 * (rng.uniform(size=(h,w)) > 0.01) *
+                 (rng.uniform(size=(h,w)) > 0.01)).astype(np.uint8)
+        mm_arrays = _round2_acc_arrays(rimg, masks, wt)
+        for acc in accs:
+            mm = Duck()
+            mm.included = True
+            mm.coslc = slc
+            mm.w = wt
+            (mm.coimgsq, mm.coimg, mm.cow, mm.con, mm.rmask2) = mm_arrays
+            acc.acc(mm)
+    res = []
+    for acc in accs:
+        acc.finish()
+        res.append((coadd_finish_arrays(acc.coimg, acc.coimgsq, acc.cow,
+                                        acc.con, tinyw),
+                    coadd_finish_arrays(acc.coimgb, acc.coimgsqb, acc.cowb,
+                                        acc.conb, tinyw)))
+    return res
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('%prog [options]\n' +
+                                   '       %prog --compare <prefix64> <prefix32>')
+    parser.add_option('--compare', action='store_true', default=False,
+                      help='Compare coadd outputs, eg, out64/121/1210p000/unwise-1210p000-w1 out32/...')
+    parser.add_option('-n', dest='nframes', type=int, default=500,
+                      help='Number of simulated frames')
+    parser.add_option('--size', type=int, default=512,
+                      help='Simulated tile size')
+    parser.add_option('--zpscale', type=float, default=1.,
+                      help='Simulated zeropoint scaling (eg, 1e4 for W4-like weights)')
+    opt,args = parser.parse_args()
+
+    fail = False
+    if opt.compare:
+        if len(args) != 2:
+            parser.print_help()
+            return -1
+        for suff in ['m', 'u']:
+            A = [[fitsio.read('%s-%s-%s.fits' % (prefix, im, suff))
+                  for im in ['img', 'invvar', 'std']] for prefix in args]
+            fail = report(suff, compare(*(A[0] + A[1]))) or fail
+    else:
+        (r64, r64b),(r32, r32b) = simulate(H=opt.size, W=opt.size,
+                                          nframes=opt.nframes,
+                                          zpscale=opt.zpscale)
+        for name,a,b in [('unmasked', r64, r32), ('masked', r64b, r32b)]:
+            fail = report(name, compare(*(a + b))) or fail
+    return (1 if fail else 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -76,8 +76,9 @@ def main():
     opt.bands = bb
     print 'Bands', opt.bands
 
-    create_animations(opt.ra, opt.dec, W, H, pixscale=opt.pixscale,
-                      bands=opt.bands, yearly=opt.year, mp=mp, outdir=opt.outdir)
+    return create_animations(opt.ra, opt.dec, W, H, pixscale=opt.pixscale,
+                             bands=opt.bands, yearly=opt.year, mp=mp,
+                             outdir=opt.outdir)
 
 
 def create_animations(ra, dec, W, H, pixscale=2.75, bands=[1,2],
@@ -120,6 +121,7 @@ def create_animations(ra, dec, W, H, pixscale=2.75, bands=[1,2],
     cube1 = False
     rchi_fraction = 0.01
 
+    # Tag of the epoch in the output jpg/gif names
     if yearly:
         ebreaks = [56000]
         etag = 'y%i'
@@ -128,32 +130,43 @@ def create_animations(ra, dec, W, H, pixscale=2.75, bands=[1,2],
         print len(ebreaks), 'epoch breaks'
         etag = 'e%i'
 
-    ebreaks = [0] + ebreaks + [1000000]
+    # Coadd all epochs, and the full depth, in one pass over the frames
+    # of each band.
+    out = os.path.join(outdir, 'all')
+    trymakedirs(out, dir=True)
+    for band in bands:
+        outfn = os.path.join(out, 'unwise-%s-w%i-img-u.fits' % (dataset, band))
+        if not os.path.exists(outfn):
+            print 'Band', band, 'all epochs'
+            if one_coadd(tile, band, W, H, pixscale, WISE, ps,
+                         False, out, mp, mp,
+                         cube, False, None, None, force,
+                         medfilt, 0, dsky, False, bgmatch,
+                         False, False,  
+                         rchi_fraction, cube1,
+                         None, None, None, force_outdir=True,
+                         multiepoch=ebreaks):
+                print 'Coadd failed: band', band
+                return -1
 
     gifs = []
     eims = []
 
-    for ei,(elo,ehi) in enumerate(zip(ebreaks, ebreaks[1:])):
+    for ei in range(len(ebreaks) + 1):
         ims = []
         for band in bands:
-            WI = WISE[(WISE.mjd >= elo) * (WISE.mjd < ehi) * (WISE.band == band)]
-            if len(WI) == 0:
+            outfn = os.path.join(out, 'unwise-%s-w%i-e%i-img-u.fits' %
+                                 (dataset, band, ei))
+            if not os.path.exists(outfn):
+                # Only epochs with no frames included have no outputs.
+                F = fits_table(os.path.join(out, 'unwise-%s-w%i-frames.fits' %
+                                            (dataset, band)),
+                               columns=['epoch', 'included'])
+                if np.any(F.included[F.epoch == ei]):
+                    print 'Missing output for epoch', ei, ':', outfn
+                    return -1
                 ims.append(None)
                 continue
-            out = os.path.join(outdir, etag % ei)
-            outfn = os.path.join(out, 'unwise-%s-w%i-img-u.fits' % (dataset, band))
-            if not os.path.exists(outfn):
-                trymakedirs(out, dir=True)
-                print 'Band', band, 'Epoch', ei
-                if one_coadd(tile, band, W, H, pixscale, WI, ps,
-                             False, out, mp, mp,
-                             cube, False, None, None, force,
-                             medfilt, 0, dsky, False, bgmatch,
-                             False, False,  
-                             rchi_fraction, cube1,
-                             None, None, None, force_outdir=True):
-                    os.unlink(out)
-                    break
             print 'read', outfn
             ims.append(fitsio.read(outfn))
             print ims[-1].shape, ims[-1].min(), ims[-1].max()
@@ -191,19 +204,8 @@ def create_animations(ra, dec, W, H, pixscale=2.75, bands=[1,2],
     if diffim:
         # Difference image vs coadd of all images
         allims = []
-        out = os.path.join(outdir, 'all')
-        trymakedirs(out, dir=True)
         for band in bands:
             outfn = os.path.join(out, 'unwise-%s-w%i-img-u.fits' % (dataset, band))
-            if not os.path.exists(outfn):
-                print 'Band', band, 'Epoch', ei
-                one_coadd(tile, band, W, H, pixscale, WISE, ps,
-                          False, out, mp, mp,
-                          cube, False, None, None, force,
-                          medfilt, 0, dsky, False, bgmatch,
-                          False, False,  
-                          rchi_fraction, cube1,
-                          None, None, None, force_outdir=True)
             print 'read', outfn
             allims.append(fitsio.read(outfn))
             print allims[-1].shape, allims[-1].min(), allims[-1].max()
@@ -280,11 +282,6 @@ def create_animations(ra, dec, W, H, pixscale=2.75, bands=[1,2],
             fn = os.path.join(outdir, 'sdiff-%s-%s.jpg' % (dataset_tag, etag % ei))
             plt.imsave(fn, rgb, origin='lower')
             print 'Wrote', fn
-            #giffn = os.path.join(outdir, 'diff-%s-%s.gif' % (etag % ei, dataset_tag))
-            #cmd = 'jpegtopnm %s | pnmquant 256 | ppmtogif > %s' % (fn, giffn)
-            #print cmd
-            #os.system(cmd)
-            #gifs.append(giffn)
 
 
     return            
@@ -0,0 +1,101 @@
+'''
+Benchmark of the round-2 outlier (rchi) kernel in unwise_coadd.py: the
+full-array round2_rchi (used when plotting) versus the blocked
+round2_badpix_blocked plus round2_contributions (used otherwise).
+
+For each, reports the time per frame and the peak extra memory -- in MB
+and in frame-sized float64 arrays -- measured as the growth of the peak
+RSS of a fresh process beyond the inputs.  The blocked kernel's
+temporaries are a few blocks of rows, so its extra memory is just its
+outputs; time is dominated by memory traffic, so it shows the
+bandwidth saving, too.  Also checks that the two give identical
+results.
+'''
+import matplotlib
+if __name__ == '__main__':
+    matplotlib.use('Agg')
+import numpy as np
+import sys
+import time
+import resource
+import multiprocessing
+
+from unwise_coadd import (round2_rchi, round2_badpix_blocked,
+                          round2_contributions)
+
+def fake_frame(H, W, seed=42):
+    rng = np.random.RandomState(seed)
+    w = 1. / 1.5**2
+    rimg = rng.normal(scale=1.5, size=(H,W)).astype(np.float32)
+    mask = (rng.uniform(size=(H,W)) > 0.05)
+    n = rng.uniform(5, 20, size=(H,W))
+    cow1 = n * w
+    cowimg1 = cow1 * rng.normal(scale=0.5, size=(H,W))
+    cowimgsq1 = cow1 * (1.5**2 + (cowimg1 / cow1)**2)
+    return rimg, mask, w, (cow1, cowimg1, cowimgsq1)
+
+def run_full(rimg, mask, w, refs, do_dsky):
+    dsky,subco,subpp,rchi = round2_rchi(rimg, mask, w, refs, 1e-16, do_dsky)
+    badpix = (np.abs(rchi) >= 5.)
+    del subco, subpp, rchi
+    r = rimg - dsky
+    return badpix, (mask * w * r**2, mask * w * r, mask * w)
+
+def run_blocked(rimg, mask, w, refs, do_dsky):
+    dsky,badpix = round2_badpix_blocked(rimg, mask, w, refs, 1e-16, do_dsky)
+    r = rimg - dsky
+    return badpix, round2_contributions(r, mask, w)
+
+def maxrss():
+    # (kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.
+
+def _bench(func, H, W, reps, do_dsky, q):
+    args = fake_frame(H, W)
+    rss0 = maxrss()
+    t0 = time.time()
+    for i in range(reps):
+        res = func(*(args + (do_dsky,)))
+        del res
+    dt = (time.time() - t0) / reps
+    q.put((dt, maxrss() - rss0))
+
+def bench(func, H, W, reps, do_dsky):
+    # one fresh process each, for clean peak-RSS numbers
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_bench,
+                                args=(func, H, W, reps, do_dsky, q))
+    p.start()
+    r = q.get()
+    p.join()
+    return r
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('%prog [options]')
+    parser.add_option('--size', type=int, default=1016,
+                      help='Frame size in pixels (default: WISE L1b, 1016)')
+    parser.add_option('--reps', type=int, default=10,
+                      help='Repetitions for timing')
+    parser.add_option('--dsky', action='store_true', default=False,
+                      help='Include the sky-difference pass')
+    opt,args = parser.parse_args()
+
+    H = W = opt.size
+    rimg,mask,w,refs = fake_frame(H, W)
+    a = run_full(rimg, mask, w, refs, opt.dsky)
+    b = run_blocked(rimg, mask, w, refs, opt.dsky)
+    same = (np.array_equal(a[0], b[0]) and
+            all([np.array_equal(x, y) for x,y in zip(a[1], b[1])]))
+    print 'Identical results:', same
+    del a, b
+
+    frame = H * W * 8.
+    for func in [run_full, run_blocked]:
+        dt,mem = bench(func, H, W, opt.reps, opt.dsky)
+        print '%-12s %8.1f ms/frame  peak extra memory %7.1f MB = %5.1f frame-size float64 arrays' % (
+            func.__name__[4:], dt * 1e3, mem / 1e6, mem / frame)
+    return (0 if same else 1)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import os
 import sys
+import shutil
 import numpy as np
 
 import fitsio
@@ -87,6 +88,9 @@ if __name__ == '__main__':
             ('unwise-%s-w%i-n-u.fits', 0, True),
             ('unwise-%s-w%i-frames.fits', 0, False),
             ]
+    # Tiles written with unwise_coadd.py --mef: all the image planes in
+    # one tile-compressed file, which is copied as is.
+    mefpat = 'unwise-%s-w%i.fits'
     gzargs = ''
 
     if len(opt.tiles):
@@ -114,6 +118,7 @@ if __name__ == '__main__':
 
             # Skip inputs that don't exist
             exists = False
+            mef = None
             fns = []
             for indir in indirs:
                 fn = os.path.join(indir, coadd[:3], coadd, pats[0][0] % (coadd, band))
@@ -121,12 +126,25 @@ if __name__ == '__main__':
                     exists = True
                     break
                 fns.append(fn)
+                fn = os.path.join(indir, coadd[:3], coadd, mefpat % (coadd, band))
+                if os.path.exists(fn):
+                    exists = True
+                    mef = fn
+                    break
+                fns.append(fn)
             if not exists:
                 print 'Input file does not exist:', fns
                 continue
     
             maskdir = 'unwise-%s-w%i-mask' % (coadd, band)
+            maskfn = 'unwise-%s-w%i-masks.fits' % (coadd, band)
             for indir in indirs:
+                # mask archive (unwise_coadd.maskwriter)
+                fn = os.path.join(indir, coadd[:3], coadd, maskfn)
+                print 'Checking', fn
+                if os.path.exists(fn):
+                    print 'exists'
+                    break
                 fn = maskdir + '.tgz'
                 fn = os.path.join(indir, coadd[:3], coadd, fn)
                 print 'Checking', fn
@@ -143,22 +161,39 @@ if __name__ == '__main__':
     
             outfn = os.path.join(outpath, maskdir + '.tgz')
             absoutfn = os.path.abspath(outfn)
-            if not fn.endswith('.tgz'):
+            cmd = None
+            if fn.endswith(maskfn):
+                # (an incremental run's archive includes the masks of an
+                # earlier -mask.tgz; see unwise_coadd.add_mask_tgz)
+                outfn = os.path.join(outpath, maskfn)
+            elif not fn.endswith('.tgz'):
                 # tar
                 dirfn = os.path.dirname(fn)
                 cmd = '(cd %s && tar czf %s %s)' % (dirfn, absoutfn, maskdir)
-            else:
-                # copy
-                cmd = 'cp %s %s' % (fn, outfn)
 
             if opt.skip and os.path.exists(outfn):
                 print 'Already exists:', outfn
                 continue
-            print cmd
-            if not opt.dryrun:
-                rtn = os.system(cmd)
-                if rtn:
-                    sys.exit(rtn)
+            if cmd is None:
+                print 'Copying', fn, 'to', outfn
+                if not opt.dryrun:
+                    shutil.copy(fn, outfn)
+            else:
+                print cmd
+                if not opt.dryrun:
+                    rtn = os.system(cmd)
+                    if rtn:
+                        sys.exit(rtn)
+
+            if mef is not None:
+                # The MEF file and the frames table
+                for fn in [mef, mef.replace('.fits', '-frames.fits')]:
+                    assert(os.path.exists(fn))
+                    outfn = os.path.join(outpath, os.path.basename(fn))
+                    print 'Copying', fn, 'to', outfn
+                    if not opt.dryrun:
+                        shutil.copy(fn, outfn)
+                continue
 
             for pat, truncbits, compress in pats:
                 for indir in indirs:
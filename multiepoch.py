@@ -0,0 +1,150 @@
+'''
+Validation for multi-epoch coadds (unwise_coadd.py --multi-epoch).
+
+Simulates round-1 frames from several epochs -- with cosmic rays and a
+source that varies between epochs -- and runs round 2 on them three
+ways: as a plain coadd, as a multi-epoch coadd, and as one plain coadd
+per epoch.  Checks that the full-depth coadd of the multi-epoch run is
+identical to the plain coadd, and that each of its epoch coadds is
+identical to that epoch's own coadd.  With --compare, checks that the
+full-depth coadd products of a pair of real runs (with and without
+--multi-epoch) are identical instead.
+'''
+import matplotlib
+if __name__ == '__main__':
+    matplotlib.use('Agg')
+import numpy as np
+import sys
+
+import fitsio
+
+from astrometry.util.util import Tan
+
+from unwise_coadd import (coaddacc, coadd_products, _coadd_one_round2,
+                          _frame_refs, Duck)
+
+def simulate_frames(H=200, W=200, nframes=60, nepochs=3, seed=42):
+    '''
+    Returns (cowcs, epochs, list of functions returning each round-1
+    frame afresh; round 2 modifies them).
+    '''
+    rng = np.random.RandomState(seed)
+    cowcs = Tan(0., 0., (W+1)/2., (H+1)/2., -2.75/3600., 0., 0., 2.75/3600.,
+                float(W), float(H))
+    yy,xx = np.mgrid[:H,:W]
+    def source(x, y, flux):
+        return flux * np.exp(-0.5 * ((xx-x)**2 + (yy-y)**2) / 1.5**2)
+    truth = np.zeros((H,W))
+    for i in range(20):
+        truth += source(rng.uniform(0, W), rng.uniform(0, H),
+                        10.**rng.uniform(1, 3))
+    # one source is much brighter in the last epoch
+    var = [source(W/2., H/2., 50. * (1 + 20 * (e == nepochs-1)))
+           for e in range(nepochs)]
+    epochs = np.arange(nframes) * nepochs / nframes
+    frames = []
+    for i in range(nframes):
+        h,w = rng.randint(H/2, H+1), rng.randint(W/2, W+1)
+        y0,x0 = rng.randint(0, H-h+1), rng.randint(0, W-w+1)
+        slc = slice(y0, y0+h), slice(x0, x0+w)
+        sig1 = rng.uniform(0.8, 1.2)
+        img = (truth + var[epochs[i]])[slc] + rng.normal(scale=sig1, size=(h,w))
+        # cosmic rays
+        for j in range(10):
+            img[rng.randint(0, h), rng.randint(0, w)] += 1000.
+        img = img.astype(np.float32)
+        rmask = (1 + 2 * (rng.uniform(size=(h,w)) > 0.02)).astype(np.uint8)
+        subwcs = cowcs.get_subimage(x0, y0, w, h)
+        def frame(img=img, rmask=rmask, wt=1./sig1**2, subwcs=subwcs,
+                  ext=(x0, x0+w-1, y0, y0+h-1)):
+            rr = Duck()
+            rr.rimg = img.copy()
+            rr.rmask = rmask.copy()
+            rr.w = wt
+            rr.coextent = ext
+            rr.wcs = rr.cosubwcs = subwcs
+            rr.npatched = 0
+            rr.ncopix = img.size
+            rr.sky = rr.zp = 0.
+            rr.zpscale = 1.
+            return rr
+        frames.append(frame)
+    return cowcs, epochs, frames
+
+def round1_sums(frames, H, W):
+    cow = np.zeros((H,W))
+    cowimg = np.zeros((H,W))
+    cowimgsq = np.zeros((H,W))
+    for frame in frames:
+        rr = frame()
+        x0,x1,y0,y1 = rr.coextent
+        slc = slice(y0, y1+1), slice(x0, x1+1)
+        m = (rr.rmask & 1) > 0
+        cow[slc] += m * rr.w
+        cowimg[slc] += m * rr.w * rr.rimg
+        cowimgsq[slc] += m * rr.w * rr.rimg**2
+    return cow, cowimg, cowimgsq
+
+def run(frames, refs, H, W, epochs=None, erefs=None, do_dsky=True,
+        rchi_fraction=0.1, tinyw=1e-16):
+    coadd = coaddacc(H, W, epochs=epochs)
+    for ri,frame in enumerate(frames):
+        mm = _coadd_one_round2((ri, len(frames), 'frame %i' % ri, frame(),
+                                _frame_refs(refs, erefs, epochs, ri), tinyw,
+                                None, False, do_dsky, rchi_fraction))
+        coadd.acc(mm, delmm=True, ri=ri)
+    coadd.finish()
+    return coadd
+
+def same(name, P, Q):
+    ok = all([np.array_equal(p, q) for p,q in zip(P, Q)])
+    print '%-10s identical: %s' % (name, ok)
+    return ok
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('%prog [options]\n' +
+                                   '       %prog --compare <prefix> <multi-epoch prefix>')
+    parser.add_option('--compare', action='store_true', default=False,
+                      help='Compare coadd outputs, eg, out/121/1210p000/unwise-1210p000-w1 outme/...')
+    parser.add_option('-n', dest='nframes', type=int, default=60,
+                      help='Number of simulated frames')
+    parser.add_option('--epochs', type=int, default=3,
+                      help='Number of simulated epochs')
+    opt,args = parser.parse_args()
+
+    ok = True
+    if opt.compare:
+        if len(args) != 2:
+            parser.print_help()
+            return -1
+        for suff in ['u', 'm']:
+            for im in ['img', 'invvar', 'std', 'n']:
+                A = [fitsio.read('%s-%s-%s.fits' % (prefix, im, suff))
+                     for prefix in args]
+                ok = same('%s-%s' % (im, suff), [A[0]], [A[1]]) and ok
+        return (0 if ok else 1)
+
+    H = W = 200
+    tinyw = 1e-16
+    cowcs,epochs,frames = simulate_frames(H=H, W=W, nframes=opt.nframes,
+                                          nepochs=opt.epochs)
+    refs = round1_sums(frames, H, W)
+    E = opt.epochs
+    esums = [round1_sums([f for f,e in zip(frames, epochs) if e == i], H, W)
+             for i in range(E)]
+    erefs = tuple([np.array([S[k] for S in esums]) for k in range(3)])
+
+    plain = run(frames, refs, H, W)
+    multi = run(frames, refs, H, W, epochs=epochs, erefs=erefs)
+    ok = same('full', coadd_products(plain, tinyw),
+              coadd_products(multi, tinyw)) and ok
+    for e in range(E):
+        sep = run([f for f,ee in zip(frames, epochs) if ee == e], esums[e],
+                  H, W)
+        ok = same('epoch %i' % e, coadd_products(sep, tinyw),
+                  coadd_products(multi.ecoadds[e], tinyw)) and ok
+    return (0 if ok else 1)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -183,9 +183,10 @@ plt.colorbar()
 plt.title('cow1 / meanw')
 ps.savefig()
 
-cube = fitsio.FITS(base1 + 'cube1.fits')[0]
-print 'Cube', cube.get_info()['dims']
-N,H,W = cube.get_info()['dims']
+from unwise_coadd import cubereader
+cube = cubereader(base1 + 'cube1.fits')
+N,H,W = len(cube), cube.H, cube.W
+print 'Cube', (N,H,W)
 
 n1 = np.round(cow1 / meanw).astype(int)
 print 'n1', n1.min(), n1.max(), n1.mean()
@@ -198,9 +199,7 @@ print 'Weights of used fields:', T.weight[U]
 lo,hi = -10000,10000
 xx = np.linspace(lo, hi, 500)
 for yi,xi in zip(*np.unravel_index(np.flatnonzero(lowpix), n1.shape))[:50]:
-    pix = cube[:, yi:yi+1, xi:xi+1]
-
-    pix = pix.ravel()
+    pix = cube.pixel(xi, yi)
     I = np.flatnonzero(pix != 0)
     
     #pix = pix[pix != 0]
@@ -265,9 +264,7 @@ for yi,xi in zip(*np.unravel_index(np.flatnonzero(lowpix), n1.shape))[:50]:
 sys.exit(0)
 
 for i in range(N):
-    plane = cube[i:i+1,:,:]
-    #print 'plane', plane.shape
-    plane = plane[0,:,:]
+    plane = cube.plane(i)
     plt.clf()
     plt.imshow(plane, **ima)
     plt.colorbar()
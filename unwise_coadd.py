@@ -10,6 +10,8 @@ import sys
 import tempfile
 import datetime
 import gc
+import copy
+import atexit
 from scipy.ndimage.morphology import binary_dilation
 from scipy.ndimage.measurements import label, center_of_mass
 
@@ -85,14 +87,11 @@ def get_coadd_tile_wcs(ra, dec, W=2048, H=2048, pixscale=2.75):
                 -pixscale/3600., 0., 0., pixscale/3600., W, H)
     return cowcs
 
-def walk_wcs_boundary(wcs, step=1024, margin=0):
+def _boundary_pixels(W, H, step=1024, margin=0):
     '''
-    Walk the image boundary counter-clockwise.
-
-    Returns rr,dd -- RA,Dec numpy arrays.
+    Returns x,y pixel coordinates walking the boundary of a W x H
+    image counter-clockwise (see walk_wcs_boundary).
     '''
-    W = wcs.get_width()
-    H = wcs.get_height()
     xlo = 1
     xhi = W
     ylo = 1
@@ -127,8 +126,18 @@ def walk_wcs_boundary(wcs, step=1024, margin=0):
     # (note, NOT closed)
     xx.append(np.zeros_like(y) + x)
     yy.append(y)
-    #
-    rr,dd = wcs.pixelxy2radec(np.hstack(xx), np.hstack(yy))
+    return np.hstack(xx), np.hstack(yy)
+
+def walk_wcs_boundary(wcs, step=1024, margin=0):
+    '''
+    Walk the image boundary counter-clockwise.
+
+    Returns rr,dd -- RA,Dec numpy arrays.
+    '''
+    W = wcs.get_width()
+    H = wcs.get_height()
+    xx,yy = _boundary_pixels(W, H, step=step, margin=margin)
+    rr,dd = wcs.pixelxy2radec(xx, yy)
     return rr,dd
 
 def get_wcs_radec_bounds(wcs):
@@ -137,39 +146,196 @@ def get_wcs_radec_bounds(wcs):
     d0,d1 = dd.min(), dd.max()
     return r0,r1,d0,d1
 
+def tan_iwc2radec(ra0, dec0, u, v):
+    '''
+    Vectorized inverse gnomonic (TAN) projection: intermediate world
+    coordinates u,v (deg) around tangent point(s) ra0,dec0 -> RA,Dec
+    (deg).  Arguments broadcast against each other.
+    '''
+    x = np.deg2rad(u)
+    y = np.deg2rad(v)
+    d0 = np.deg2rad(dec0)
+    den = np.cos(d0) - y * np.sin(d0)
+    ra = (ra0 + np.rad2deg(np.arctan2(x, den))) % 360.
+    dec = np.rad2deg(np.arctan2(np.sin(d0) + y * np.cos(d0), np.hypot(x, den)))
+    return ra, dec
+
+def tan_radec2iwc(ra0, dec0, ra, dec):
+    '''
+    Vectorized gnomonic (TAN) projection: RA,Dec (deg) -> intermediate
+    world coordinates u,v (deg) around tangent point(s) ra0,dec0.
+    Returns ok,u,v; ok is False for points on the far hemisphere.
+    '''
+    dra = np.deg2rad(ra - ra0)
+    d = np.deg2rad(dec)
+    d0 = np.deg2rad(dec0)
+    cosc = np.sin(d0) * np.sin(d) + np.cos(d0) * np.cos(d) * np.cos(dra)
+    u = np.rad2deg(np.cos(d) * np.sin(dra) / cosc)
+    v = np.rad2deg((np.cos(d0) * np.sin(d) - np.sin(d0) * np.cos(d) * np.cos(dra))
+                   / cosc)
+    return (cosc > 0), u, v
+
+def get_atlas_tile_bounds(ra, dec, W=2048, H=2048, pixscale=2.75):
+    '''
+    Vectorized version of get_wcs_radec_bounds(get_coadd_tile_wcs(...))
+    for arrays of tile centers *ra*, *dec*.
+
+    Returns r0,r1,d0,d1 arrays.  r0,r1 are continuous across RA = 0, so
+    r0 may be < 0 or r1 > 360; tiles containing a pole get r0,r1 =
+    0,360.
+    '''
+    ra = np.atleast_1d(ra).astype(float)
+    dec = np.atleast_1d(dec).astype(float)
+    s = pixscale / 3600.
+    x,y = _boundary_pixels(W, H)
+    u = -s * (x - (W+1)/2.)
+    v =  s * (y - (H+1)/2.)
+    rr,dd = tan_iwc2radec(ra[:,np.newaxis], dec[:,np.newaxis],
+                          u[np.newaxis,:], v[np.newaxis,:])
+    dra = (rr - ra[:,np.newaxis] + 180.) % 360. - 180.
+    r0 = ra + dra.min(axis=1)
+    r1 = ra + dra.max(axis=1)
+    d0 = dd.min(axis=1)
+    d1 = dd.max(axis=1)
+    # Tiles containing a pole
+    umax = s * (W-1)/2.
+    vmax = s * (H-1)/2.
+    for pole in [90., -90.]:
+        ok,pu,pv = tan_radec2iwc(ra, dec, 0., pole)
+        I = np.flatnonzero(ok * (np.abs(pu) <= umax) * (np.abs(pv) <= vmax))
+        r0[I] = 0.
+        r1[I] = 360.
+        if pole > 0:
+            d1[I] = pole
+        else:
+            d0[I] = pole
+    return r0,r1,d0,d1
+
+# Pre-built Atlas tile index (bounds of all tiles), in wisedir
+atlas_index_fn = 'atlas-tile-index.fits'
+
+def temp_file_beside(fn):
+    '''
+    Returns the name of a new temp file of our own in the same
+    directory as *fn*, to be written and then renamed onto *fn*, so
+    that readers -- and other jobs writing *fn* -- never see a partial
+    file.  (The name is free: fitsio appends to existing files.)
+    '''
+    f,tmpfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)),
+                               suffix='.tmp')
+    os.close(f)
+    os.unlink(tmpfn)
+    return tmpfn
+
+def build_atlas_tile_index(fn=None, W=2048, H=2048, pixscale=2.75):
+    '''
+    Builds the Atlas tile index: the Atlas Image table plus the RA,Dec
+    bounds (ra0,ra1,dec0,dec1; see get_atlas_tile_bounds) of every
+    coadd tile, computed in one vectorized pass.  Writes it to *fn* if
+    that directory is writable; returns it either way.
+    '''
+    if fn is None:
+        fn = os.path.join(wisedir, atlas_index_fn)
+    tfn = os.path.join(wisedir, 'wise_allsky_4band_p3as_cdd.fits')
+    print 'Reading', tfn
+    T = fits_table(tfn, columns=['coadd_id', 'ra', 'dec'])
+    print 'Read', len(T), 'Atlas tiles'
+    T.coadd_id = np.array([c.replace('_ab41','') for c in T.coadd_id])
+    T.ra0,T.ra1,T.dec0,T.dec1 = get_atlas_tile_bounds(T.ra, T.dec, W, H, pixscale)
+    hdr = fitsio.FITSHDR()
+    hdr.add_record(dict(name='TILEW', value=W, comment='Coadd tile width (pixels)'))
+    hdr.add_record(dict(name='TILEH', value=H, comment='Coadd tile height (pixels)'))
+    hdr.add_record(dict(name='PIXSCALE', value=pixscale,
+                        comment='Coadd pixel scale (arcsec/pixel)'))
+    if not os.access(os.path.dirname(os.path.abspath(fn)), os.W_OK):
+        print 'Not writing Atlas tile index', fn, '(directory not writable)'
+        return T
+    tmpfn = temp_file_beside(fn)
+    T.writeto(tmpfn, header=hdr)
+    os.rename(tmpfn, fn)
+    print 'Wrote', fn
+    return T
+
+def read_atlas_tile_index(fn=None, W=2048, H=2048, pixscale=2.75):
+    '''
+    Reads the Atlas tile index, building it if it does not exist or
+    was built for a different tile geometry.
+    '''
+    if fn is None:
+        fn = os.path.join(wisedir, atlas_index_fn)
+    if os.path.exists(fn):
+        hdr = fitsio.read_header(fn, ext=1)
+        if (hdr.get('TILEW') == W and hdr.get('TILEH') == H and
+            hdr.get('PIXSCALE') == pixscale):
+            T = fits_table(fn)
+            print 'Read', len(T), 'Atlas tiles from', fn
+            return T
+        print 'Atlas tile index', fn, 'does not match tile size; rebuilding'
+        fn = fn.replace('.fits', '-%ix%i-%g.fits' % (W, H, pixscale))
+        if os.path.exists(fn):
+            return read_atlas_tile_index(fn, W, H, pixscale)
+    return build_atlas_tile_index(fn, W, H, pixscale)
+
+def atlas_tiles_in_box(A, r0,r1,d0,d1):
+    '''
+    Returns a boolean array: which Atlas tiles (from the Atlas tile
+    index *A*) touch the RA,Dec box.  Handles RA wrap-around.
+    '''
+    ok = (A.dec1 >= d0) * (A.dec0 <= d1)
+    if r1 - r0 >= 360.:
+        return ok
+    rok = np.zeros(len(A), bool)
+    for wrap in [-360., 0., 360.]:
+        rok |= (A.ra1 + wrap >= r0) * (A.ra0 + wrap <= r1)
+    return ok * rok
+
+def lookup_atlas_tiles(A, ra, dec, W=2048, H=2048, pixscale=2.75):
+    '''
+    Batch lookup of the coadd tile for each RA,Dec point: the tile (from
+    Atlas tile index *A*) whose center is nearest the point.
+
+    Returns (tile, x, y): *tile* is the index into *A* (-1 if the point
+    is not inside the nearest tile), and x,y are the zero-indexed pixel
+    coordinates of the point in that tile.
+    '''
+    ra = np.atleast_1d(ra).astype(float)
+    dec = np.atleast_1d(dec).astype(float)
+    tile = np.zeros(len(ra), int) - 1
+    x = np.zeros(len(ra), np.float32)
+    y = np.zeros(len(ra), np.float32)
+    s = pixscale / 3600.
+    radius = np.hypot(W, H) / 2. * s
+    I,J,d = match_radec(ra, dec, A.ra, A.dec, radius, nearest=True)
+    ok,u,v = tan_radec2iwc(A.ra[J], A.dec[J], ra[I], dec[I])
+    # zero-indexed pixel coords
+    xx = (W+1)/2. - u / s - 1.
+    yy = (H+1)/2. + v / s - 1.
+    ok *= (xx > -0.5) * (xx < W-0.5) * (yy > -0.5) * (yy < H-0.5)
+    tile[I[ok]] = J[ok]
+    x[I] = xx
+    y[I] = yy
+    return tile, x, y
+
 def get_atlas_tiles(r0,r1,d0,d1, W=2048, H=2048, pixscale=2.75):
     '''
     Select Atlas Image tiles touching a desired RA,Dec box.
 
     pixscale in arcsec/pixel
     '''
-    # Read Atlas Image table
-    fn = os.path.join(wisedir, 'wise_allsky_4band_p3as_cdd.fits')
-    print 'Reading', fn
-    T = fits_table(fn, columns=['coadd_id', 'ra', 'dec'])
+    # Read Atlas Image tile index
+    T = read_atlas_tile_index(W=W, H=H, pixscale=pixscale)
     T.row = np.arange(len(T))
-    print 'Read', len(T), 'Atlas tiles'
 
     margin = (max(W,H) / 2.) * (pixscale / 3600.)
 
     T.cut(in_radec_box(T.ra, T.dec, r0,r1,d0,d1, margin))
     print 'Cut to', len(T), 'Atlas tiles near RA,Dec box'
 
-    T.coadd_id = np.array([c.replace('_ab41','') for c in T.coadd_id])
-
     # Some of them don't *actually* touch our RA,Dec box...
-    print 'Checking tile RA,Dec bounds...'
-    keep = []
-    for i in range(len(T)):
-        wcs = get_coadd_tile_wcs(T.ra[i], T.dec[i], W, H, pixscale)
-        R0,R1,D0,D1 = get_wcs_radec_bounds(wcs)
-        # FIXME RA wrap
-        if R1 < r0 or R0 > r1 or D1 < d0 or D0 > d1:
-            print 'Coadd tile', T.coadd_id[i], 'is outside RA,Dec box'
-            continue
-        keep.append(i)
-    T.cut(np.array(keep))
+    T.cut(atlas_tiles_in_box(T, r0,r1,d0,d1))
     print 'Cut to', len(T), 'tiles'
+    for c in ['ra0', 'ra1', 'dec0', 'dec1']:
+        T.delete_column(c)
     # sort
     T.cut(np.argsort(T.coadd_id))
     return T
@@ -214,19 +380,23 @@ def in_radec_box(ra,dec, r0,r1,d0,d1, margin):
                 (dec + margin >= d0) *
                 (dec - margin <= d1))
 
-def get_wise_frames(r0,r1,d0,d1, margin=2.):
+# WISE Single-Frame Metadata Tables: (number of bands, name), in order
+# of precedence (later tables override earlier ones).
+frame_metadata_tables = [(4,'4band'), (3,'3band'), (2,'2band'), (2,'neowiser')]
+
+# Pre-joined L1b index + metadata table, written by build_frame_metadata()
+frame_metadata_fn = 'WISE-l1b-joined.fits'
+
+def _frame_keys(scan_id, frame_num):
     '''
-    Returns WISE frames touching the given RA,Dec box plus margin.
+    Returns string keys "scanid-frame" for exact (scan_id, frame_num)
+    joins.
     '''
-    # Read WISE frame metadata
-    WISE = fits_table(os.path.join(wisedir, 'WISE-index-L1b.fits'))
-    print 'Read', len(WISE), 'WISE L1b frames'
-    WISE.row = np.arange(len(WISE))
-
-    # Coarse cut on RA,Dec box.
-    WISE.cut(in_radec_box(WISE.ra, WISE.dec, r0,r1,d0,d1, margin))
-    print 'Cut to', len(WISE), 'WISE frames near RA,Dec box'
+    scan_id = np.char.strip(np.asarray(scan_id).astype(str))
+    return np.char.add(np.char.add(scan_id, '-'),
+                       np.asarray(frame_num).astype(int).astype(str))
 
+def _init_frame_metadata(WISE):
     # Join to WISE Single-Frame Metadata Tables
     WISE.qual_frame = np.zeros(len(WISE), np.int16) - 1
     WISE.moon_masked = np.zeros(len(WISE), bool)
@@ -240,58 +410,192 @@ def get_wise_frames(r0,r1,d0,d1, margin=2.):
 
     # 4-band, 3-band, or 2-band phase
     WISE.phase = np.zeros(len(WISE), np.uint8)
-    
-    for nbands,name in [(4,'4band'), (3,'3band'), (2,'2band'), (2,'neowiser')]:
-        fn = os.path.join(wisedir, 'WISE-l1b-metadata-%s.fits' % name)
-        print 'Reading', fn
-        bb = [1,2,3,4][:nbands]
-        cols = (['ra', 'dec', 'scan_id', 'frame_num',
-                 'qual_frame', 'moon_masked', ] +
-                ['w%iintmed16ptile' % b for b in bb] +
-                ['w%iintmedian' % b for b in bb] +
-                ['w%iintstddev' % b for b in bb])
-        if nbands > 2:
-            cols.append('dtanneal')
-        T = fits_table(fn, columns=cols)
-        print 'Read', len(T), 'from', fn
+
+def read_frame_metadata(name, nbands):
+    '''
+    Reads the columns we use from the WISE-l1b-metadata-*name*.fits
+    table, for a mission phase with *nbands* bands.
+    '''
+    fn = os.path.join(wisedir, 'WISE-l1b-metadata-%s.fits' % name)
+    print 'Reading', fn
+    bb = [1,2,3,4][:nbands]
+    cols = (['ra', 'dec', 'scan_id', 'frame_num',
+             'qual_frame', 'moon_masked', ] +
+            ['w%iintmed16ptile' % b for b in bb] +
+            ['w%iintmedian' % b for b in bb] +
+            ['w%iintstddev' % b for b in bb])
+    if nbands > 2:
+        cols.append('dtanneal')
+    T = fits_table(fn, columns=cols)
+    print 'Read', len(T), 'from', fn
+    if not 'dtanneal' in T.get_columns():
+        T.dtanneal = np.zeros(len(T), np.float64) + 1000000.
+    return T
+
+def join_frame_metadata(WISE, T, nbands):
+    '''
+    Attaches the metadata columns from table *T* (as returned by
+    read_frame_metadata) to the L1b index rows *WISE*, matching
+    exactly on (scan_id, frame_num, band).  WISE must have been set
+    up with _init_frame_metadata().
+    '''
+    if len(T) == 0 or len(WISE) == 0:
+        return
+    tkeys = _frame_keys(T.scan_id, T.frame_num)
+    I = np.argsort(tkeys)
+    tkeys = tkeys[I]
+    wkeys = _frame_keys(WISE.scan_id, WISE.frame_num)
+    J = np.minimum(np.searchsorted(tkeys, wkeys), len(tkeys)-1)
+    II = np.flatnonzero((tkeys[J] == wkeys) * (WISE.band >= 1) *
+                        (WISE.band <= nbands))
+    JJ = I[J[II]]
+    print 'Matched', len(II), 'on scan/frame/band'
+    if len(II) == 0:
+        return
+    # band index per matched row
+    B = WISE.band[II].astype(int) - 1
+    bb = range(1, nbands+1)
+
+    WISE.qual_frame[II] = T.qual_frame[JJ].astype(WISE.qual_frame.dtype)
+    # "moon_masked" is a string of per-band '0'/'1' flags
+    moon = np.asarray(T.moon_masked[JJ]).astype('S4')
+    moon = moon.view('S1').reshape(len(moon), 4)
+    WISE.moon_masked[II] = (moon[np.arange(len(B)), B] == '1')
+    WISE.dtanneal [II] = T.dtanneal[JJ].astype(WISE.dtanneal.dtype)
+    for col,tcol in [('intmedian', 'w%iintmedian'),
+                     ('intstddev', 'w%iintstddev'),
+                     ('intmed16p', 'w%iintmed16ptile')]:
+        X = np.vstack([T.get(tcol % b)[JJ] for b in bb])
+        WISE.get(col)[II] = X[B, np.arange(len(B))].astype(np.float32)
+    WISE.matched[II] = True
+    WISE.phase[II] = nbands
+
+def build_frame_metadata(fn=None):
+    '''
+    One-time build of the WISE L1b index joined to all the
+    frame_metadata_tables, written to *fn* (default: wisedir /
+    frame_metadata_fn).  get_wise_frames() then just slices this
+    table.  Only matched frames are kept; new metadata tables can be
+    added with append_frame_metadata().
+    '''
+    if fn is None:
+        fn = os.path.join(wisedir, frame_metadata_fn)
+    WISE = fits_table(os.path.join(wisedir, 'WISE-index-L1b.fits'))
+    print 'Read', len(WISE), 'WISE L1b frames'
+    WISE.row = np.arange(len(WISE))
+    _init_frame_metadata(WISE)
+    for nbands,name in frame_metadata_tables:
+        join_frame_metadata(WISE, read_frame_metadata(name, nbands), nbands)
+    print np.sum(WISE.matched), 'of', len(WISE), 'matched to metadata tables'
+    nun = int(np.sum(np.logical_not(WISE.matched)))
+    if nun:
+        print 'WARNING: dropping', nun, 'frames not in the metadata tables'
+    WISE.cut(WISE.matched)
+    WISE.delete_column('matched')
+    # bool -> uint8 to avoid confusing fitsio
+    WISE.moon_masked = WISE.moon_masked.astype(np.uint8)
+    hdr = fitsio.FITSHDR()
+    for i,(nbands,name) in enumerate(frame_metadata_tables):
+        hdr.add_record(dict(name='META%i' % i, value=name,
+                            comment='Joined metadata table (%i bands)' % nbands))
+    hdr.add_record(dict(name='NUNMATCH', value=nun,
+                        comment='L1b index frames dropped (no metadata)'))
+    lock = lock_file(fn)
+    try:
+        tmpfn = temp_file_beside(fn)
+        WISE.writeto(tmpfn, header=hdr)
+        os.rename(tmpfn, fn)
+    finally:
+        unlock_file(lock)
+    print 'Wrote', fn
+
+def append_frame_metadata(name, nbands=2, fn=None):
+    '''
+    Joins a new WISE-l1b-metadata-*name*.fits table (eg, a new NEOWISE
+    release) to the L1b index rows that are not yet in the pre-joined
+    table *fn*, and appends the matches to it.  The rows of
+    WISE-index-L1b.fits must be stable (new frames appended).  As in
+    append_table, a copy is updated and renamed onto *fn*.
+    '''
+    import shutil
+    if fn is None:
+        fn = os.path.join(wisedir, frame_metadata_fn)
+    lock = lock_file(fn)
+    try:
+        tmpfn = temp_file_beside(fn)
+        shutil.copyfile(fn, tmpfn)
+        n = _append_frame_metadata(tmpfn, name, nbands)
+        os.rename(tmpfn, fn)
+    finally:
+        unlock_file(lock)
+    print 'Appended', n, 'frames to', fn
+
+def _append_frame_metadata(fn, name, nbands):
+    F = fitsio.FITS(fn, 'rw')
+    hdr = F[1].read_header()
+    nmeta = len([k for k in hdr.keys() if k.startswith('META')])
+    done = F[1].read_column('row')
+
+    WISE = fits_table(os.path.join(wisedir, 'WISE-index-L1b.fits'))
+    WISE.row = np.arange(len(WISE))
+    keep = np.ones(len(WISE), bool)
+    keep[done] = False
+    WISE.cut(keep)
+    print len(WISE), 'WISE L1b frames not yet joined'
+    _init_frame_metadata(WISE)
+    join_frame_metadata(WISE, read_frame_metadata(name, nbands), nbands)
+    print np.sum(WISE.matched), 'of', len(WISE), 'matched to', name
+    WISE.cut(WISE.matched)
+    if len(WISE):
+        data = np.zeros(len(WISE), dtype=F[1].get_rec_dtype()[0])
+        for c in data.dtype.names:
+            data[c] = WISE.get(c.lower())
+        F[1].append(data)
+    F[1].write_key('META%i' % nmeta, name,
+                   comment='Joined metadata table (%i bands)' % nbands)
+    F[1].write_key('NUNMATCH', int(np.sum(keep)) - len(WISE),
+                   comment='L1b index frames dropped (no metadata)')
+    F.close()
+    return len(WISE)
+
+def get_wise_frames(r0,r1,d0,d1, margin=2.):
+    '''
+    Returns WISE frames touching the given RA,Dec box plus margin.
+    '''
+    fn = os.path.join(wisedir, frame_metadata_fn)
+    if os.path.exists(fn):
+        # Slice the pre-joined table.
+        nun = fitsio.read_header(fn, ext=1).get('NUNMATCH', 0)
+        if nun:
+            print 'WARNING:', nun, 'L1b frames without metadata are not in', fn
+        WISE = fits_table(fn, columns=['ra', 'dec'])
+        I = np.flatnonzero(in_radec_box(WISE.ra, WISE.dec, r0,r1,d0,d1, margin))
+        print 'Cut to', len(I), 'of', len(WISE), 'WISE frames near RA,Dec box in', fn
+        if len(I):
+            WISE = fits_table(fn, rows=I)
+        else:
+            WISE.cut(I)
+        WISE.moon_masked = (WISE.moon_masked != 0)
+        # Reorder by scan, frame, band
+        WISE.cut(np.lexsort((WISE.band, WISE.frame_num, WISE.scan_id)))
+        return WISE
+
+    # Read WISE frame metadata
+    WISE = fits_table(os.path.join(wisedir, 'WISE-index-L1b.fits'))
+    print 'Read', len(WISE), 'WISE L1b frames'
+    WISE.row = np.arange(len(WISE))
+
+    # Coarse cut on RA,Dec box.
+    WISE.cut(in_radec_box(WISE.ra, WISE.dec, r0,r1,d0,d1, margin))
+    print 'Cut to', len(WISE), 'WISE frames near RA,Dec box'
+
+    _init_frame_metadata(WISE)
+    for nbands,name in frame_metadata_tables:
+        T = read_frame_metadata(name, nbands)
         # Cut with extra large margins
         T.cut(in_radec_box(T.ra, T.dec, r0,r1,d0,d1, 2.*margin))
         print 'Cut to', len(T), 'near RA,Dec box'
-        if len(T) == 0:
-            continue
-
-        if not 'dtanneal' in T.get_columns():
-            T.dtanneal = np.zeros(len(T), np.float64) + 1000000.
-            
-        I,J,d = match_radec(WISE.ra, WISE.dec, T.ra, T.dec, 60./3600.)
-        print 'Matched', len(I)
-
-        print 'WISE-index-L1b scan_id:', WISE.scan_id.dtype, 'frame_num:', WISE.frame_num.dtype
-        print 'WISE-metadata scan_id:', T.scan_id.dtype, 'frame_num:', T.frame_num.dtype
-
-        K = np.flatnonzero((WISE.scan_id  [I] == T.scan_id  [J]) *
-                           (WISE.frame_num[I] == T.frame_num[J]))
-        I = I[K]
-        J = J[K]
-        print 'Cut to', len(I), 'matching scan/frame'
-
-        for band in bb:
-            K = (WISE.band[I] == band)
-            print 'Band', band, ':', sum(K)
-            if sum(K) == 0:
-                continue
-            II = I[K]
-            JJ = J[K]
-            WISE.qual_frame [II] = T.qual_frame [JJ].astype(WISE.qual_frame.dtype)
-            moon = T.moon_masked[JJ]
-            WISE.moon_masked[II] = np.array([m[band-1] == '1' for m in moon]
-                                            ).astype(WISE.moon_masked.dtype)
-            WISE.dtanneal [II] = T.dtanneal[JJ].astype(WISE.dtanneal.dtype)
-            WISE.intmedian[II] = T.get('w%iintmedian' % band)[JJ].astype(np.float32)
-            WISE.intstddev[II] = T.get('w%iintstddev' % band)[JJ].astype(np.float32)
-            WISE.intmed16p[II] = T.get('w%iintmed16ptile' % band)[JJ].astype(np.float32)
-            WISE.matched[II] = True
-            WISE.phase[II] = nbands
+        join_frame_metadata(WISE, T, nbands)
 
     print np.sum(WISE.matched), 'of', len(WISE), 'matched to metadata tables'
     assert(np.sum(WISE.matched) == len(WISE))
@@ -300,6 +604,127 @@ def get_wise_frames(r0,r1,d0,d1, margin=2.):
     WISE.cut(np.lexsort((WISE.band, WISE.frame_num, WISE.scan_id)))
     return WISE
 
+def write_frame_index(WISE, fn, zone=1.):
+    '''
+    Writes the WISE frame table (as returned by get_wise_frames) to a
+    spatially-indexed frame catalog: rows are sorted into Dec zones of
+    height *zone* degrees, and by RA within each zone.  A second HDU,
+    "ZONES", gives the row range of each zone, so that
+    read_frame_index() only has to read the rows near a tile.
+    '''
+    nz = int(np.ceil(180. / zone))
+    z = np.clip(np.floor((WISE.dec + 90.) / zone).astype(int), 0, nz-1)
+    I = np.lexsort((WISE.ra, z))
+    WISE = WISE[I]
+    z = z[I]
+    # bool -> uint8 to avoid confusing fitsio
+    WISE.moon_masked = WISE.moon_masked.astype(np.uint8)
+
+    zz = np.arange(nz)
+    Z = np.rec.fromarrays([-90. + zone * zz, -90. + zone * (zz + 1),
+                           np.searchsorted(z, zz, side='left'),
+                           np.searchsorted(z, zz, side='right')],
+                          names='dec0,dec1,row0,row1')
+    tmpfn = temp_file_beside(fn)
+    WISE.writeto(tmpfn)
+    fitsio.write(tmpfn, Z, extname='ZONES')
+    os.rename(tmpfn, fn)
+    print 'Wrote frame index', fn, 'with', len(WISE), 'frames in', nz, 'zones'
+
+def _ra_ranges(r0, r1):
+    '''
+    Splits the RA range [r0,r1], which may extend outside [0,360), into
+    a list of non-wrapping (lo,hi) ranges within [0,360].
+    '''
+    if r1 - r0 >= 360.:
+        return [(0., 360.)]
+    lo = r0 % 360.
+    hi = lo + (r1 - r0)
+    if hi <= 360.:
+        return [(lo, hi)]
+    return [(lo, 360.), (0., hi - 360.)]
+
+def read_frame_index(fn, r0, r1, d0, d1):
+    '''
+    Reads the frames from a frame index (see write_frame_index) with
+    Dec in [d0,d1] and RA in [r0,r1].  The RA range may extend outside
+    [0,360) to handle RA wrap-around.
+
+    Only the "ra" column of the overlapping Dec zones, and then the
+    selected rows, are read from disk.
+    '''
+    F = fitsio.FITS(fn)
+    Z = F['ZONES'].read()
+    rows = []
+    for dec0,dec1,row0,row1 in Z:
+        if dec1 < d0 or dec0 > d1 or row1 == row0:
+            continue
+        ra = F[1]['ra'][row0:row1]
+        for lo,hi in _ra_ranges(r0, r1):
+            i0 = np.searchsorted(ra, lo, side='left')
+            i1 = np.searchsorted(ra, hi, side='right')
+            rows.append(np.arange(row0 + i0, row0 + i1))
+    F.close()
+    rows = np.unique(np.hstack(rows + [np.array([], int)]))
+    if len(rows) == 0:
+        T = fits_table(fn, rows=np.array([0]))
+        T.cut(np.array([], int))
+    else:
+        T = fits_table(fn, rows=rows)
+    T.cut((T.dec >= d0) * (T.dec <= d1))
+    print 'Read', len(T), 'frames from index', fn
+    # convert to boolean
+    T.moon_masked = (T.moon_masked != 0)
+    # Same order as get_wise_frames
+    T.cut(np.lexsort((T.band, T.frame_num, T.scan_id)))
+    return T
+
+def read_frame_index_box(fn, r0,r1,d0,d1, margin=2.):
+    '''
+    Returns the frames from a frame index within the given RA,Dec box
+    plus margin; the same frames that get_wise_frames() would return.
+    '''
+    if r0 == 0. and r1 == 360.:
+        rlo,rhi = 0., 360.
+    else:
+        cosdec = np.cos(np.deg2rad(max(abs(d0),abs(d1))))
+        rlo,rhi = r0 - margin/cosdec, r1 + margin/cosdec
+    T = read_frame_index(fn, rlo, rhi, d0 - margin, d1 + margin)
+    T.cut(in_radec_box(T.ra, T.dec, r0,r1,d0,d1, margin))
+    return T
+
+def read_frame_index_near(fn, ra, dec, radius):
+    '''
+    Returns the frames from a frame index with centers within *radius*
+    degrees of RA,Dec.
+    '''
+    d0 = dec - radius
+    d1 = dec + radius
+    if d0 <= -90. or d1 >= 90.:
+        dr = 180.
+    else:
+        # Maximum RA extent of the small circle
+        r = np.deg2rad(radius)
+        d = np.deg2rad(dec)
+        dr = np.rad2deg(np.arctan(np.sin(r) /
+                                  np.sqrt(np.abs(np.cos(d - r) * np.cos(d + r)))))
+    T = read_frame_index(fn, ra - dr, ra + dr, d0, d1)
+    T.cut(degrees_between(ra, dec, T.ra, T.dec) < radius)
+    print 'Cut to', len(T), 'frames within', radius, 'deg of', ra, dec
+    return T
+
+def get_frame_search_radius(W, H, pixscale, wisepixscale=2.75):
+    '''
+    Returns the radius (in deg) around a coadd tile center within
+    which a WISE L1b frame center must lie for the frame to overlap
+    the tile.
+    '''
+    return (1.1 # safety margin
+            * (np.sqrt(2.) / 2.) # diagonal
+            * (max(W,H) * pixscale/3600.
+               + 1016 * wisepixscale/3600) # WISE FOV + coadd FOV side length
+            ) # in deg
+
 def check_one_md5(wise):
     intfn = get_l1b_file(wisedir, wise.scan_id, wise.frame_num, wise.band)
     uncfn = intfn.replace('-int-', '-unc-')
@@ -343,6 +768,24 @@ def check_md5s(WISE):
             ibad.append(i)
     return np.array(ibad)
 
+def coadd_input_hash(T, params):
+    '''
+    Returns an md5 hex digest of the inputs of a coadd: the scan_id and
+    frame_num of the frames selected (the 'use' column) in table *T*,
+    and the parameters (options, data model version) in dict *params*.
+    This needs only the frame list, so can be checked before any L1b
+    files are located or fetched.  The frame order does not matter.
+    '''
+    import hashlib
+    h = hashlib.md5()
+    for k in sorted(params.keys()):
+        h.update('%s=%r\n' % (k, params[k]))
+    ids = sorted(zip([s.strip() for s in T.scan_id[T.use > 0]],
+                     T.frame_num[T.use > 0]))
+    for s,f in ids:
+        h.update('%s %i\n' % (s, f))
+    return h.hexdigest()
+
 def get_dir_for_coadd(outdir, coadd_id):
     # base/RRR/RRRRsDDD/unwise-*
     return os.path.join(outdir, coadd_id[:3], coadd_id)
@@ -362,13 +805,599 @@ def get_epoch_breaks(mjds):
     print 'Found', len(ebreaks), 'epoch breaks'
     return ebreaks
 
+def find_l1b_frame(scan_id, frame_num, band, download=True):
+    '''
+    Searches the *wisedirs* for the given L1b int frame with its unc
+    and msk siblings, trying to download it from IRSA as a last resort
+    (if *download*).
+
+    Returns (intfn, wcs, intfnx): the int filename and its Sip WCS (or
+    None,None if not found), and the filename relative to the data
+    directory.
+    '''
+    dirs = wisedirs
+    if download:
+        dirs = dirs + [None]
+    for wdir in dirs:
+        download = False
+        if wdir is None:
+            download = True
+            wdir = 'merge_p1bm_frm'
+
+        intfn = get_l1b_file(wdir, scan_id, frame_num, band)
+        print 'intfn', intfn
+        intfnx = intfn.replace(wdir+'/', '')
+
+        if download:
+            # Try to download the file from IRSA.
+            cmd = (('(wget -r -N -nH -np -nv --cut-dirs=4 -A "*w%i*" ' +
+                    '"http://irsa.ipac.caltech.edu/ibe/data/wise/merge/merge_p1bm_frm/%s/")') %
+                    (band, os.path.dirname(intfnx)))
+            print
+            print 'Trying to download file:'
+            print cmd
+            print
+            os.system(cmd)
+            print
+
+        if os.path.exists(intfn):
+            try:
+                wcs = Sip(intfn)
+            except RuntimeError:
+                import traceback
+                traceback.print_exc()
+                continue
+        else:
+            print 'does not exist:', intfn
+            continue
+        if (os.path.exists(intfn.replace('-int-', '-unc-') + '.gz') and
+            os.path.exists(intfn.replace('-int-', '-msk-') + '.gz')):
+            return intfn, wcs, intfnx
+        else:
+            print 'missing unc or msk file'
+            continue
+    return None, None, intfnx
+
+# SIP polynomial terms (p,q) kept in the WCS store
+sip_store_maxorder = 5
+sip_store_terms = [(p,q) for p in range(sip_store_maxorder+1)
+                   for q in range(sip_store_maxorder+1)
+                   if p + q <= sip_store_maxorder]
+
+def wcs_store_row(wise, intfn, wcs):
+    '''
+    Returns a one-row table of WCS store columns for frame *wise*
+    (a row of the WISE table), found at *intfn* with Sip *wcs* (or
+    not found, if *wcs* is None).
+    '''
+    R = fits_table()
+    R.row = np.array([wise.row]).astype(np.int32)
+    R.scan_id = np.array([wise.scan_id])
+    R.frame_num = np.array([wise.frame_num]).astype(np.int16)
+    R.band = np.array([wise.band]).astype(np.uint8)
+    R.intfn = np.array([intfn or ''])
+    R.found = np.array([wcs is not None]).astype(np.uint8)
+    nt = len(sip_store_terms)
+    if wcs is None:
+        R.imagew = R.imageh = np.zeros(1, np.int16)
+        R.crval = np.zeros((1,2))
+        R.crpix = np.zeros((1,2))
+        R.cd = np.zeros((1,4))
+        R.sin = np.zeros(1, np.uint8)
+        R.sip_order = np.zeros((1,4), np.int16)
+        for k in ['a','b','ap','bp']:
+            R.set('sip_' + k, np.zeros((1,nt)))
+        return R
+    tan = wcs.wcstan
+    R.imagew = np.array([wcs.get_width()]).astype(np.int16)
+    R.imageh = np.array([wcs.get_height()]).astype(np.int16)
+    R.crval = np.array([tan.crval[:2]])
+    R.crpix = np.array([tan.crpix[:2]])
+    R.cd = np.array([tan.cd[:4]])
+    R.sin = np.array([tan.sin]).astype(np.uint8)
+    orders = [wcs.a_order, wcs.b_order, wcs.ap_order, wcs.bp_order]
+    assert(max(orders) <= sip_store_maxorder)
+    R.sip_order = np.array([orders]).astype(np.int16)
+    for k,order,get in [('a',  wcs.a_order,  wcs.get_a_term),
+                        ('b',  wcs.b_order,  wcs.get_b_term),
+                        ('ap', wcs.ap_order, wcs.get_ap_term),
+                        ('bp', wcs.bp_order, wcs.get_bp_term)]:
+        R.set('sip_' + k, np.array([[get(p,q) if p+q <= order else 0.
+                                     for p,q in sip_store_terms]]))
+    return R
+
+def sip_from_wcs_store(S, i):
+    '''
+    Rebuilds the Sip WCS of row *i* of WCS store table *S* without
+    touching the frame file.
+    '''
+    tan = Tan(*([float(x) for x in S.crval[i]] + [float(x) for x in S.crpix[i]] +
+                [float(x) for x in S.cd[i]] +
+                [float(S.imagew[i]), float(S.imageh[i])]))
+    tan.sin = bool(S.sin[i])
+    wcs = Sip(tan)
+    wcs.a_order, wcs.b_order, wcs.ap_order, wcs.bp_order = [
+        int(x) for x in S.sip_order[i]]
+    for k,order,set_term in [('a',  wcs.a_order,  wcs.set_a_term),
+                             ('b',  wcs.b_order,  wcs.set_b_term),
+                             ('ap', wcs.ap_order, wcs.set_ap_term),
+                             ('bp', wcs.bp_order, wcs.set_bp_term)]:
+        terms = S.get('sip_' + k)[i]
+        for (p,q),t in zip(sip_store_terms, terms):
+            if p + q <= order:
+                set_term(p, q, float(t))
+    return wcs
+
+def lock_file(fn):
+    '''
+    Takes an exclusive lock for updating the shared file *fn*, held on
+    <fn>.lock, so that concurrent jobs take turns; returns the lock
+    file, to be passed to unlock_file.
+    '''
+    import fcntl
+    f = open(fn + '.lock', 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+def unlock_file(f):
+    import fcntl
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+def append_table(fn, T):
+    '''
+    Appends the rows of table *T* to the FITS table file *fn*, which is
+    created if it does not exist.  Safe for concurrent jobs: under
+    lock_file, the rows are appended to a copy, which is renamed onto
+    *fn*, so readers never see a partial file.
+    '''
+    import shutil
+    lock = lock_file(fn)
+    try:
+        tmpfn = temp_file_beside(fn)
+        if not os.path.exists(fn):
+            T.writeto(tmpfn)
+        else:
+            shutil.copyfile(fn, tmpfn)
+            F = fitsio.FITS(tmpfn, 'rw')
+            data = np.zeros(len(T), dtype=F[1].get_rec_dtype()[0])
+            for c in data.dtype.names:
+                data[c] = T.get(c.lower())
+            F[1].append(data)
+            F.close()
+        os.rename(tmpfn, fn)
+    finally:
+        unlock_file(lock)
+
+def update_wcs_store(fn, WISE, recheck=False):
+    '''
+    Adds to the per-frame WCS store *fn* (a FITS table, created if
+    needed) the SIP WCS parameters, image size and file-existence flag
+    of the frames in table *WISE* that it does not yet contain.
+    Frames previously not found (or all frames, if *recheck*) are
+    looked up again; updated rows are appended, and lookups use the
+    last row for each frame.
+    '''
+    if os.path.exists(fn):
+        S = fits_table(fn, columns=['row', 'found'])
+        J = lookup_wcs_store(S, WISE)
+        todo = (J < 0)
+        if recheck:
+            todo[:] = True
+        else:
+            todo[J >= 0] = (S.found[J[J >= 0]] == 0)
+        I = np.flatnonzero(todo)
+    else:
+        I = np.arange(len(WISE))
+    print 'Updating WCS store', fn, 'with', len(I), 'of', len(WISE), 'frames'
+    rows = []
+    for k,i in enumerate(I):
+        wise = WISE[i]
+        if k % 1000 == 0:
+            print 'WCS store: frame', k+1, 'of', len(I)
+        intfn,wcs,nil = find_l1b_frame(wise.scan_id, wise.frame_num, wise.band,
+                                       download=False)
+        rows.append(wcs_store_row(wise, intfn, wcs))
+        # Write out in chunks, so we don't lose work.
+        if len(rows) == 1000 or k == len(I)-1:
+            R = merge_tables(rows)
+            rows = []
+            append_table(fn, R)
+    print 'Wrote', fn
+
+def read_wcs_store(fn, WISE):
+    '''
+    Reads from WCS store *fn* just the rows for the frames in table
+    *WISE*.  Returns the store table; use lookup_wcs_store() to map
+    WISE rows to store rows.
+    '''
+    S = fits_table(fn, columns=['row'])
+    J = lookup_wcs_store(S, WISE)
+    J = np.unique(J[J >= 0])
+    print 'Reading', len(J), 'of', len(S), 'rows from WCS store', fn
+    if len(J) == 0:
+        return None
+    S = fits_table(fn, rows=J)
+    S.cut(S.found > 0)
+    S.intfn = np.array([f.strip() for f in S.intfn])
+    return S
+
+def lookup_wcs_store(S, WISE):
+    '''
+    Returns, for each row of table *WISE*, the index of the last row
+    in WCS store table *S* for the same frame (matching the "row"
+    column, ie, the row in WISE-index-L1b.fits), or -1.
+    '''
+    I = np.argsort(S.row, kind='mergesort')
+    srow = S.row[I]
+    J = np.searchsorted(srow, WISE.row, side='right') - 1
+    ok = (J >= 0)
+    ok[ok] = (srow[J[ok]] == WISE.row[ok])
+    return np.where(ok, I[np.maximum(J, 0)], -1)
+
+def frame_tile_extents(cowcs, copoly, wcs, W, H):
+    '''
+    Computes the overlap between L1b frame *wcs* and the coadd tile
+    *cowcs* (of size W x H, with IWC polygon *copoly*).
+
+    Returns (coextent, imextent), the *inclusive* bounding boxes
+    [x0,x1,y0,y1] of the overlap in the coadd and in the image, or
+    None if they do not overlap.
+    '''
+    h,w = wcs.get_height(), wcs.get_width()
+    r,d = walk_wcs_boundary(wcs, step=2.*w, margin=10)
+    ok,u,v = cowcs.radec2iwc(r, d)
+    poly = np.array(list(reversed(zip(u,v))))
+    #print 'Image IWC polygon:', poly
+    intersects = polygons_intersect(copoly, poly)
+
+    if not intersects:
+        print 'Image does not intersect target'
+        return None
+
+    cpoly = np.array(clip_polygon(copoly, poly))
+    if len(cpoly) == 0:
+        print 'No overlap between coadd and image polygons'
+        print 'copoly:', copoly
+        print 'poly:', poly
+        print 'cpoly:', cpoly
+        return None
+
+    # Convert the intersected polygon in IWC space into image
+    # pixel bounds.
+    # Coadd extent:
+    xy = np.array([cowcs.iwc2pixelxy(u,v) for u,v in cpoly])
+    xy -= 1
+    x0,y0 = np.floor(xy.min(axis=0)).astype(int)
+    x1,y1 = np.ceil (xy.max(axis=0)).astype(int)
+    coextent = [np.clip(x0, 0, W-1),
+                np.clip(x1, 0, W-1),
+                np.clip(y0, 0, H-1),
+                np.clip(y1, 0, H-1)]
+
+    # Input image extent:
+    #   There was a bug in the an-ran coadds; all imextents are
+    #   [0,1015,0,1015] as a result.
+    #rd = np.array([cowcs.iwc2radec(u,v) for u,v in poly])
+    # Should be: ('cpoly' rather than 'poly' here)
+    rd = np.array([cowcs.iwc2radec(u,v) for u,v in cpoly])
+    ok,x,y = np.array(wcs.radec2pixelxy(rd[:,0], rd[:,1]))
+    x -= 1
+    y -= 1
+    x0,y0 = [np.floor(v.min(axis=0)).astype(int) for v in [x,y]]
+    x1,y1 = [np.ceil (v.max(axis=0)).astype(int) for v in [x,y]]
+    imextent = [np.clip(x0, 0, w-1),
+                np.clip(x1, 0, w-1),
+                np.clip(y0, 0, h-1),
+                np.clip(y1, 0, h-1)]
+    return coextent, imextent
+
+def _proj_iwc2radec(ra0, dec0, u, v, sin):
+    '''
+    Vectorized TAN (or, where *sin*, SIN) inverse projection of
+    intermediate world coordinates u,v (deg).
+    '''
+    x = np.deg2rad(u)
+    y = np.deg2rad(v)
+    d0 = np.deg2rad(dec0)
+    c = np.where(sin, np.sqrt(np.maximum(0., 1. - x**2 - y**2)), 1.)
+    den = c * np.cos(d0) - y * np.sin(d0)
+    ra = (ra0 + np.rad2deg(np.arctan2(x, den))) % 360.
+    dec = np.rad2deg(np.arctan2(c * np.sin(d0) + y * np.cos(d0), np.hypot(x, den)))
+    return ra, dec
+
+def _proj_radec2iwc(ra0, dec0, ra, dec, sin):
+    '''
+    Vectorized TAN (or, where *sin*, SIN) projection of RA,Dec to
+    intermediate world coordinates.  Returns ok,u,v.
+    '''
+    dra = np.deg2rad(ra - ra0)
+    d = np.deg2rad(dec)
+    d0 = np.deg2rad(dec0)
+    cosc = np.sin(d0) * np.sin(d) + np.cos(d0) * np.cos(d) * np.cos(dra)
+    scale = np.where(sin, 1., 1. / cosc)
+    u = np.rad2deg(np.cos(d) * np.sin(dra) * scale)
+    v = np.rad2deg((np.cos(d0) * np.sin(d) - np.sin(d0) * np.cos(d) * np.cos(dra))
+                   * scale)
+    return (cosc > 0), u, v
+
+def _sip_poly(coeffs, u, v):
+    '''
+    Evaluates SIP polynomials with coefficients *coeffs* (N x
+    len(sip_store_terms)) at u,v (N x K).
+    '''
+    f = np.zeros_like(u)
+    for t,(p,q) in enumerate(sip_store_terms):
+        c = coeffs[:,t]
+        if not np.any(c):
+            continue
+        f += c[:,np.newaxis] * u**p * v**q
+    return f
+
+def sip_pixelxy2radec_batch(S, x, y):
+    '''
+    Vectorized Sip.pixelxy2radec for N frames with WCS store rows *S*,
+    at (1-indexed) pixel positions x,y (N x K).
+    '''
+    u = x - S.crpix[:,0:1]
+    v = y - S.crpix[:,1:2]
+    U = u + _sip_poly(S.sip_a, u, v)
+    V = v + _sip_poly(S.sip_b, u, v)
+    cd = S.cd
+    iu = cd[:,0:1] * U + cd[:,1:2] * V
+    iv = cd[:,2:3] * U + cd[:,3:4] * V
+    return _proj_iwc2radec(S.crval[:,0:1], S.crval[:,1:2], iu, iv,
+                           S.sin[:,np.newaxis] > 0)
+
+def sip_radec2pixelxy_batch(S, ra, dec):
+    '''
+    Vectorized Sip.radec2pixelxy (using the AP,BP inverse polynomials)
+    for N frames with WCS store rows *S*, at RA,Dec (N x K).  Returns
+    ok,x,y with 1-indexed pixel positions.
+    '''
+    ok,iu,iv = _proj_radec2iwc(S.crval[:,0:1], S.crval[:,1:2], ra, dec,
+                               S.sin[:,np.newaxis] > 0)
+    cd = S.cd
+    det = cd[:,0:1] * cd[:,3:4] - cd[:,1:2] * cd[:,2:3]
+    U = ( cd[:,3:4] * iu - cd[:,1:2] * iv) / det
+    V = (-cd[:,2:3] * iu + cd[:,0:1] * iv) / det
+    x = U + _sip_poly(S.sip_ap, U, V) + S.crpix[:,0:1]
+    y = V + _sip_poly(S.sip_bp, U, V) + S.crpix[:,1:2]
+    return ok, x, y
+
+def frame_tile_geometry(S, ra, dec, W, H, pixscale, margin=10):
+    '''
+    Batched version of frame_tile_extents() for all frames with WCS
+    store rows *S* at once, against the coadd tile centered at ra,dec
+    (see get_coadd_tile_wcs).
+
+    The clipped polygon is built from its candidate vertices: frame
+    corners inside the tile, tile corners inside the frame, and
+    frame-edge / tile-edge crossings.
+
+    Returns a Duck with arrays:
+      intersects: (N) bool
+      cpoly: (N x 24 x 2) clipped polygon vertices in coadd IWC,
+             counter-clockwise, padded with NaN
+      coextent, imextent: (N x 4) as in frame_tile_extents()
+    '''
+    N = len(S)
+    s = pixscale / 3600.
+    cx,cy = (W+1)/2., (H+1)/2.
+    # Coadd IWC polygon: an axis-aligned box (as walk_wcs_boundary(cowcs, margin))
+    ulo,uhi = -s * (W + margin - cx), -s * (1 - margin - cx)
+    vlo,vhi =  s * (1 - margin - cy),  s * (H + margin - cy)
+
+    # Frame corners (as walk_wcs_boundary(wcs, step=2*w, margin))
+    w = S.imagew.astype(float)[:,np.newaxis]
+    h = S.imageh.astype(float)[:,np.newaxis]
+    lo = np.zeros((N,1)) + 1 - margin
+    X = np.hstack([lo, w + margin, w + margin, lo])
+    Y = np.hstack([lo, lo, h + margin, h + margin])
+    rr,dd = sip_pixelxy2radec_batch(S, X, Y)
+    pok,pu,pv = tan_radec2iwc(ra, dec, rr, dd)
+    pok = np.all(pok, axis=1)
+
+    cu,cv,valid = [],[],[]
+    # Frame corners inside the tile
+    cu.append(pu)
+    cv.append(pv)
+    valid.append((pu >= ulo) * (pu <= uhi) * (pv >= vlo) * (pv <= vhi))
+    # Tile corners inside the (convex) frame polygon
+    qu,qv = np.roll(pu, -1, axis=1), np.roll(pv, -1, axis=1)
+    for tu,tv in [(ulo,vlo), (uhi,vlo), (uhi,vhi), (ulo,vhi)]:
+        cross = (qu - pu) * (tv - pv) - (qv - pv) * (tu - pu)
+        inside = np.logical_or(np.all(cross >= 0, axis=1),
+                               np.all(cross <= 0, axis=1))
+        cu.append(np.zeros((N,1)) + tu)
+        cv.append(np.zeros((N,1)) + tv)
+        valid.append(inside[:,np.newaxis])
+    # Frame edges crossing tile edges
+    du = qu - pu
+    dv = qv - pv
+    olderr = np.seterr(divide='ignore', invalid='ignore')
+    for u0 in [ulo, uhi]:
+        t = (u0 - pu) / du
+        v = pv + t * dv
+        cu.append(np.zeros_like(v) + u0)
+        cv.append(v)
+        valid.append((du != 0) * (t >= 0) * (t <= 1) * (v >= vlo) * (v <= vhi))
+    for v0 in [vlo, vhi]:
+        t = (v0 - pv) / dv
+        u = pu + t * du
+        cu.append(u)
+        cv.append(np.zeros_like(u) + v0)
+        valid.append((dv != 0) * (t >= 0) * (t <= 1) * (u >= ulo) * (u <= uhi))
+    np.seterr(**olderr)
+    cu = np.hstack(cu)
+    cv = np.hstack(cv)
+    valid = np.hstack(valid) * pok[:,np.newaxis]
+
+    G = Duck()
+    G.intersects = np.any(valid, axis=1)
+    cu[np.logical_not(valid)] = np.nan
+    cv[np.logical_not(valid)] = np.nan
+
+    # Order vertices counter-clockwise around their centroid.
+    nv = np.maximum(1, np.sum(valid, axis=1))[:,np.newaxis]
+    mu = np.sum(np.where(valid, cu, 0.), axis=1)[:,np.newaxis] / nv
+    mv = np.sum(np.where(valid, cv, 0.), axis=1)[:,np.newaxis] / nv
+    angle = np.where(valid, np.arctan2(cv - mv, cu - mu), np.inf)
+    I = np.argsort(angle, axis=1)
+    J = np.arange(N)[:,np.newaxis]
+    G.cpoly = np.dstack([cu[J,I], cv[J,I]])
+
+    def extent(x, y, W, H):
+        x = np.where(valid, x, np.nan)
+        y = np.where(valid, y, np.nan)
+        ok = G.intersects
+        e = np.zeros((N,4), int)
+        e[ok,0] = np.floor(np.nanmin(x[ok], axis=1))
+        e[ok,1] = np.ceil (np.nanmax(x[ok], axis=1))
+        e[ok,2] = np.floor(np.nanmin(y[ok], axis=1))
+        e[ok,3] = np.ceil (np.nanmax(y[ok], axis=1))
+        e[:,0:2] = np.clip(e[:,0:2], 0, W-1)
+        e[:,2:4] = np.clip(e[:,2:4], 0, H-1)
+        return e
+
+    olderr = np.seterr(invalid='ignore')
+    # Coadd extent (zero-indexed pixels)
+    G.coextent = extent(cx - cu / s - 1., cy + cv / s - 1., W, H)
+    # Image extent
+    r,d = tan_iwc2radec(ra, dec, cu, cv)
+    ok,x,y = sip_radec2pixelxy_batch(S, r, d)
+    G.imextent = extent(x - 1., y - 1., w, h)
+    np.seterr(**olderr)
+    return G
+
+def get_peak_mem():
+    '''
+    Returns the peak resident memory (VmHWM) of this process, in GB, or
+    0 if unknown.
+    '''
+    mu = get_memusage()
+    try:
+        return float(mu['VmHWM'][0]) / (1024.**2)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 0.
+
+def _mp_threads(mp):
+    if mp.pool is None:
+        return 1
+    return mp.pool._processes
+
+def log_memory_use(fn, ti, band, pixinrange, npix, nthreads, lowmem, memstats):
+    '''
+    Appends a row of measured memory use for a tile to the memory log
+    *fn*, for fit_memory_model.
+    '''
+    M = fits_table()
+    M.coadd_id = np.array([ti.coadd_id])
+    M.band = np.array([band]).astype(np.uint8)
+    M.pixinrange = np.array([pixinrange]).astype(float)
+    M.npix = np.array([npix]).astype(float)
+    M.nthreads = np.array([nthreads]).astype(np.int16)
+    M.lowmem = np.array([lowmem]).astype(np.uint8)
+    M.mem_parent = np.array([get_peak_mem()]).astype(np.float32)
+    M.mem_worker = np.array([memstats.worker]).astype(np.float32)
+    M.mem_shm = np.array([getattr(memstats, 'shm', 0.)]).astype(np.float32)
+    append_table(fn, M)
+    print 'Memory use: parent %.2f GB, workers %.2f GB each, records %.2f GB' % (
+        M.mem_parent[0], M.mem_worker[0], M.mem_shm[0])
+
+def fit_memory_model(fn=None):
+    '''
+    Returns the memory model (a Duck) used by plan_coadd_memory:
+
+      parent memory (GB) = base + perpix * pixinrange + pertile * npix
+      record memory (GB) = shmperpix * pixinrange
+      worker memory (GB) = worker
+
+    where pixinrange is the total coadd-space size of the input frames
+    (both pixinrange terms dropped in low-memory mode) and npix the tile
+    size.  Record memory is that of the workers' results held in shared
+    memory (see pack_record), which is RAM but not in any process's
+    RSS.  The coefficients are fit to the measurements in memory log
+    *fn* (see log_memory_use) where available, else the old rule of
+    thumb of 1 GB plus 5 bytes per pixel is used, plus 4.5 bytes per
+    pixel (a float32 image and a 2-bit mask) of records.
+    '''
+    M = Duck()
+    M.base = 1.
+    M.perpix = 5e-9
+    M.pertile = 0.
+    M.shmperpix = 4.5e-9
+    M.worker = 0.5
+    if fn is None or not os.path.exists(fn):
+        return M
+    T = fits_table(fn)
+    T.cut(T.mem_parent > 0)
+    if len(T) < 3:
+        return M
+    A = np.vstack([np.ones(len(T)), T.pixinrange * (T.lowmem == 0), T.npix]).T
+    # Fit relative errors, so the big tiles don't dominate.
+    w = 1. / T.mem_parent
+    p,nil,nil,nil = np.linalg.lstsq(A * w[:,np.newaxis], T.mem_parent * w)
+    M.base,M.perpix,M.pertile = [max(x, 0.) for x in p]
+    if np.any(T.mem_worker > 0):
+        M.worker = np.percentile(T.mem_worker[T.mem_worker > 0], 95)
+    if 'mem_shm' in T.get_columns():
+        I = np.flatnonzero((T.mem_shm > 0) * (T.lowmem == 0))
+        if len(I):
+            M.shmperpix = np.percentile(T.mem_shm[I] / T.pixinrange[I], 95)
+    print 'Memory model from %i runs: %.2f GB + %.2g GB/pixel + %.2g GB/tile pixel; %.2g GB/pixel of records; %.2f GB/worker' % (
+        len(T), M.base, M.perpix, M.pertile, M.shmperpix, M.worker)
+    return M
+
+def plan_coadd_memory(M, pixinrange, npix, maxmem, nthreads, lowmem=False,
+                      margin=1.1):
+    '''
+    Picks the number of worker processes, and whether to use low-memory
+    mode, so that the memory use predicted by model *M* (times *margin*)
+    fits within *maxmem* GB.  Prefers the normal mode with as many
+    workers as possible (up to *nthreads*).
+
+    Returns (nthreads, lowmem, predicted GB), or None if nothing fits.
+    '''
+    for lm in [lowmem, True]:
+        parent = M.base + M.pertile * npix
+        if not lm:
+            parent += (M.perpix + M.shmperpix) * pixinrange
+        for n in range(nthreads, 0, -1):
+            mem = margin * (parent + n * M.worker)
+            if mem <= maxmem:
+                return n, lm, mem
+    return None
+
 def one_coadd(ti, band, W, H, pixscale, WISE,
               ps, wishlist, outdir, mp1, mp2, do_cube, plots2,
               frame0, nframes, force, medfilt, maxmem, do_dsky, checkmd5,
               bgmatch, center, minmax, rchi_fraction, do_cube1, epoch,
-              before, after, force_outdir=False, just_image=False, version=None):
+              before, after, force_outdir=False, just_image=False, version=None,
+              wcsstore=None, framecache=None, prefetch=None, framestats=None,
+              round1dir=None, lowmem=False, memmodel=None, memlog=None,
+              acc32=False, sumstats=False, incremental=False,
+              multiepoch=None, mef=False, rebuild=False):
     '''
     Create coadd for one tile & band.
+
+    *sumstats*: also write the raw sums (see write_coadd_sums) to
+    -sums.fits, so that the coadd can be updated incrementally.
+
+    *incremental*: add only the frames that are not in an existing
+    coadd's -frames.fits to its -sums.fits, and rewrite the outputs.
+    Not with *minmax*, *do_cube* or *do_cube1*, whose products the sums
+    cannot update.
+
+    *multiepoch*: also write a coadd of each epoch, to -e<N>-*.fits,
+    from the same run (see coadd_wise).  True for the epochs of
+    get_epoch_breaks, or a list of MJD epoch breaks.
+
+    *mef*: write the coadd images as one tile-compressed multi-extension
+    file, <prefix>.fits (see write_coadd_products).
+
+    *rebuild*: redo a tile-band with complete outputs if its input hash
+    (UNW_HASH; see coadd_input_hash) has changed, and skip it otherwise.
     '''
     print 'Coadd tile', ti.coadd_id
     print 'RA,Dec', ti.ra, ti.dec
@@ -376,6 +1405,11 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
 
     wisepixscale = 2.75
 
+    if incremental and (minmax or do_cube or do_cube1):
+        # (they would cover only the new frames)
+        print 'Incremental mode does not support --minmax, --cube or --cube1'
+        return -1
+
     if version is None:
         from astrometry.util.run_command import run_command
         rtn,version,err = run_command('git describe')
@@ -391,11 +1425,13 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
             os.makedirs(outdir)
     tag = 'unwise-%s-w%i' % (ti.coadd_id, band)
     prefix = os.path.join(outdir, tag)
-    ofn = prefix + '-img-m.fits'
-    if os.path.exists(ofn):
-        print 'Output file exists:', ofn
-        if not force:
+    status,mhdr = manifest_status(prefix)
+    if status == 'done':
+        print 'Outputs complete:', prefix + '-manifest.fits'
+        if not (force or incremental or rebuild):
             return 0
+    elif status != 'missing':
+        print 'Outputs', status + ':', prefix + '-manifest.fits'
 
     cowcs = get_coadd_tile_wcs(ti.ra, ti.dec, W, H, pixscale)
     # Intermediate world coordinates (IWC) polygon
@@ -404,11 +1440,7 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
     copoly = np.array(list(reversed(zip(u,v))))
     print 'Coadd IWC polygon:', copoly
 
-    margin = (1.1 # safety margin
-              * (np.sqrt(2.) / 2.) # diagonal
-              * (max(W,H) * pixscale/3600.
-                 + 1016 * wisepixscale/3600) # WISE FOV + coadd FOV side length
-              ) # in deg
+    margin = get_frame_search_radius(W, H, pixscale, wisepixscale)
     t0 = Time()
 
     # cut
@@ -436,6 +1468,17 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
             WISE = WISE[WISE.mjd <  ebreaks[epoch]]
         print 'Cut to', len(WISE), 'within epoch'
 
+    if multiepoch is not None:
+        if incremental:
+            print 'Incremental mode does not support multiple epochs'
+            return -1
+        ebreaks = multiepoch
+        if ebreaks is True:
+            ebreaks = get_epoch_breaks(WISE.mjd)
+        WISE.epoch = np.searchsorted(ebreaks, WISE.mjd,
+                                     side='right').astype(np.int16)
+        print 'Frames per epoch:', np.bincount(WISE.epoch)
+
     if bgmatch or center:
         # reorder by dist from center
         WISE.cut(np.argsort(degrees_between(ti.ra, ti.dec, WISE.ra, WISE.dec)))
@@ -524,13 +1567,41 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
                 #os.system(cmd)
         return 0
 
-    # Estimate memory usage and bail out if too high.
-    if maxmem:
-        mem = 1. + (len(WISE) * 1e6/2. * 5. / 1e9)
-        print 'Estimated mem usage:', mem
-        if mem > maxmem:
-            print 'Estimated memory usage:', mem, 'GB > max', maxmem
-            return -1
+    # Hash of the selected frames (before the incremental cut, so that
+    # an incremental update hashes the same as a full coadd) and options.
+    inhash = coadd_input_hash(WISE, dict(
+        band=band, W=W, H=H, pixscale=pixscale, medfilt=medfilt,
+        rchi_fraction=rchi_fraction, bgmatch=bgmatch, do_dsky=do_dsky,
+        acc32=acc32, dver=unwise_data_model_version,
+        # (the products written; incremental mode also writes the sums)
+        minmax=bool(minmax), multiepoch=multiepoch, mef=bool(mef),
+        do_cube=bool(do_cube), do_cube1=bool(do_cube1),
+        sumstats=bool(sumstats or incremental), just_image=bool(just_image)))
+    print 'Input hash:', inhash
+    if rebuild and status == 'done' and not force:
+        if mhdr.get('UNW_HASH', '') == inhash:
+            print 'Inputs unchanged; not rebuilding'
+            return 0
+        print 'Inputs changed (was', mhdr.get('UNW_HASH', 'not recorded') + '); rebuilding'
+
+    sumfn = prefix + '-sums.fits'
+    prior = oldframes = None
+    if incremental:
+        ffn = prefix + '-frames.fits'
+        if os.path.exists(sumfn) and os.path.exists(ffn):
+            prior = read_coadd_sums(sumfn)
+            oldframes = fits_table(ffn)
+            old = set(zip([s.strip() for s in oldframes.scan_id],
+                          oldframes.frame_num))
+            WISE.cut(np.array([(s.strip(), f) not in old for s,f in
+                               zip(WISE.scan_id, WISE.frame_num)], bool))
+            print 'Incremental: cut to', len(WISE), 'frames not already in', ffn
+            if sum(WISE.use) == 0:
+                print 'No new frames to add'
+                return 0
+        else:
+            print 'Incremental: no stored sums', sumfn, '-- doing a full coadd'
+        sumstats = True
 
     # *inclusive* coordinates of the bounding-box in the coadd of this
     # image (x0,x1,y0,y1)
@@ -544,9 +1615,25 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
     WISE.intfn  = np.zeros(len(WISE), object)
     WISE.wcs    = np.zeros(len(WISE), object)
 
+    # Full-frame sky and sig1, so that round 1 can read just sub-images
+    if framestats is not None:
+        WISE.frame_sky, WISE.frame_sig1 = read_frame_stats(framestats, WISE)
+
     # count total number of coadd-space pixels -- this determines memory use
     pixinrange = 0.
 
+    # Look up frame WCS headers and file existence in the WCS store, and
+    # compute the frame/tile overlap geometry for all those frames at once.
+    if wcsstore is not None:
+        wcsrows = lookup_wcs_store(wcsstore, WISE)
+        G = np.flatnonzero(WISE.use * (wcsrows >= 0))
+        G = G[wcsstore.found[wcsrows[G]] > 0]
+        geom = frame_tile_geometry(wcsstore[wcsrows[G]], ti.ra, ti.dec, W, H, pixscale)
+        geomidx = np.zeros(len(WISE), int) - 1
+        geomidx[G] = np.arange(len(G))
+        print 'Computed geometry for', len(G), 'frames from the WCS store;', np.sum(geom.intersects), 'intersect the tile'
+
+    failedfiles = []
     nu = 0
     NU = sum(WISE.use)
     for wi,wise in enumerate(WISE):
@@ -557,115 +1644,31 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
         print nu, 'of', NU
         print 'scan', wise.scan_id, 'frame', wise.frame_num, 'band', band
 
-        failedfiles = []
-        found = False
-        for wdir in wisedirs + [None]:
-            download = False
-            if wdir is None:
-                download = True
-                wdir = 'merge_p1bm_frm'
-
-            intfn = get_l1b_file(wdir, wise.scan_id, wise.frame_num, band)
-            print 'intfn', intfn
-            intfnx = intfn.replace(wdir+'/', '')
-
-            if download:
-                # Try to download the file from IRSA.
-                cmd = (('(wget -r -N -nH -np -nv --cut-dirs=4 -A "*w%i*" ' +
-                        '"http://irsa.ipac.caltech.edu/ibe/data/wise/merge/merge_p1bm_frm/%s/")') %
-                        (band, os.path.dirname(intfnx)))
-                print
-                print 'Trying to download file:'
-                print cmd
-                print
-                os.system(cmd)
-                print
-
-            if os.path.exists(intfn):
-                try:
-                    wcs = Sip(intfn)
-                except RuntimeError:
-                    import traceback
-                    traceback.print_exc()
-                    continue
-            else:
-                print 'does not exist:', intfn
+        if wcsstore is not None and geomidx[wi] >= 0:
+            # Geometry precomputed from the WCS store
+            g = geomidx[wi]
+            if not geom.intersects[g]:
+                print 'Image does not intersect target'
+                WISE.use[wi] = False
                 continue
-            if (os.path.exists(intfn.replace('-int-', '-unc-') + '.gz') and
-                os.path.exists(intfn.replace('-int-', '-msk-') + '.gz')):
-                found = True
-                break
-            else:
-                print 'missing unc or msk file'
+            intfn = wcsstore.intfn[wcsrows[wi]].strip()
+            print 'intfn', intfn, '(from WCS store)'
+            wcs = sip_from_wcs_store(wcsstore, wcsrows[wi])
+            h,w = wcs.get_height(), wcs.get_width()
+            WISE.coextent[wi,:] = geom.coextent[g]
+            WISE.imextent[wi,:] = geom.imextent[g]
+        else:
+            intfn,wcs,intfnx = find_l1b_frame(wise.scan_id, wise.frame_num, band)
+            if wcs is None:
+                print 'WARNING: Not found: scan', wise.scan_id, 'frame', wise.frame_num, 'band', band
+                failedfiles.append(intfnx)
                 continue
-        if not found:
-            print 'WARNING: Not found: scan', wise.scan_id, 'frame', wise.frame_num, 'band', band
-            failedfiles.append(intfnx)
-            continue
-
-        h,w = wcs.get_height(), wcs.get_width()
-        r,d = walk_wcs_boundary(wcs, step=2.*w, margin=10)
-        ok,u,v = cowcs.radec2iwc(r, d)
-        poly = np.array(list(reversed(zip(u,v))))
-        #print 'Image IWC polygon:', poly
-        intersects = polygons_intersect(copoly, poly)
-
-        if ps and False:
-            plt.clf()
-            plt.plot(copoly[:,0], copoly[:,1], 'r-')
-            plt.plot(copoly[0,0], copoly[0,1], 'ro')
-            plt.plot(poly[:,0], poly[:,1], 'b-')
-            plt.plot(poly[0,0], poly[0,1], 'bo')
-            cpoly = np.array(clip_polygon(copoly, poly))
-            if len(cpoly) == 0:
-                pass
-            else:
-                print 'cpoly:', cpoly
-                plt.plot(cpoly[:,0], cpoly[:,1], 'm-')
-                plt.plot(cpoly[0,0], cpoly[0,1], 'mo')
-            ps.savefig()
-
-        if not intersects:
-            print 'Image does not intersect target'
-            WISE.use[wi] = False
-            continue
-
-        cpoly = np.array(clip_polygon(copoly, poly))
-        if len(cpoly) == 0:
-            print 'No overlap between coadd and image polygons'
-            print 'copoly:', copoly
-            print 'poly:', poly
-            print 'cpoly:', cpoly
-            WISE.use[wi] = False
-            continue
-
-        # Convert the intersected polygon in IWC space into image
-        # pixel bounds.
-        # Coadd extent:
-        xy = np.array([cowcs.iwc2pixelxy(u,v) for u,v in cpoly])
-        xy -= 1
-        x0,y0 = np.floor(xy.min(axis=0)).astype(int)
-        x1,y1 = np.ceil (xy.max(axis=0)).astype(int)
-        WISE.coextent[wi,:] = [np.clip(x0, 0, W-1),
-                               np.clip(x1, 0, W-1),
-                               np.clip(y0, 0, H-1),
-                               np.clip(y1, 0, H-1)]
-
-        # Input image extent:
-        #   There was a bug in the an-ran coadds; all imextents are
-        #   [0,1015,0,1015] as a result.
-        #rd = np.array([cowcs.iwc2radec(u,v) for u,v in poly])
-        # Should be: ('cpoly' rather than 'poly' here)
-        rd = np.array([cowcs.iwc2radec(u,v) for u,v in cpoly])
-        ok,x,y = np.array(wcs.radec2pixelxy(rd[:,0], rd[:,1]))
-        x -= 1
-        y -= 1
-        x0,y0 = [np.floor(v.min(axis=0)).astype(int) for v in [x,y]]
-        x1,y1 = [np.ceil (v.max(axis=0)).astype(int) for v in [x,y]]
-        WISE.imextent[wi,:] = [np.clip(x0, 0, w-1),
-                               np.clip(x1, 0, w-1),
-                               np.clip(y0, 0, h-1),
-                               np.clip(y1, 0, h-1)]
+            h,w = wcs.get_height(), wcs.get_width()
+            ext = frame_tile_extents(cowcs, copoly, wcs, W, H)
+            if ext is None:
+                WISE.use[wi] = False
+                continue
+            WISE.coextent[wi,:], WISE.imextent[wi,:] = ext
 
         WISE.intfn[wi] = intfn
         WISE.imagew[wi] = w
@@ -687,13 +1690,26 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
             print '  ', f
         print
 
-    # Now we can make a more informed estimate of memory use.
+    # Now we can make an informed estimate of memory use, and pick the
+    # number of workers (and low-memory mode) to fit in the budget.
+    nthreads = max(_mp_threads(mp1), _mp_threads(mp2))
+    tilemp = None
     if maxmem:
-        mem = 1. + (pixinrange * 5. / 1e9)
-        print 'Estimated mem usage:', mem
-        if mem > maxmem:
-            print 'Estimated memory usage:', mem, 'GB > max', maxmem
+        if memmodel is None:
+            memmodel = fit_memory_model()
+        plan = plan_coadd_memory(memmodel, pixinrange, W*H, maxmem, nthreads,
+                                 lowmem=lowmem)
+        if plan is None:
+            print 'Estimated memory usage > max', maxmem, 'GB, even in low-memory mode with 1 worker'
             return -1
+        n,lowmem,mem = plan
+        print 'Estimated mem usage: %.2f GB with %i workers%s' % (
+            mem, n, (' (low-memory mode)' if lowmem else ''))
+        if n < nthreads:
+            print 'Reducing to', n, 'workers to fit in', maxmem, 'GB'
+            tilemp = multiproc(n)
+            mp1 = mp2 = tilemp
+            nthreads = n
 
     # convert from object array to string array; '' rather than '0'
     WISE.intfn = np.array([{0:''}.get(s,s) for s in WISE.intfn])
@@ -706,13 +1722,33 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
     # Now that we've got some information about the input frames, call
     # the real coadding code.  Maybe we should move this first loop into
     # the round 1 coadd...
+    memstats = Duck()
+    sums = None
+    if sumstats:
+        sums = Duck()
+    epochs = epochout = None
+    if multiepoch is not None:
+        epochs = WISE.epoch[WISE.use]
+        epochout = Duck()
+    # Write the outputs to a scratch directory beside them, and move
+    # them into place only once they are all written (commit_outputs).
+    # Scratch directories of killed runs of this tile-band go first.
+    remove_stale_scratch(outdir, tag)
+    tmpdir = tempfile.mkdtemp(dir=outdir, prefix=scratch_prefix(tag))
+    # Record files left in shared memory by killed jobs.
+    sweep_records(stale=True)
+    wprefix = os.path.join(tmpdir, tag)
     try:
         (coim,coiv,copp,con, coimb,coivb,coppb,conb,masks, cube, cosky,
-         comin,comax,cominb,comaxb
-         )= coadd_wise(ti.coadd_id, cowcs, WISE[WISE.use], ps, band, mp1, mp2, do_cube,
+         robust)= coadd_wise(ti.coadd_id, cowcs, WISE[WISE.use], ps, band, mp1, mp2, do_cube,
                        medfilt, plots2=plots2, do_dsky=do_dsky,
                        checkmd5=checkmd5, bgmatch=bgmatch, minmax=minmax,
-                       rchi_fraction=rchi_fraction, do_cube1=do_cube1)
+                       rchi_fraction=rchi_fraction, do_cube1=do_cube1,
+                       framecache=framecache, prefetch=prefetch,
+                       round1dir=round1dir, lowmem=lowmem, memstats=memstats,
+                       acc32=acc32, prior=prior, sums=sums,
+                       epochs=epochs, epochout=epochout,
+                       cubefn=wprefix + '-cube.fits')
     except:
         print 'coadd_wise failed:'
         import traceback
@@ -720,22 +1756,30 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
         print 'time up to failure:'
         t2 = Time()
         print t2 - t1
+        import shutil
+        shutil.rmtree(tmpdir)
+        # (tiles are done one at a time, so all of our records are
+        # this tile's)
+        sweep_records()
         return
+    finally:
+        if tilemp is not None:
+            tilemp.close()
     t2 = Time()
     print 'coadd_wise:'
     print t2 - t1
 
+    if memlog is not None:
+        log_memory_use(memlog, ti, band, pixinrange, W*H, nthreads, lowmem,
+                       memstats)
+
     # For any "masked" pixels that have invvar = 0 (ie, NO pixels
     # contributed), fill in the image from the "unmasked" image.
     # Leave the invvar image untouched.
     coimb[coivb == 0] = coim[coivb == 0]
 
     # Plug the WCS header cards into the output coadd files.
-    f,wcsfn = tempfile.mkstemp()
-    os.close(f)
-    cowcs.write_to(wcsfn)
-    hdr = fitsio.read_header(wcsfn)
-    os.remove(wcsfn)
+    hdr = tan_wcs_header(cowcs)
 
     hdr.add_record(dict(name='MAGZP', value=22.5,
                         comment='Magnitude zeropoint (in Vega mag)'))
@@ -745,7 +1789,7 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
                         comment='unWISE code git revision'))
     hdr.add_record(dict(name='UNW_URL', value='https://github.com/dstndstn/unwise-coadds',
                         comment='git URL'))
-    hdr.add_record(dict(name='UNW_DVER', value=1,
+    hdr.add_record(dict(name='UNW_DVER', value=unwise_data_model_version,
                         comment='unWISE data model version'))
     hdr.add_record(dict(name='UNW_DATE', value=datetime.datetime.now().isoformat(),
                         comment='unWISE run time'))
@@ -753,57 +1797,45 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
     hdr.add_record(dict(name='UNW_FRN', value=nframes, comment='unWISE N frames'))
     hdr.add_record(dict(name='UNW_MEDF', value=medfilt, comment='unWISE median filter sz'))
     hdr.add_record(dict(name='UNW_BGMA', value=bgmatch, comment='unWISE background matching?'))
+    hdr.add_record(dict(name='UNW_HASH', value=inhash, comment='unWISE input hash'))
 
-    # "Unmasked" versions
-    ofn = prefix + '-img-u.fits'
-    fitsio.write(ofn, coim.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
+    if do_cube:
+        cube.close(header=hdr)
+        print 'Wrote', cube.fn
+
+    # -min, -max, -rejmean, -med; unmasked and masked.  -min and -max
+    # are not sky-subtracted (as they always were); -rejmean and -med
+    # are, like the coadd images.
+    if robust is not None:
+        for k,v in robust.items():
+            if not (k.startswith('min-') or k.startswith('max-')):
+                v -= cosky
+    write_coadd_products(wprefix, hdr, (coim, coiv, copp, con,
+                                       coimb, coivb, coppb, conb),
+                         just_image=just_image, extra=robust, mef=mef)
+
+    if epochout is not None:
+        for e,P in enumerate(epochout.coadds):
+            if P is None:
+                continue
+            (eim,eiv,epp,en, eimb,eivb,eppb,enb, esky) = P
+            eimb[eivb == 0] = eim[eivb == 0]
+            ehdr = copy.deepcopy(hdr)
+            ehdr.add_record(dict(name='UNW_SKY', value=esky,
+                                 comment='Background value subtracted from coadd img'))
+            ehdr.add_record(dict(name='UNW_EPCH', value=e,
+                                 comment='unWISE epoch number'))
+            ehdr.add_record(dict(name='UNW_NEPC', value=len(epochout.coadds),
+                                 comment='unWISE number of epochs'))
+            write_coadd_products(wprefix + '-e%i' % e, ehdr,
+                                 (eim,eiv,epp,en, eimb,eivb,eppb,enb),
+                                 just_image=just_image, mef=mef)
+        del epochout
 
     if just_image:
+        commit_outputs(tmpdir, prefix, hdr)
         return 0
 
-    ofn = prefix + '-invvar-u.fits'
-    fitsio.write(ofn, coiv.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
-    ofn = prefix + '-std-u.fits'
-    fitsio.write(ofn, copp.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
-    ofn = prefix + '-n-u.fits'
-    fitsio.write(ofn, con.astype(np.int16), header=hdr, clobber=True)
-    print 'Wrote', ofn
-
-    # "Masked" versions
-    ofn = prefix + '-img-m.fits'
-    fitsio.write(ofn, coimb.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
-    ofn = prefix + '-invvar-m.fits'
-    fitsio.write(ofn, coivb.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
-    ofn = prefix + '-std-m.fits'
-    fitsio.write(ofn, coppb.astype(np.float32), header=hdr, clobber=True)
-    print 'Wrote', ofn
-    ofn = prefix + '-n-m.fits'
-    fitsio.write(ofn, conb.astype(np.int16), header=hdr, clobber=True)
-    print 'Wrote', ofn
-
-    if do_cube:
-        ofn = prefix + '-cube.fits'
-        fitsio.write(ofn, cube.astype(np.float32), header=hdr, clobber=True)
-
-    if minmax:
-        ofn = prefix + '-min-m.fits'
-        fitsio.write(ofn, cominb.astype(np.float32), header=hdr, clobber=True)
-        print 'Wrote', ofn
-        ofn = prefix + '-max-m.fits'
-        fitsio.write(ofn, comaxb.astype(np.float32), header=hdr, clobber=True)
-        print 'Wrote', ofn
-        ofn = prefix + '-min-u.fits'
-        fitsio.write(ofn, comin.astype(np.float32), header=hdr, clobber=True)
-        print 'Wrote', ofn
-        ofn = prefix + '-max-u.fits'
-        fitsio.write(ofn, comax.astype(np.float32), header=hdr, clobber=True)
-        print 'Wrote', ofn
-
     WISE.included = np.zeros(len(WISE), bool)
     WISE.sky1 = np.zeros(len(WISE), np.float32)
     WISE.sky2 = np.zeros(len(WISE), np.float32)
@@ -816,9 +1848,16 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
     Iused = np.flatnonzero(WISE.use)
     assert(len(Iused) == len(masks))
 
-    maskdir = os.path.join(outdir, tag + '-mask')
-    if not os.path.exists(maskdir):
-        os.mkdir(maskdir)
+    maskfn = prefix + '-masks.fits'
+    maskout = maskwriter()
+    if oldframes is not None:
+        # Start from the existing frames' masks.
+        if os.path.exists(maskfn):
+            maskout.add_archive(maskreader(maskfn))
+        elif os.path.exists(prefix + '-mask.tgz'):
+            n = add_mask_tgz(maskout, prefix + '-mask.tgz', oldframes,
+                             ti.coadd_id)
+            print 'Added', n, 'masks from', prefix + '-mask.tgz'
             
     for i,mm in enumerate(masks):
         if mm is None:
@@ -838,18 +1877,14 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
 
         WISE.included   [ii] = True
 
-        # Write outlier masks
-        ofn = WISE.intfn[ii].replace('-int', '')
-        ofn = os.path.join(maskdir, 'unwise-mask-' + ti.coadd_id + '-'
-                           + os.path.basename(ofn) + '.gz')
-        w,h = WISE.imagew[ii],WISE.imageh[ii]
-        fullmask = np.zeros((h,w), mm.omask.dtype)
-        x0,x1,y0,y1 = WISE.imextent[ii,:]
-        fullmask[y0:y1+1, x0:x1+1] = mm.omask
-        fitsio.write(ofn, fullmask, clobber=True)
-        print 'Wrote mask', (i+1), 'of', len(masks), ':', ofn
+        # Outlier masks
+        maskout.add(WISE.scan_id[ii], WISE.frame_num[ii], WISE.imagew[ii],
+                    WISE.imageh[ii], WISE.imextent[ii,:], mm.omask)
 
     WISE.delete_column('wcs')
+    if framestats is not None:
+        WISE.delete_column('frame_sky')
+        WISE.delete_column('frame_sig1')
 
     # downcast datatypes, and work around fitsio's issues with
     # "bool" columns
@@ -863,25 +1898,252 @@ def one_coadd(ti, band, W, H, pixscale, WISE,
                 ]:
         WISE.set(c, WISE.get(c).astype(t))
 
-    ofn = prefix + '-frames.fits'
+    if oldframes is not None:
+        WISE = merge_tables([oldframes, WISE], columns='fillzero')
+    ofn = wprefix + '-frames.fits'
     WISE.writeto(ofn)
     print 'Wrote', ofn
 
-    md = tag + '-mask'
-    cmd = ('cd %s && tar czf %s %s && rm -R %s' %
-           (outdir, md + '.tgz', md, md))
-    print 'tgz:', cmd
-    rtn,out,err = run_command(cmd)
-    print out, err
-    if rtn:
-        print >>sys.stderr, 'ERROR: return code', rtn
-        print >>sys.stderr, 'Command:', cmd
-        print >>sys.stderr, out
-        print >>sys.stderr, err
-        ok = False
+    if sums is not None:
+        write_coadd_sums(wprefix + '-sums.fits', sums)
+        print 'Wrote', wprefix + '-sums.fits'
 
+    maskout.write(wprefix + '-masks.fits')
+    print 'Wrote', len(maskout), 'masks to', wprefix + '-masks.fits'
+
+    commit_outputs(tmpdir, prefix, hdr)
     return 0
 
+# Version of the layout of the coadd outputs, recorded in their headers
+# (UNW_DVER) and manifests; outputs from an older version are stale.
+#  1: manifests
+#  2: round-1 sky estimated with reproducible noise (frame_noise_seed)
+#     of the full-frame sig1, rather than unseeded noise of the sig1 of
+#     the sub-image overlapping the tile
+unwise_data_model_version = 2
+
+def file_md5(fn, blocksize=1<<20):
+    import hashlib
+    h = hashlib.md5()
+    f = open(fn, 'rb')
+    while True:
+        b = f.read(blocksize)
+        if not b:
+            break
+        h.update(b)
+    f.close()
+    return h.hexdigest()
+
+def commit_outputs(tmpdir, prefix, hdr):
+    '''
+    Moves the outputs written to scratch directory *tmpdir* into place,
+    beside *prefix*, each with an atomic rename, followed by the
+    manifest <prefix>-manifest.fits listing them (filename, size, md5),
+    with the coadd parameters from header *hdr*.  The manifest is
+    written in *tmpdir* before anything is moved, and renamed into
+    place last, so a tile-band with a manifest has complete outputs.
+    (The renames also change the tile directory's mtime, which
+    invalidates its entries in the todo() index.)  Removes *tmpdir*.
+    '''
+    outdir = os.path.dirname(prefix)
+    fns = sorted(os.listdir(tmpdir))
+    M = fits_table()
+    M.filename = np.array(fns)
+    M.size = np.array([os.path.getsize(os.path.join(tmpdir, fn))
+                       for fn in fns]).astype(np.int64)
+    M.md5 = np.array([file_md5(os.path.join(tmpdir, fn)) for fn in fns])
+    mfn = prefix + '-manifest.fits'
+    tmpfn = os.path.join(tmpdir, os.path.basename(mfn))
+    M.writeto(tmpfn, header=hdr)
+    # The old manifest, if any, no longer describes the files.
+    if os.path.exists(mfn):
+        os.remove(mfn)
+    for fn in fns:
+        os.rename(os.path.join(tmpdir, fn), os.path.join(outdir, fn))
+    os.rename(tmpfn, mfn)
+    os.rmdir(tmpdir)
+    print 'Wrote', len(M), 'outputs and', mfn
+
+def manifest_status(prefix):
+    '''
+    Checks the outputs of the tile-band with prefix *prefix* against its
+    manifest.  Returns (status, hdr): status is 'done', 'missing' (no
+    manifest), 'incomplete' (a listed file is missing or has the wrong
+    size), or 'stale' (older data model version); hdr is the manifest
+    header, or None.
+
+    Outputs written before manifests (and data model versions) count as
+    done if their -frames.fits, written last, exists; hdr is then the
+    -img-m.fits header, without UNW_DVER.
+    '''
+    mfn = prefix + '-manifest.fits'
+    if not os.path.exists(mfn):
+        ifn = prefix + '-img-m.fits'
+        if os.path.exists(prefix + '-frames.fits') and os.path.exists(ifn):
+            hdr = fitsio.read_header(ifn)
+            # (not a run of this version killed while committing)
+            if not 'UNW_DVER' in hdr:
+                return 'done', hdr
+        return 'missing', None
+    M = fits_table(mfn)
+    hdr = fitsio.read_header(mfn, ext=1)
+    outdir = os.path.dirname(prefix)
+    for fn,size in zip(M.filename, M.size):
+        fn = os.path.join(outdir, fn.strip())
+        if not os.path.exists(fn) or os.path.getsize(fn) != size:
+            return 'incomplete', hdr
+    if hdr.get('UNW_DVER', 0) < unwise_data_model_version:
+        return 'stale', hdr
+    return 'done', hdr
+
+def scratch_prefix(tag):
+    '''
+    Returns the name prefix of the scratch directories of tile-band
+    *tag* made by this job: .tmp-<tag>-<host>-<pid>- (see
+    remove_stale_scratch).
+    '''
+    import socket
+    host = socket.gethostname().split('.')[0].replace('-', '_')
+    return '.tmp-%s-%s-%i-' % (tag, host, os.getpid())
+
+# Scratch directories of jobs on other hosts (whose liveness we cannot
+# check) are removed once they are this old, in seconds.
+scratch_timeout = 2 * 86400.
+
+def remove_stale_scratch(outdir, tag):
+    '''
+    Removes scratch directories left in *outdir* by killed runs of
+    tile-band *tag* (see one_coadd): those of processes on this host
+    that no longer run, and those from other hosts (or unnamed) older
+    than *scratch_timeout*.  Returns their number.
+    '''
+    import shutil
+    import errno
+    import time
+    n = 0
+    if not os.path.isdir(outdir):
+        return n
+    pre = '.tmp-%s-' % tag
+    me = scratch_prefix(tag)[len(pre):].split('-')
+    now = time.time()
+    for fn in os.listdir(outdir):
+        if not fn.startswith(pre):
+            continue
+        path = os.path.join(outdir, fn)
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+        words = fn[len(pre):].split('-')
+        if len(words) == 3 and words[0] == me[0]:
+            # ours: remove if the process is gone
+            stale = False
+            try:
+                os.kill(int(words[1]), 0)
+            except ValueError:
+                stale = (age > scratch_timeout)
+            except OSError as e:
+                stale = (e.errno == errno.ESRCH)
+        else:
+            stale = (age > scratch_timeout)
+        if not stale:
+            continue
+        print 'Removing scratch directory of an earlier run:', fn
+        shutil.rmtree(path, ignore_errors=True)
+        n += 1
+    return n
+
+def read_todo_index(outdir):
+    '''
+    Reads the completion index of output directory *outdir*, written by
+    todo(): a dict of (coadd_id, band) -> (data model version, mtime
+    of the tile directory when found complete).
+    '''
+    fn = os.path.join(outdir, 'unwise-todo-index.fits')
+    index = dict()
+    if not os.path.exists(fn):
+        return index
+    I = fits_table(fn)
+    for c,b,v,t in zip(I.coadd_id, I.band, I.dver, I.mtime):
+        index[(c.strip(), b)] = (v, t)
+    return index
+
+def write_todo_index(outdir, index):
+    fn = os.path.join(outdir, 'unwise-todo-index.fits')
+    keys = sorted(index.keys())
+    I = fits_table()
+    I.coadd_id = np.array([c for c,b in keys])
+    I.band = np.array([b for c,b in keys]).astype(np.uint8)
+    I.dver = np.array([index[k][0] for k in keys]).astype(np.int16)
+    I.mtime = np.array([index[k][1] for k in keys]).astype(np.float64)
+    f,tmpfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)),
+                               suffix='.tmp')
+    os.close(f)
+    os.unlink(tmpfn)
+    I.writeto(tmpfn)
+    os.rename(tmpfn, fn)
+    print 'Wrote', len(I), 'complete tile-bands to', fn
+
+def tan_wcs_header(wcs):
+    '''
+    Returns a fitsio header with the WCS cards of Tan WCS *wcs*, from
+    the library's own wcs.add_to_header() (the cards wcs.write_to()
+    writes), built in memory rather than through a temp file.
+    '''
+    hdr = fitsio.FITSHDR()
+    wcs.add_to_header(hdr)
+    return hdr
+
+# Tile compression of each product in multi-extension output, by
+# product name: float images are quantized (to a fraction of their
+# noise, as cfitsio does by default) or left uncompressed; Rice
+# compression of integer images is lossless.
+mef_compression = dict(img=None, invvar='RICE', std='RICE', n='RICE',
+                       min=None, max=None, rejmean=None, med=None)
+
+def write_coadd_products(prefix, hdr, P, just_image=False, extra=None,
+                         mef=False):
+    '''
+    Writes the coadd outputs *P* = (coimg, coinvvar, coppstd, con,
+    coimgb, coinvvarb, coppstdb, conb), "unmasked" and "masked", to
+    *prefix*-{img,invvar,std,n}-{u,m}.fits; or just the unmasked image
+    if *just_image*.  *extra*: optional dict of more images, by name
+    (eg, "min-u"; see coaddacc.robust).
+
+    With *mef*, writes them instead as extensions (IMG_U, ...) of one
+    file, *prefix*.fits, tile-compressed as in *mef_compression*.
+    '''
+    (coim, coiv, copp, con, coimb, coivb, coppb, conb) = P
+
+    prods = [('img-u',    coim.astype(np.float32)),
+             ('invvar-u', coiv.astype(np.float32)),
+             ('std-u',    copp.astype(np.float32)),
+             ('n-u',      con.astype(np.int16)),
+             ('img-m',    coimb.astype(np.float32)),
+             ('invvar-m', coivb.astype(np.float32)),
+             ('std-m',    coppb.astype(np.float32)),
+             ('n-m',      conb.astype(np.int16))]
+    if just_image:
+        prods = prods[:1]
+    elif extra is not None:
+        prods += [(k, extra[k].astype(np.float32)) for k in sorted(extra.keys())]
+
+    if not mef:
+        for k,img in prods:
+            ofn = prefix + '-%s.fits' % k
+            fitsio.write(ofn, img, header=hdr, clobber=True)
+            print 'Wrote', ofn
+        return
+
+    ofn = prefix + '.fits'
+    F = fitsio.FITS(ofn, 'rw', clobber=True)
+    F.write(None, header=hdr)
+    for k,img in prods:
+        F.write(img, header=hdr, extname=k.upper().replace('-', '_'),
+                compress=mef_compression[k.split('-')[0]])
+    F.close()
+    print 'Wrote', ofn, 'with', ', '.join([k for k,img in prods])
+
 def plot_region(r0,r1,d0,d1, ps, T, WISE, wcsfns, W, H, pixscale, margin=1.05,
                 allsky=False, grid_ra_range=None, grid_dec_range=None,
                 grid_spacing=[5, 5, 20, 10], label_tiles=True, draw_outline=True,
@@ -1040,23 +2302,135 @@ def plot_region(r0,r1,d0,d1, ps, T, WISE, wcsfns, W, H, pixscale, margin=1.05,
         print 'Wrote', fn
 
 
+# Round-2 reference arrays (cow1, cowimg1, cowimgsq1) in worker
+# processes, keyed by file name; see publish_round2_refs.
+_round2_refs = {}
+
+def publish_round2_refs(cow1, cowimg1, cowimgsq1):
+    '''
+    Writes the round-1 reference arrays needed by every round-2 task to
+    a single .npy file -- in shared memory (/dev/shm) where available --
+    which worker processes memory-map once, instead of receiving pickled
+    copies with every task.  Returns the file name; the caller must
+    delete it when done.
+
+    The arrays may also be per-epoch stacks, of shape (nepochs, H, W);
+    see _frame_refs.
+    '''
+    f,fn = tempfile.mkstemp(dir=record_dir(), prefix=record_prefix + 'round2-',
+                            suffix='.npy')
+    os.close(f)
+    refs = np.lib.format.open_memmap(fn, mode='w+', dtype=np.float64,
+                                     shape=(3,) + cow1.shape)
+    refs[0] = cow1
+    refs[1] = cowimg1
+    refs[2] = cowimgsq1
+    refs.flush()
+    del refs
+    return fn
+
+def _get_round2_refs(refs):
+    '''
+    Returns (cow1, cowimg1, cowimgsq1) given either the arrays
+    themselves, the name of a file written by publish_round2_refs, or
+    (file name, epoch) for per-epoch stacks.
+    '''
+    epoch = None
+    if isinstance(refs, tuple) and isinstance(refs[0], basestring):
+        refs,epoch = refs
+    if not isinstance(refs, basestring):
+        return refs
+    R = _round2_refs.get(refs)
+    if R is None:
+        # Only keep the current tile's arrays (full-depth and per-epoch)
+        # mapped.
+        if len(_round2_refs) >= 2:
+            _round2_refs.clear()
+        R = np.load(refs, mmap_mode='r')
+        _round2_refs[refs] = R
+    if epoch is not None:
+        return R[0][epoch], R[1][epoch], R[2][epoch]
+    return R[0], R[1], R[2]
+
+def _frame_refs(refs, erefs, epochs, ri):
+    '''
+    Returns the round-2 references for frame *ri*: the full-depth
+    *refs* or, given the frames' *epochs*, the list [*refs*, those of
+    the frame's epoch from the per-epoch stacks *erefs*], for the
+    full-depth and epoch outlier masks (see _round2_epoch).
+    '''
+    if epochs is None:
+        return refs
+    e = int(epochs[ri])
+    if isinstance(erefs, basestring):
+        return [refs, (erefs, e)]
+    return [refs, tuple([a[e] for a in erefs])]
+
+def _round2_return(mm, ps1):
+    # In a worker process, hand the result back as a compact record.
+    if mm is None or ps1 or not _in_worker():
+        return mm
+    return round2_record(mm)
+
 def _bounce_one_round2(*A):
     try:
-        return _coadd_one_round2(*A)
+        return _round2_return(_coadd_one_round2(*A), A[0][7])
     except:
         import traceback
         print '_coadd_one_round2 failed:'
         traceback.print_exc()
         raise
 
-def _coadd_one_round2((ri, N, scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
+def _coadd_one_round12((args1, bg, ri, N, scanid, refs, tinyw, plotfn, ps1,
+                        do_dsky, rchi_fraction)):
+    '''
+    For multiprocessing, in low-memory mode: recomputes the round-1
+    result for one frame (with arguments *args1* for
+    _coadd_one_round1, adding back the background offset *bg* found by
+    bgmatch in round 1) and runs round 2 on it.  *args1* is None for
+    frames that failed in round 1.
+    '''
+    if args1 is None:
+        return None
+    rr = _coadd_one_round1(args1)
+    if rr is None:
+        return None
+    if bg:
+        rr.rimg[(rr.rmask & 1) > 0] += bg
+    return _coadd_one_round2((ri, N, scanid, rr, refs, tinyw, plotfn, ps1,
+                              do_dsky, rchi_fraction))
+
+def _bounce_one_round12(*A):
+    try:
+        return _round2_return(_coadd_one_round12(*A), A[0][8])
+    except:
+        import traceback
+        print '_coadd_one_round12 failed:'
+        traceback.print_exc()
+        raise
+
+def _coadd_one_round2((ri, N, scanid, rr, refs, tinyw,
                        plotfn, ps1, do_dsky, rchi_fraction)):
     '''
     For multiprocessing, the function to be called for each round-2
     frame.
+
+    *refs*: (cow1, cowimg1, cowimgsq1), or the file name from
+    publish_round2_refs (see _get_round2_refs); or, for a multi-epoch
+    coadd, a list of the full-depth and epoch references (see
+    _frame_refs), in which case mm.epoch holds the result for the
+    epoch coadd.
     '''
     if rr is None:
         return None
+    if isinstance(rr, tuple):
+        rec = rr
+        rr = round1_from_record(rec)
+        free_record(rec)
+    erefs = None
+    if isinstance(refs, list):
+        refs,erefs = refs
+    cow1,cowimg1,cowimgsq1 = _get_round2_refs(refs)
     print 'Coadd round 2, image', (ri+1), 'of', N
     t00 = Time()
     mm = Duck()
@@ -1069,37 +2443,24 @@ def _coadd_one_round2((ri, N, scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
 
     cox0,cox1,coy0,coy1 = rr.coextent
     coslc = slice(coy0, coy1+1), slice(cox0, cox1+1)
-    # Remove this image from the per-pixel std calculation...
-    subw  = np.maximum(cow1[coslc] - rr.w, tinyw)
-    subco = (cowimg1  [coslc] - (rr.w * rr.rimg   )) / subw
-    subsq = (cowimgsq1[coslc] - (rr.w * rr.rimg**2)) / subw
-    subv = np.maximum(0, subsq - subco**2)
-    # previously, no prior:
-    # subp = np.sqrt(np.maximum(0, subsq - subco**2))
-
-    # "prior" estimate of per-pixel noise: sig1 + 3% flux in quadrature
-    # rr.w = 1./sig1**2 for this image.
-    priorv = 1./rr.w + (0.03 * np.maximum(subco, 0))**2
-    # Weight that prior equal to the 'subv' estimate from nprior exposures
-    nprior = 5
-    priorw = nprior * rr.w
-    subpp = np.sqrt((subv * subw + priorv * priorw) / (subw + priorw))
-    
     mask = (rr.rmask & 1).astype(bool)
-
-    # like in the WISE Atlas Images, estimate sky difference via
-    # median difference in the overlapping area.
+    corefs = (cow1[coslc], cowimg1[coslc], cowimgsq1[coslc])
+
+    if erefs is not None:
+        # (before rr is patched below)
+        mm.epoch = _round2_epoch(rr, mask, coslc, erefs, tinyw, do_dsky,
+                                 rchi_fraction, scanid)
+
+    if ps1 or plotfn:
+        # Keep the full arrays for plotting.
+        dsky,subco,subpp,rchi = round2_rchi(rr.rimg, mask, rr.w, corefs, tinyw,
+                                            do_dsky)
+        badpix = (np.abs(rchi) >= 5.)
+    else:
+        dsky,badpix = round2_badpix_blocked(rr.rimg, mask, rr.w, corefs, tinyw,
+                                            do_dsky)
     if do_dsky:
-        dsky = median_f((rr.rimg[mask] - subco[mask]).astype(np.float32))
         print 'Sky difference:', dsky
-    else:
-        dsky = 0.
-
-    rchi = ((rr.rimg - dsky - subco) * mask * (subw > 0) * (subpp > 0) /
-            np.maximum(subpp, 1e-6))
-    assert(np.all(np.isfinite(rchi)))
-
-    badpix = (np.abs(rchi) >= 5.)
     #print 'Number of rchi-bad pixels:', np.count_nonzero(badpix)
 
     mm.nrchipix = np.count_nonzero(badpix)
@@ -1147,10 +2508,9 @@ def _coadd_one_round2((ri, N, scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
             return None
 
         rimg = (rr.rimg - dsky)
+        mm.rimg = rimg
         mm.coslc = coslc
-        mm.coimgsq = mask * rr.w * rimg**2
-        mm.coimg   = mask * rr.w * rimg
-        mm.cow     = mask * rr.w
+        mm.coimgsq,mm.coimg,mm.cow = round2_contributions(rimg, mask, rr.w)
         mm.con     = mask
         mm.rmask2  = (rr.rmask & 2).astype(bool)
 
@@ -1263,88 +2623,654 @@ def _coadd_one_round2((ri, N, scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
     print Time() - t00
     return mm
 
+def _round2_epoch(rr, mask, coslc, refs, tinyw, do_dsky, rchi_fraction,
+                  scanid):
+    '''
+    Round-2 outlier rejection of frame *rr* against its epoch's round-1
+    sums *refs*, for the epoch coadd, as _coadd_one_round2 does against
+    the full-depth sums.  Leaves *rr* untouched.  Returns a Duck with
+    the accumulation arrays (see coaddacc.acc), or included=False.
+    '''
+    cow1,cowimg1,cowimgsq1 = _get_round2_refs(refs)
+    corefs = (cow1[coslc], cowimg1[coslc], cowimgsq1[coslc])
+    dsky,badpix = round2_badpix_blocked(rr.rimg, mask, rr.w, corefs, tinyw,
+                                        do_dsky)
+    em = Duck()
+    em.w = rr.w
+    em.included = (np.count_nonzero(badpix) <= rr.ncopix * rchi_fraction)
+    if not em.included:
+        print ('WARNING: dropping exposure %s from its epoch: n rchi pixels %i / %i' %
+               (scanid, np.count_nonzero(badpix), rr.ncopix))
+        return em
+    badpix = binary_dilation(badpix)
+    rimg = rr.rimg.copy()
+    if not patch_image(rimg, np.logical_not(badpix),
+                       required=(badpix * mask)):
+        print 'patch_image failed (epoch)'
+        em.included = False
+        return em
+    rimg -= dsky
+    em.rimg = rimg
+    em.coslc = coslc
+    em.coimgsq,em.coimg,em.cow = round2_contributions(rimg, mask, rr.w)
+    em.con    = mask
+    em.rmask2 = ((rr.rmask & 2) > 0) * np.logical_not(badpix)
+    return em
+
+def _coaddacc_stripe((y0, y1, recs, out, epoch)):
+    '''
+    For multiprocessing: accumulates the round-2 records *recs*, in
+    order, into rows [y0,y1) of the coaddacc arrays in record *out*.
+    With *epoch*, accumulates the records' epoch results.
+    '''
+    inc,rk,mk = ('included', 'rimg', 'masks')
+    if epoch:
+        inc,rk,mk = ('eincluded', 'erimg', 'emasks')
+    A,nil = unpack_record(out, mode='r+')
+    S = Duck()
+    for k,a in A.items():
+        setattr(S, k, a[y0:y1])
+    for rec in recs:
+        if rec is None:
+            continue
+        R,scalars = unpack_record(rec)
+        if not scalars.get(inc, False):
+            continue
+        cox0,cox1,coy0,coy1 = scalars['coextent']
+        r0 = max(coy0, y0)
+        r1 = min(coy1+1, y1)
+        if r0 >= r1:
+            continue
+        rows = (r0 - coy0, r1 - coy0)
+        rimg = np.array(R[rk][rows[0]:rows[1]])
+        masks = unpack_mask_bits(R[mk], R[rk].shape, 2, rows=rows)
+        coadd_acc_add(S, (slice(r0 - y0, r1 - y0), slice(cox0, cox1+1)),
+                      *_round2_acc_arrays(rimg, masks, scalars['w']))
+    del S, A
+
+def kahan_add(s, c, x):
+    '''
+    In-place compensated (Kahan) summation s += x, in the precision of
+    *s*, carrying the lost low-order part (including that of *x*, if it
+    is more precise than *s*) in *c* (same shape and type).  The
+    corrected total is s - c.
+    '''
+    y = x - c
+    t = (s + y).astype(s.dtype)
+    c[...] = (t - s) - y
+    s[...] = t
+
+def coadd_finish_arrays(coimg, coimgsq, cow, con, tinyw):
+    '''
+    Turns accumulated sums into the (in-place normalized) coadd image,
+    its inverse-variance map, and the per-pixel std of the coadd.  The
+    variance is formed in float64 even from float32 sums, since it is
+    a difference of nearly equal numbers at bright pixels.
+    '''
+    coimg /= np.maximum(cow, tinyw)
+    coinvvar = cow
+    # per-pixel variance
+    coppstd = np.sqrt(np.maximum(0, coimgsq / np.maximum(cow, tinyw).astype(float)
+                                 - coimg.astype(float)**2))
+    # normalize by number of frames to produce an estimate of the
+    # stddev in the *coadd* rather than in the individual frames.
+    # This is the sqrt of the unbiased estimator of the variance
+    coppstd /= np.sqrt(np.maximum(1., (con - 1).astype(float)))
+    return coimg, coinvvar, coppstd
+
+def coadd_acc_add(A, slc, coimgsq, coimg, cow, con, rmask2):
+    '''
+    Adds one frame's round-2 arrays into the accumulator arrays of *A*
+    (a coaddacc, or a stripe of one) at *slc*.
+    '''
+    if getattr(A, 'coimgsqc', None) is not None:
+        # float32: the std is a difference of nearly equal numbers at
+        # bright pixels, so compensate the sums of squares.
+        kahan_add(A.coimgsq [slc], A.coimgsqc [slc], coimgsq)
+        kahan_add(A.coimgsqb[slc], A.coimgsqbc[slc], rmask2 * coimgsq)
+    else:
+        A.coimgsq [slc] += coimgsq
+        A.coimgsqb[slc] += rmask2 * coimgsq
+    A.coimg   [slc] += coimg
+    A.cow     [slc] += cow
+    A.con     [slc] += con
+    A.coimgb  [slc] += rmask2 * coimg
+    A.cowb    [slc] += rmask2 * cow
+    A.conb    [slc] += rmask2 * con
+
+class cubewriter():
+    '''
+    Writes an image cube to a FITS file one frame at a time, so that
+    only the current frame is held in memory.  Each frame's plane is
+    stored as its own image HDU, cut to its coadd extent; an "INDEX"
+    table written by close() gives, for each plane, the frame number
+    (its index in the coadd_wise inputs), the HDU, and the *inclusive* coadd extent (x0,x1,y0,y1), as in
+    WISE.coextent.  The primary header holds the coadd size (CUBE_W,
+    CUBE_H).  Read with cubereader.
+    '''
+    def __init__(self, fn, H, W):
+        self.fn = fn
+        self.H = H
+        self.W = W
+        self.fits = fitsio.FITS(fn, 'rw', clobber=True)
+        hdr = fitsio.FITSHDR()
+        hdr.add_record(dict(name='CUBE_W', value=W, comment='Coadd width'))
+        hdr.add_record(dict(name='CUBE_H', value=H, comment='Coadd height'))
+        self.fits.write(None, header=hdr)
+        self.frame = []
+        self.coextent = []
+
+    def __len__(self):
+        return len(self.frame)
+
+    def add(self, img, slc, frame=-1):
+        '''
+        Writes the plane of frame number *frame*, with image *img* at
+        coadd slice *slc*.
+        '''
+        self.fits.write(img.astype(np.float32))
+        ys,xs = slc
+        self.coextent.append((xs.start, xs.stop-1, ys.start, ys.stop-1))
+        self.frame.append(-1 if frame is None else frame)
+
+    def close(self, header=None):
+        '''
+        Writes the index table, and the keywords of *header* (if given)
+        to the primary header.
+        '''
+        if self.fits is None:
+            return
+        n = len(self.frame)
+        self.fits.write([np.array(self.frame, np.int32),
+                         np.arange(1, n+1).astype(np.int32),
+                         np.array(self.coextent, np.int32).reshape((n,4))],
+                        names=['frame', 'hdu', 'coextent'], extname='INDEX')
+        if header is not None:
+            self.fits[0].write_keys(header)
+        self.fits.close()
+        self.fits = None
+
+class cubereader():
+    '''
+    Reads an image cube written by cubewriter, one plane or one pixel's
+    time series at a time.
+    '''
+    def __init__(self, fn):
+        self.fits = fitsio.FITS(fn)
+        hdr = self.fits[0].read_header()
+        self.W = hdr['CUBE_W']
+        self.H = hdr['CUBE_H']
+        index = self.fits['INDEX'].read()
+        self.frame    = index['frame']
+        self.hdu      = index['hdu']
+        self.coextent = index['coextent']
+
+    def __len__(self):
+        return len(self.hdu)
+
+    def plane(self, i):
+        '''
+        Returns plane *i* as a full-size image, zero outside its extent.
+        '''
+        img = np.zeros((self.H, self.W), np.float32)
+        x0,x1,y0,y1 = self.coextent[i]
+        img[y0:y1+1, x0:x1+1] = self.fits[self.hdu[i]].read()
+        return img
+
+    def pixel(self, x, y):
+        '''
+        Returns the values of coadd pixel *x*,*y* in all planes, zero
+        for planes not covering it.
+        '''
+        pix = np.zeros(len(self), np.float32)
+        x0,x1,y0,y1 = [self.coextent[:,j] for j in range(4)]
+        I = np.flatnonzero((x >= x0) * (x <= x1) * (y >= y0) * (y <= y1))
+        for i in I:
+            dx = x - x0[i]
+            dy = y - y0[i]
+            pix[i] = self.fits[self.hdu[i]][dy:dy+1, dx:dx+1][0,0]
+        return pix
+
+def mask_runs(mask):
+    '''
+    Run-length encodes the nonzero pixels of *mask*: returns the
+    inclusive bounding box (x0,x1,y0,y1) of the nonzero pixels (None if
+    there are none), and (start, length, value) arrays of the runs of
+    equal nonzero values in the flattened box.
+    '''
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    if len(rows) == 0:
+        return None, (np.zeros(0, np.int32), np.zeros(0, np.int32),
+                      np.zeros(0, mask.dtype))
+    y0,y1 = rows[0], rows[-1]
+    x0,x1 = cols[0], cols[-1]
+    flat = mask[y0:y1+1, x0:x1+1].ravel()
+    starts = np.append(0, np.flatnonzero(flat[1:] != flat[:-1]) + 1)
+    ends = np.append(starts[1:], len(flat))
+    vals = flat[starts]
+    K = np.flatnonzero(vals)
+    return ((x0,x1,y0,y1), (starts[K].astype(np.int32),
+                            (ends - starts)[K].astype(np.int32), vals[K]))
+
+class maskwriter():
+    '''
+    Collects the outlier masks of a tile's frames as run-length encoded
+    nonzero pixels (see mask_runs), and writes them in one go to a FITS
+    file: a "FRAMES" table (scan_id, frame_num, the frame size imagew
+    and imageh, the inclusive bounding box "bbox" of the nonzero pixels
+    in the frame, or -1s, and its runs: run0, nruns), and a "RUNS"
+    table (start, length, value; starts are flat indices in the box).
+    Read with maskreader.
+    '''
+    def __init__(self):
+        self.frames = []
+        self.runs = []
+        self.nruns = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, scan_id, frame_num, imagew, imageh, imextent, omask):
+        '''
+        Adds the mask *omask* of a frame, covering its *imextent*
+        (inclusive x0,x1,y0,y1).
+        '''
+        box,runs = mask_runs(omask)
+        if box is None:
+            box = (-1,-1,-1,-1)
+        else:
+            x0,x1,y0,y1 = box
+            box = (x0 + imextent[0], x1 + imextent[0],
+                   y0 + imextent[2], y1 + imextent[2])
+        self.add_runs(scan_id, frame_num, imagew, imageh, box, runs)
+
+    def add_runs(self, scan_id, frame_num, imagew, imageh, box, runs):
+        n = len(runs[0])
+        self.frames.append((scan_id, frame_num, imagew, imageh, box,
+                            self.nruns, n))
+        self.runs.append(runs)
+        self.nruns += n
+
+    def add_archive(self, R, keep=None):
+        '''
+        Adds the frames of maskreader *R* (those with *keep* True).
+        '''
+        for i in range(len(R)):
+            if keep is not None and not keep[i]:
+                continue
+            self.add_runs(R.scan_id[i], R.frame_num[i], R.imagew[i],
+                          R.imageh[i], R.bbox[i], R.runs(i))
+
+    def write(self, fn):
+        F = fitsio.FITS(fn, 'rw', clobber=True)
+        F.write(None)
+        cols = zip(*self.frames) if len(self.frames) else [[]] * 7
+        F.write([np.array(cols[0], 'S16'),
+                 np.array(cols[1], np.int32),
+                 np.array(cols[2], np.int16),
+                 np.array(cols[3], np.int16),
+                 np.array(cols[4], np.int16).reshape((-1,4)),
+                 np.array(cols[5], np.int64),
+                 np.array(cols[6], np.int32)],
+                names=['scan_id', 'frame_num', 'imagew', 'imageh', 'bbox',
+                       'run0', 'nruns'], extname='FRAMES')
+        if len(self.runs):
+            runs = [np.hstack(r) for r in zip(*self.runs)]
+        else:
+            runs = [np.zeros(0, np.int32), np.zeros(0, np.int32),
+                    np.zeros(0, np.uint8)]
+        F.write([runs[0].astype(np.int32), runs[1].astype(np.int32),
+                 runs[2].astype(np.uint8)],
+                names=['start', 'length', 'value'], extname='RUNS')
+        F.close()
+
+def add_mask_tgz(maskout, fn, T, coadd_id):
+    '''
+    Adds to maskwriter *maskout* the full-frame outlier masks of the
+    frames in table *T* (a -frames.fits) from a -mask.tgz written
+    before mask archives; returns their number.
+    '''
+    import tarfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tar = tarfile.open(fn)
+        tar.extractall(tmpdir)
+        tar.close()
+        n = 0
+        for i in np.flatnonzero(T.included):
+            # (as named by unwise_coadd.py before mask archives)
+            mfn = ('unwise-mask-' + coadd_id + '-' +
+                   os.path.basename(T.intfn[i].strip().replace('-int', '')) + '.gz')
+            mfn = os.path.join(tmpdir, os.path.basename(fn).replace('.tgz', ''), mfn)
+            if not os.path.exists(mfn):
+                print 'WARNING: no mask for frame', T.scan_id[i], T.frame_num[i], 'in', fn
+                continue
+            mask = fitsio.read(mfn)
+            h,w = mask.shape
+            maskout.add(T.scan_id[i], T.frame_num[i], w, h, (0, w-1, 0, h-1),
+                        mask)
+            n += 1
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return n
+
+class maskreader():
+    '''
+    Reads an outlier-mask archive written by maskwriter, rebuilding
+    full-frame masks on demand.
+    '''
+    def __init__(self, fn):
+        F = fitsio.FITS(fn)
+        T = F['FRAMES'].read()
+        self.scan_id   = np.array([s.strip() for s in T['scan_id']])
+        self.frame_num = T['frame_num']
+        self.imagew    = T['imagew']
+        self.imageh    = T['imageh']
+        self.bbox      = T['bbox']
+        self.run0      = T['run0']
+        self.nruns     = T['nruns']
+        R = F['RUNS'].read()
+        self.start  = R['start']
+        self.length = R['length']
+        self.value  = R['value']
+        F.close()
+
+    def __len__(self):
+        return len(self.scan_id)
+
+    def index(self, scan_id, frame_num):
+        '''
+        Returns the index of the given frame, or -1.
+        '''
+        I = np.flatnonzero((self.scan_id == scan_id.strip()) *
+                           (self.frame_num == frame_num))
+        if len(I) == 0:
+            return -1
+        return I[0]
+
+    def runs(self, i):
+        r = slice(self.run0[i], self.run0[i] + self.nruns[i])
+        return self.start[r], self.length[r], self.value[r]
+
+    def mask(self, i):
+        '''
+        Returns the full-frame mask of frame *i*.
+        '''
+        mask = np.zeros((self.imageh[i], self.imagew[i]), np.uint8)
+        x0,x1,y0,y1 = self.bbox[i]
+        if x0 < 0:
+            return mask
+        sub = np.zeros((y1+1-y0) * (x1+1-x0), np.uint8)
+        s,l,v = self.runs(i)
+        # flat index of each pixel of each run
+        off = np.repeat(s - np.append(0, np.cumsum(l)[:-1]), l)
+        sub[np.arange(np.sum(l)) + off] = np.repeat(v, l)
+        mask[y0:y1+1, x0:x1+1] = sub.reshape((y1+1-y0, x1+1-x0))
+        return mask
+
+class robustacc():
+    '''
+    Streaming per-pixel order statistics of frame values: the min and
+    max, the mean with the min and max rejected, and quantiles (eg,
+    the median) estimated from a fixed-size histogram of each pixel's
+    values.
+
+    The histogram has *nbins* uint16 counts per pixel, with bins
+    *binsig* times the per-pixel reference std *sig* wide, centered on
+    the reference image *ref* (the round-1 coadd); the outermost bins
+    extend to the min and max.  Quantiles are interpolated linearly
+    within a bin, so are good to a fraction of a bin for pixels whose
+    values are near the reference.  Without *ref*, only the min, max
+    and rejected mean are kept.  With the default 16 bins this takes 58
+    bytes per pixel, including the reference.
+    '''
+    def __init__(self, H, W, ref=None, sig=None, nbins=16, binsig=0.5):
+        self.min = np.empty((H,W), np.float32)
+        self.max = np.empty((H,W), np.float32)
+        self.min[:,:] =  np.inf
+        self.max[:,:] = -np.inf
+        self.sum = np.zeros((H,W))
+        self.n = np.zeros((H,W), np.int16)
+        self.nbins = nbins
+        self.hist = None
+        if ref is not None:
+            self.ref = ref.astype(np.float32)
+            # bin width; (guard against zero std)
+            sig = np.maximum(sig, np.median(sig[sig > 0]) if np.any(sig > 0) else 1.)
+            self.binw = (binsig * sig).astype(np.float32)
+            # pixel-major, so that each pixel's counts are contiguous
+            self.hist = np.zeros((H,W,nbins), np.uint16)
+
+    def add(self, slc, img, mask):
+        '''
+        Adds frame image *img*, at coadd slice *slc*, where *mask* is
+        set.  Touches only the frame's extent.
+        '''
+        mn = self.min[slc]
+        mx = self.max[slc]
+        np.minimum(mn, np.where(mask, img, np.float32( np.inf)), out=mn)
+        np.maximum(mx, np.where(mask, img, np.float32(-np.inf)), out=mx)
+        self.sum[slc] += np.where(mask, img, 0.)
+        self.n[slc] += mask
+        if self.hist is None:
+            return
+        b = (img - self.ref[slc]) / self.binw[slc]
+        b += self.nbins / 2
+        # (non-negative after clipping, so truncation is floor)
+        np.clip(b, 0, self.nbins - 1, out=b)
+        H,W = self.n.shape
+        y,x = np.ogrid[slc]
+        # Flat index into hist; each index appears once, so this
+        # increments each masked pixel's bin.
+        I = (y * W + x) * self.nbins + b.astype(np.intp)
+        self.hist.reshape(-1)[I] += mask
+
+    def minmax(self):
+        '''
+        Returns the (min, max) images, zero where there were no values.
+        '''
+        n0 = (self.n == 0)
+        mn = self.min.copy()
+        mx = self.max.copy()
+        mn[n0] = 0.
+        mx[n0] = 0.
+        return mn, mx
+
+    def rejected_mean(self):
+        '''
+        Returns the mean with the min and max values rejected (the
+        plain mean for fewer than three values; zero for none).
+        '''
+        n = self.n.astype(float)
+        s = self.sum.copy()
+        rej = (self.n > 2)
+        s[rej] -= self.min[rej].astype(float) + self.max[rej]
+        n[rej] -= 2
+        return (s / np.maximum(n, 1)).astype(np.float32)
+
+    def quantile(self, q):
+        '''
+        Returns the estimated *q* quantile (0.5 for the median) image,
+        zero where there were no values.
+        '''
+        assert(self.hist is not None)
+        H,W = self.n.shape
+        res = np.zeros((H,W), np.float32)
+        for rows in _row_blocks(H, W * self.nbins):
+            hist = self.hist[rows]
+            c = np.cumsum(hist, axis=2)
+            target = q * self.n[rows]
+            # bin containing the quantile
+            k = np.sum(c < target[:,:,np.newaxis], axis=2)
+            k = np.minimum(k, self.nbins - 1)
+            i0 = np.arange(k.size)
+            cnt = hist.reshape(-1, self.nbins)[i0, k.ravel()].reshape(k.shape)
+            cbefore = c.reshape(-1, self.nbins)[i0, k.ravel()].reshape(k.shape) - cnt
+            frac = np.clip((target - cbefore) / np.maximum(cnt, 1.), 0., 1.)
+            ref = self.ref[rows]
+            binw = self.binw[rows]
+            mn = self.min[rows]
+            mx = self.max[rows]
+            lo = ref + (k - self.nbins / 2) * binw
+            hi = lo + binw
+            lo = np.where(k == 0, mn, np.clip(lo, mn, mx))
+            hi = np.where(k == self.nbins - 1, mx, np.clip(hi, mn, mx))
+            r = lo + frac * (hi - lo)
+            r[self.n[rows] == 0] = 0.
+            res[rows] = r
+        return res
+
 class coaddacc():
     '''Second-round coadd accumulator.'''
-    def __init__(self, H,W, do_cube=False, nims=0, bgmatch=False,
-                 minmax=False):
-        self.coimg    = np.zeros((H,W))
-        self.coimgsq  = np.zeros((H,W))
-        self.cow      = np.zeros((H,W))
+    arrays = ['coimg', 'coimgsq', 'cow', 'con',
+              'coimgb', 'coimgsqb', 'cowb', 'conb']
+
+    def __init__(self, H,W, cube=None, bgmatch=False,
+                 minmax=False, acc32=False, epochs=None, minmaxref=None):
+        '''
+        *minmax*: also keep robust per-pixel statistics of the frame
+        values (see robustacc), of the unmasked and masked pixels; with
+        *minmaxref* = (ref, sig) (the round-1 coadd and its per-pixel
+        std), including median estimates.  See *robust*, set by
+        finish().
+
+        *cube*: optional cubewriter, to which each frame's round-2
+        image is written.
+
+        *acc32*: accumulate in float32 rather than float64, with
+        compensated summation of the sums of squares (see
+        coadd_acc_add); this takes two-thirds of the memory.
+
+        *epochs*: optional epoch number of each frame; each frame is
+        then also added to its epoch's accumulator in *ecoadds*.
+        '''
+        dt = np.float32 if acc32 else float
+        self.coimg    = np.zeros((H,W), dt)
+        self.coimgsq  = np.zeros((H,W), dt)
+        self.cow      = np.zeros((H,W), dt)
         self.con      = np.zeros((H,W), np.int16)
-        self.coimgb   = np.zeros((H,W))
-        self.coimgsqb = np.zeros((H,W))
-        self.cowb     = np.zeros((H,W))
+        self.coimgb   = np.zeros((H,W), dt)
+        self.coimgsqb = np.zeros((H,W), dt)
+        self.cowb     = np.zeros((H,W), dt)
         self.conb     = np.zeros((H,W), np.int16)
+        self.compensated = ['coimgsq', 'coimgsqb']
+        for k in self.compensated:
+            # Kahan compensation terms
+            setattr(self, k + 'c', np.zeros((H,W), dt) if acc32 else None)
+        if acc32:
+            self.arrays = coaddacc.arrays + [k + 'c' for k in self.compensated]
 
         self.bgmatch = bgmatch
 
         self.minmax = minmax
+        self.comin  = None
+        self.comax  = None
+        self.cominb = None
+        self.comaxb = None
+        self.robust = None
         if minmax:
-            self.comin  = np.empty((H,W))
-            self.comax  = np.empty((H,W))
-            self.cominb = np.empty((H,W))
-            self.comaxb = np.empty((H,W))
-            self.comin [:,:] =  1e30
-            self.cominb[:,:] =  1e30
-            self.comax [:,:] = -1e30
-            self.comaxb[:,:] = -1e30
-        else:
-            self.comin  = None
-            self.comax  = None
-            self.cominb = None
-            self.comaxb = None
-
-        if do_cube:
-            self.cube = np.zeros((nims, H, W), np.float32)
-            self.cubei = 0
-        else:
-            self.cube = None
+            ref,sig = minmaxref if minmaxref is not None else (None, None)
+            self.racc  = robustacc(H, W, ref=ref, sig=sig)
+            self.raccb = robustacc(H, W, ref=ref, sig=sig)
+
+        self.cube = cube
+
+        self.epochs = epochs
+        self.ecoadds = []
+        if epochs is not None:
+            E = (max(epochs) + 1) if len(epochs) else 0
+            self.ecoadds = [coaddacc(H, W, acc32=acc32) for e in range(E)]
+
+    def add_sums(self, S):
+        '''
+        Adds the raw sums of an existing coadd (see read_coadd_sums).
+        '''
+        for k in coaddacc.arrays:
+            a = getattr(self, k)
+            a += getattr(S, k).astype(a.dtype)
 
     def finish(self):
+        for k in self.compensated:
+            c = getattr(self, k + 'c')
+            if c is not None:
+                # The (sum, compensation) pair holds more precision than
+                # float32; keep it by combining them in float64.
+                setattr(self, k, getattr(self, k).astype(float) - c)
+                setattr(self, k + 'c', None)
         if self.minmax:
-            # Set pixels that weren't changed from their initial values to zero.
-            self.comin [self.comin  ==  1e30] = 0.
-            self.cominb[self.cominb ==  1e30] = 0.
-            self.comax [self.comax  == -1e30] = 0.
-            self.comaxb[self.comaxb == -1e30] = 0.
+            # Products, by output file name suffix
+            self.robust = dict()
+            for racc,suff in [(self.racc, 'u'), (self.raccb, 'm')]:
+                mn,mx = racc.minmax()
+                self.robust['min-' + suff] = mn
+                self.robust['max-' + suff] = mx
+                self.robust['rejmean-' + suff] = racc.rejected_mean()
+                if racc.hist is not None:
+                    self.robust['med-' + suff] = racc.quantile(0.5)
+            self.comin,  self.comax  = self.robust['min-u'], self.robust['max-u']
+            self.cominb, self.comaxb = self.robust['min-m'], self.robust['max-m']
+            del self.racc, self.raccb
+        for ec in self.ecoadds:
+            ec.finish()
             
-    def acc(self, mm, delmm=False):
-        if mm is None or not mm.included:
+    def acc_records(self, recs, mp, epoch=False):
+        '''
+        Accumulates the round-2 records *recs* (see round2_record; or
+        None) with the tile split into row stripes, one per process of
+        *mp*.  Each stripe adds the frames in input order, so the result
+        is identical to calling acc() on each frame in turn.  Not for
+        use with the cube or minmax.  With *epoch*, accumulates the
+        records' epoch results (see _round2_epoch).
+        '''
+        assert(self.cube is None and not self.minmax)
+        H,W = self.coimg.shape
+        out = pack_record([(k, getattr(self, k)) for k in self.arrays], {})
+        try:
+            nstripes = max(1, min(H, _mp_threads(mp)))
+            edges = np.linspace(0, H, nstripes+1).astype(int)
+            mp.map(_coaddacc_stripe, [(y0, y1, recs, out, epoch) for y0,y1
+                                      in zip(edges[:-1], edges[1:])])
+            A,nil = unpack_record(out)
+            for k in self.arrays:
+                setattr(self, k, np.array(A[k]))
+            del A
+        finally:
+            free_record(out)
+        for e,ec in enumerate(self.ecoadds):
+            ec.acc_records([rec if self.epochs[ri] == e else None
+                            for ri,rec in enumerate(recs)], mp, epoch=True)
+
+    def acc(self, mm, delmm=False, ri=None):
+        '''
+        Accumulates round-2 result *mm*, of frame number *ri* (needed
+        with *epochs*).  The frame's epoch coadd gets mm.epoch, its
+        result with outliers rejected against the epoch rather than the
+        full depth (see _round2_epoch).
+        '''
+        if mm is None:
+            return
+
+        if self.ecoadds:
+            self.ecoadds[self.epochs[ri]].acc(mm.epoch)
+            if delmm:
+                del mm.epoch
+
+        if not mm.included:
             return
 
         if self.bgmatch:
             pass
 
-        self.coimgsq [mm.coslc] += mm.coimgsq
-        self.coimg   [mm.coslc] += mm.coimg
-        self.cow     [mm.coslc] += mm.cow
-        self.con     [mm.coslc] += mm.con
-        self.coimgsqb[mm.coslc] += mm.rmask2 * mm.coimgsq
-        self.coimgb  [mm.coslc] += mm.rmask2 * mm.coimg
-        self.cowb    [mm.coslc] += mm.rmask2 * mm.cow
-        self.conb    [mm.coslc] += mm.rmask2 * mm.con
+        coadd_acc_add(self, mm.coslc, mm.coimgsq, mm.coimg, mm.cow, mm.con,
+                      mm.rmask2)
         if self.cube is not None:
-            self.cube[(self.cubei,) + mm.coslc] = (mm.coimg).astype(self.cube.dtype)
-            self.cubei += 1
+            self.cube.add(mm.coimg, mm.coslc, ri)
         if self.minmax:
-
-            print 'mm.coslc:', mm.coslc
-            print 'mm.con:', np.unique(mm.con), mm.con.dtype
-            print 'mm.rmask2:', np.unique(mm.rmask2), mm.rmask2.dtype
-
-            self.comin[mm.coslc][mm.con] = np.minimum(self.comin[mm.coslc][mm.con],
-                                                      mm.coimg[mm.con] / mm.w)
-            self.comax[mm.coslc][mm.con] = np.maximum(self.comax[mm.coslc][mm.con],
-                                                      mm.coimg[mm.con] / mm.w)
-            self.cominb[mm.coslc][mm.rmask2] = np.minimum(self.cominb[mm.coslc][mm.rmask2],
-                                                          mm.coimg[mm.rmask2] / mm.w)
-            self.comaxb[mm.coslc][mm.rmask2] = np.maximum(self.comaxb[mm.coslc][mm.rmask2],
-                                                          mm.coimg[mm.rmask2] / mm.w)
-
-            print 'comin',  self.comin.min(),  self.comin.max()
-            print 'comax',  self.comax.min(),  self.comax.max()
-            print 'cominb', self.cominb.min(), self.cominb.max()
-            print 'comaxb', self.comaxb.min(), self.comaxb.max()
+            img = (mm.coimg / mm.w).astype(np.float32)
+            self.racc .add(mm.coslc, img, mm.con)
+            self.raccb.add(mm.coslc, img, mm.con * mm.rmask2)
 
         if delmm:
             del mm.coimgsq
@@ -1352,6 +3278,7 @@ class coaddacc():
             del mm.cow
             del mm.con
             del mm.rmask2
+            mm.__dict__.pop('rimg', None)
 
 
 def binimg(img, b):
@@ -1363,28 +3290,96 @@ def binimg(img, b):
 
 def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
                do_cube, medfilt, plots2=False, table=True, do_dsky=False,
-               checkmd5=False, bgmatch=False, minmax=False, rchi_fraction=0.01, do_cube1=False):
+               checkmd5=False, bgmatch=False, minmax=False, rchi_fraction=0.01, do_cube1=False,
+               framecache=None, prefetch=None, round1dir=None, lowmem=False,
+               memstats=None, acc32=False, prior=None, sums=None,
+               epochs=None, epochout=None, cubefn=None):
+    '''
+    *do_cube*, *do_cube1*: write the round-2 and round-1 frames as an
+    image cube, streamed to disk as they are accumulated (see
+    cubewriter), to *cubefn* (default <tile>-w<band>-cube.fits) and
+    <tile>-w<band>-cube1.fits.  The returned *cube* is the round-2
+    cubewriter, still open so that the caller can add header cards on
+    close().
+
+    *lowmem*: keep only per-frame scalars after round 1, and recompute
+    each frame for round 2.  The results are identical; peak memory no
+    longer grows with the number of frames, at the cost of running
+    round 1 twice.
+
+    *memstats*: optional Duck; memstats.worker is set to the peak
+    memory (GB) of the round-1 worker processes.
+
+    *acc32*: accumulate the round-1 and round-2 coadds in float32, with
+    compensated summation of the sums of squares.  The coadd image,
+    inverse-variance and per-pixel std agree with float64 accumulation
+    to well within the noise; see acc32.py for the tolerances.
+
+    *prior*: raw sums of an existing coadd (see read_coadd_sums), to
+    which *WISE* frames are added.  Outlier rejection of the new frames
+    is against the round-1 sums of all frames; the existing frames are
+    not revisited.
+
+    *sums*: optional Duck, filled with the raw sums of the result.
+
+    *epochs*: optional epoch number (0, 1, ...) of each frame, for a
+    multi-epoch coadd: each frame is resampled once and added both to
+    the full-depth coadd and to that of its epoch.  Each frame gets two
+    outlier masks: one against the full-depth round-1 coadd, for the
+    full-depth coadd (which is thus identical to that without
+    *epochs*), and one against the round-1 coadd of its epoch, for the
+    epoch coadd, as if the epochs were coadded separately.  *epochout* (a Duck) is filled with
+    *coadds*, a list with, for each epoch, the same tuple as
+    coadd_products or None if no frames were included.
+    '''
     L = 3
     W = cowcs.get_width()
     H = cowcs.get_height()
     # For W4, single-image ww is ~ 1e-10
     tinyw = 1e-16
+    assert(prior is None or epochs is None)
+
+    # Keep resampled round-1 frames in a scratch file rather than in
+    # memory?  (Not when plotting, which needs the extra rr arrays.)
+    store = None
+    if lowmem and not ps:
+        store = round1metastore()
+    elif round1dir is not None and not ps:
+        store = round1diskstore(round1dir, prefix='%s-w%i-round1-' % (tile, band))
+        print 'Round-1 frame store:', store.fn
 
     # Round-1 coadd:
+    esums = None
+    if epochs is not None:
+        esums = Duck()
+    cube1fn = None
+    if do_cube1:
+        cube1fn = '%s-w%i-cube1.fits' % (tile, band)
     (rimgs, coimg1, cow1, coppstd1, cowimgsq1, cube1)= _coadd_wise_round1(
         cowcs, WISE, ps, band, table, L, tinyw, mp1, medfilt, checkmd5,
-        bgmatch, do_cube1)
+        bgmatch, cube1fn, cache=framecache, prefetch=prefetch, store=store,
+        acc32=acc32, epochs=epochs, esums=esums)
     cowimg1 = coimg1 * cow1
+    if prior is not None:
+        cow1      = cow1      + prior.cow1
+        cowimg1   = cowimg1   + prior.cowimg1
+        cowimgsq1 = cowimgsq1 + prior.cowimgsq1
+        coimg1 = cowimg1 / np.maximum(cow1, tinyw)
+        coppstd1 = np.sqrt(np.maximum(0, cowimgsq1 / np.maximum(cow1, tinyw)
+                                      - coimg1**2))
     assert(len(rimgs) == len(WISE))
+    if memstats is not None:
+        memstats.worker = max([getattr(rr, 'peakmem', 0.) for rr in rimgs
+                               if rr is not None] + [0.])
+        # round-1 records held for round 2
+        memstats.shm = records_footprint()
 
     if mp1 != mp2:
         print 'Shutting down multiprocessing pool 1'
         mp1.close()
 
     if do_cube1:
-        ofn = '%s-w%i-cube1.fits' % (tile, band)
-        fitsio.write(ofn, cube1, clobber=True)
-        print 'Wrote', ofn
+        print 'Wrote', cube1fn
 
         ofn = '%s-w%i-coimg1.fits' % (tile, band)
         fitsio.write(ofn, coimg1, clobber=True)
@@ -1630,13 +3625,64 @@ def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
     print 'After garbage collection:', Time()-t0
     ps1 = (ps is not None)
     delmm = (ps is None)
-    if not mp2.pool:
-        coadd = coaddacc(H, W, do_cube=do_cube, nims=len(rimgs), minmax=minmax)
+    cube = None
+    if do_cube:
+        if cubefn is None:
+            cubefn = '%s-w%i-cube.fits' % (tile, band)
+        cube = cubewriter(cubefn, H, W)
+    # Round-2 references: the round-1 sums, for the full-depth outlier
+    # masks, and per-epoch stacks of them, for the epoch coadds' own
+    # (see _frame_refs).
+    refs1 = (cow1, cowimg1, cowimgsq1)
+    erefs1 = None
+    if epochs is not None:
+        erefs1 = (esums.cow, esums.cowimg, esums.cowimgsq)
+    del esums
+    if isinstance(rimgs, round1metastore):
+        # Recompute the round-1 frames, accumulating round-2 results as
+        # they arrive.
+        refs,erefs = refs1,erefs1
+        if mp2.pool:
+            refs = publish_round2_refs(*refs1)
+            if erefs1 is not None:
+                erefs = publish_round2_refs(*erefs1)
+        N = len(WISE)
+        stats = _round1_stats(WISE, medfilt)
+        args = (((ri, N, WISE[ri], table, L, ps, band, cowcs, medfilt,
+                  checkmd5, framecache, None, stats[ri])
+                 if rimgs[ri] is not None else None,
+                 getattr(rimgs[ri], 'bgmatch', 0.), ri, N,
+                 ('scan %s frame %i band %i' %
+                  (WISE.scan_id[ri], WISE.frame_num[ri], band)),
+                 _frame_refs(refs, erefs, epochs, ri), tinyw, None, ps1, do_dsky,
+                 rchi_fraction)
+                for ri in range(N))
+        coadd = coaddacc(H, W, cube=cube, bgmatch=bgmatch,
+                         minmax=minmax, acc32=acc32, epochs=epochs,
+                         minmaxref=(coimg1, coppstd1))
+        if prior is not None:
+            coadd.add_sums(prior)
+        masks = []
+        try:
+            for ri,mm in enumerate(mp2.imap(_bounce_one_round12, args)):
+                mm = _round2_result(mm)
+                coadd.acc(mm, delmm=delmm, ri=ri)
+                masks.append(mm)
+        finally:
+            if mp2.pool:
+                os.unlink(refs)
+                if erefs1 is not None:
+                    os.unlink(erefs)
+        del args
+    elif not mp2.pool:
+        coadd = coaddacc(H, W, cube=cube, minmax=minmax,
+                         acc32=acc32, epochs=epochs,
+                         minmaxref=(coimg1, coppstd1))
+        if prior is not None:
+            coadd.add_sums(prior)
         masks = []
-        ri = -1
-        while len(rimgs):
-            ri += 1
-            rr = rimgs.pop(0)
+        for ri in range(len(rimgs)):
+            rr = rimgs.take(ri)
             if ps and plots2:
                 plotfn = ps.getnext()
             else:
@@ -1644,34 +3690,80 @@ def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
             scanid = ('scan %s frame %i band %i' %
                       (WISE.scan_id[ri], WISE.frame_num[ri], band))
             mm = _coadd_one_round2(
-                (ri, len(WISE), scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
-                 plotfn, ps1, do_dsky, rchi_fraction))
-            coadd.acc(mm, delmm=delmm)
+                (ri, len(WISE), scanid, rr, _frame_refs(refs1, erefs1, epochs, ri),
+                 tinyw, plotfn, ps1, do_dsky, rchi_fraction))
+            coadd.acc(mm, delmm=delmm, ri=ri)
             masks.append(mm)
     else:
-        args = []
+        # Share the reference arrays with the workers through a file in
+        # shared memory rather than pickling them into every task.
+        refsfn = publish_round2_refs(*refs1)
+        erefsfn = None
+        if erefs1 is not None:
+            erefsfn = publish_round2_refs(*erefs1)
         N = len(WISE)
-        for ri,rr in enumerate(rimgs):
-            if ps and plots2:
-                plotfn = ps.getnext()
-            else:
-                plotfn = None
-            scanid = ('scan %s frame %i band %i' %
-                      (WISE.scan_id[ri], WISE.frame_num[ri], band))
-            args.append((ri, N, scanid, rr, cow1, cowimg1, cowimgsq1, tinyw,
-                         plotfn, ps1, do_dsky, rchi_fraction))
+        if store is not None:
+            # Read frames back from the store as tasks are handed out.
+            args = ((ri, N, ('scan %s frame %i band %i' %
+                             (WISE.scan_id[ri], WISE.frame_num[ri], band)),
+                     rimgs.take(ri), _frame_refs(refsfn, erefsfn, epochs, ri), tinyw,
+                     None, ps1, do_dsky, rchi_fraction)
+                    for ri in range(len(rimgs)))
+        else:
+            args = []
+            for ri in range(len(rimgs)):
+                if ps and plots2:
+                    plotfn = ps.getnext()
+                else:
+                    plotfn = None
+                scanid = ('scan %s frame %i band %i' %
+                          (WISE.scan_id[ri], WISE.frame_num[ri], band))
+                args.append((ri, N, scanid, rimgs.record(ri),
+                             _frame_refs(refsfn, erefsfn, epochs, ri), tinyw,
+                             plotfn, ps1, do_dsky, rchi_fraction))
         #masks = mp.map(_coadd_one_round2, args)
-        masks = mp2.map(_bounce_one_round2, args)
+        try:
+            masks = list(mp2.imap(_bounce_one_round2, args))
+            if memstats is not None:
+                # round-2 records held for accumulation
+                memstats.shm = max(memstats.shm, records_footprint())
+        finally:
+            os.unlink(refsfn)
+            if erefsfn is not None:
+                os.unlink(erefsfn)
         del args
         print 'Accumulating second-round coadds...'
         t0 = Time()
-        coadd = coaddacc(H, W, do_cube=do_cube, nims=len(rimgs), bgmatch=bgmatch,
-                         minmax=minmax)
-        for mm in masks:
-            coadd.acc(mm, delmm=delmm)
+        coadd = coaddacc(H, W, cube=cube, bgmatch=bgmatch,
+                         minmax=minmax, acc32=acc32, epochs=epochs,
+                         minmaxref=(coimg1, coppstd1))
+        if prior is not None:
+            coadd.add_sums(prior)
+        if (not do_cube and not minmax and
+            all([mm is None or isinstance(mm, tuple) for mm in masks])):
+            # Shard the accumulation by row stripes across the workers.
+            try:
+                coadd.acc_records(masks, mp2)
+            finally:
+                masks = [round2_from_record(mm, arrays=False)
+                         if mm is not None else None for mm in masks]
+        else:
+            masks = [_round2_result(mm) for mm in masks]
+            for ri,mm in enumerate(masks):
+                coadd.acc(mm, delmm=delmm, ri=ri)
         print Time()-t0
 
     coadd.finish()
+    rimgs.close()
+
+    if sums is not None:
+        # (coimg, coimgb are normalized in place below)
+        sums.cow1, sums.cowimg1, sums.cowimgsq1 = cow1, cowimg1, cowimgsq1
+        for k in coaddacc.arrays:
+            a = getattr(coadd, k)
+            if k in ['coimg', 'coimgb']:
+                a = a.copy()
+            setattr(sums, k, a)
 
     t0 = Time()
     print 'Before garbage collection:', Time()-t0
@@ -1734,48 +3826,19 @@ def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
                        cmap='gray', vmin=0, vmax=1)
             ps.savefig()
 
-    coimg    = coadd.coimg
-    coimgsq  = coadd.coimgsq
-    cow      = coadd.cow
-    con      = coadd.con
-    coimgb   = coadd.coimgb
-    coimgsqb = coadd.coimgsqb
-    cowb     = coadd.cowb
-    conb     = coadd.conb
-    cube     = coadd.cube
-
-    coimg /= np.maximum(cow, tinyw)
-    coinvvar = cow
-
-    coimgb /= np.maximum(cowb, tinyw)
-    coinvvarb = cowb
-
-    # per-pixel variance
-    coppstd  = np.sqrt(np.maximum(0, coimgsq  / 
-                                  np.maximum(cow,  tinyw) - coimg **2))
-    coppstdb = np.sqrt(np.maximum(0, coimgsqb /
-                                  np.maximum(cowb, tinyw) - coimgb**2))
-
-    # normalize by number of frames to produce an estimate of the
-    # stddev in the *coadd* rather than in the individual frames.
-    # This is the sqrt of the unbiased estimator of the variance
-    coppstd  /= np.sqrt(np.maximum(1., (con  - 1).astype(float)))
-    coppstdb /= np.sqrt(np.maximum(1., (conb - 1).astype(float)))
+    (coimg,  coinvvar,  coppstd,  con,
+     coimgb, coinvvarb, coppstdb, conb, sky) = coadd_products(coadd, tinyw)
 
-    # re-estimate and subtract sky from the coadd.  approx median:
-    #med = median_f(coimgb[::4,::4].astype(np.float32))
-    #sig1 = 1./np.sqrt(median_f(coinvvarb[::4,::4].astype(np.float32)))
-    try:
-        sky = estimate_mode(coimgb)
-        #sky = estimate_sky(coimgb, med-2.*sig1, med+1.*sig1, omit=None)
-        print 'Estimated coadd sky:', sky
-        coimg  -= sky
-        coimgb -= sky
-    except np.linalg.LinAlgError:
-        print 'WARNING: Failed to estimate sky in coadd:'
-        import traceback
-        traceback.print_exc()
-        sky = 0.
+    if epochout is not None:
+        epochout.coadds = []
+        for e,ec in enumerate(coadd.ecoadds):
+            if not np.any(ec.con):
+                print 'Epoch', e, ': no frames included'
+                epochout.coadds.append(None)
+                continue
+            print 'Epoch', e, ':'
+            epochout.coadds.append(coadd_products(ec, tinyw))
+        del coadd.ecoadds
 
 
     if ps:
@@ -1878,21 +3941,19 @@ def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
                 plt.title('Coadd %s' % tt)
                 ps.savefig()
 
-            plt.clf()
-            plt.imshow(((coimg * con) - (coadd.comin-sky) - (coadd.comax-sky)) / np.maximum(1, con-2),
-                       interpolation='nearest', origin='lower', cmap='gray',
-                       vmin=plo, vmax=phi)
-            plt.colorbar()
-            plt.title('Coadd - min,max')
-            ps.savefig()
-
-            plt.clf()
-            plt.imshow(((coimgb * conb) - (coadd.cominb-sky) - (coadd.comaxb-sky)) / np.maximum(1, conb-2),
-                       interpolation='nearest', origin='lower', cmap='gray',
-                       vmin=plo, vmax=phi)
-            plt.colorbar()
-            plt.title('Coadd - min,max (weighted)')
-            ps.savefig()
+            for k,tt in [('rejmean-u', 'Coadd - min,max'),
+                         ('rejmean-m', 'Coadd - min,max (weighted)'),
+                         ('med-u', 'Coadd median'),
+                         ('med-m', 'Coadd median (weighted)')]:
+                if not k in coadd.robust:
+                    continue
+                plt.clf()
+                plt.imshow(coadd.robust[k] - sky,
+                           interpolation='nearest', origin='lower', cmap='gray',
+                           vmin=plo, vmax=phi)
+                plt.colorbar()
+                plt.title(tt)
+                ps.savefig()
 
         plt.clf()
         I = coppstd
@@ -1926,8 +3987,68 @@ def coadd_wise(tile, cowcs, WISE, ps, band, mp1, mp2,
     return (coimg,  coinvvar,  coppstd,  con,
             coimgb, coinvvarb, coppstdb, conb,
             masks, cube, sky,
-            coadd.comin, coadd.comax, coadd.cominb, coadd.comaxb)
+            coadd.robust)
+
+
+def coadd_products(coadd, tinyw):
+    '''
+    Returns the outputs (coimg, coinvvar, coppstd, con, coimgb,
+    coinvvarb, coppstdb, conb, sky) of a finished coaddacc, normalizing
+    its image sums in place.  The coadd sky level *sky* is estimated and
+    subtracted from the images.
+    '''
+    coimg    = coadd.coimg
+    coimgsq  = coadd.coimgsq
+    cow      = coadd.cow
+    con      = coadd.con
+    coimgb   = coadd.coimgb
+    coimgsqb = coadd.coimgsqb
+    cowb     = coadd.cowb
+    conb     = coadd.conb
+
+    coimg, coinvvar, coppstd = coadd_finish_arrays(
+        coimg, coimgsq, cow, con, tinyw)
+    coimgb, coinvvarb, coppstdb = coadd_finish_arrays(
+        coimgb, coimgsqb, cowb, conb, tinyw)
+
+    # re-estimate and subtract sky from the coadd.  approx median:
+    #med = median_f(coimgb[::4,::4].astype(np.float32))
+    #sig1 = 1./np.sqrt(median_f(coinvvarb[::4,::4].astype(np.float32)))
+    try:
+        sky = estimate_mode(coimgb)
+        #sky = estimate_sky(coimgb, med-2.*sig1, med+1.*sig1, omit=None)
+        print 'Estimated coadd sky:', sky
+        coimg  -= sky
+        coimgb -= sky
+    except np.linalg.LinAlgError:
+        print 'WARNING: Failed to estimate sky in coadd:'
+        import traceback
+        traceback.print_exc()
+        sky = 0.
+
+    return (coimg,  coinvvar,  coppstd,  con,
+            coimgb, coinvvarb, coppstdb, conb, sky)
 
+coadd_sums_arrays = ['cow1', 'cowimg1', 'cowimgsq1'] + coaddacc.arrays
+
+def write_coadd_sums(fn, S):
+    '''
+    Writes the raw sums of a coadd -- round-1 sum w, w*img, w*img^2 and
+    round-2 sum w, w*img, w*img^2, n, unmasked and masked -- from
+    Duck *S* to a multi-extension FITS file.
+    '''
+    F = fitsio.FITS(fn, 'rw', clobber=True)
+    for k in coadd_sums_arrays:
+        F.write(getattr(S, k), extname=k.upper())
+    F.close()
+
+def read_coadd_sums(fn):
+    S = Duck()
+    F = fitsio.FITS(fn)
+    for k in coadd_sums_arrays:
+        setattr(S, k, F[k.upper()].read())
+    F.close()
+    return S
 
 def estimate_sky(img, lo, hi, omit=None, maxdev=0., return_fit=False):
     # Estimate sky level by: compute the histogram within [lo,hi], fit
@@ -2034,25 +4155,401 @@ def estimate_sky_2(img, lo=None, hi=None, plo=1, phi=70, bins1=30,
         return (x * xscale + x0, b, bfit, mx, warn, binedges1,counts1)
                 
 
-    return mx
+    return mx
+
+
+def _l1b_filenames(intfn):
+    '''
+    Returns the (int, unc, msk) filenames for the given L1b int file.
+    '''
+    uncfn = intfn.replace('-int-', '-unc-')
+    if unc_gz:
+        uncfn = uncfn + '.gz'
+    maskfn = intfn.replace('-int-', '-msk-')
+    if mask_gz:
+        maskfn = maskfn + '.gz'
+    return intfn, uncfn, maskfn
+
+def _read_l1b_frame((intfn, uncfn, maskfn)):
+    import time
+    t0 = time.time()
+    img,hdr = fitsio.read(intfn, header=True)
+    mask = fitsio.read(maskfn)
+    unc  = fitsio.read(uncfn )
+    return (img, hdr, mask, unc), time.time() - t0
+
+def prefetch_l1b_frames(fns, depth=4, maxmem=0, nthreads=2, stats=None):
+    '''
+    Generator that reads (and decompresses) L1b frames on a pool of I/O
+    threads, keeping up to *depth* frames -- and at most *maxmem* bytes
+    -- read ahead of the consumer.
+
+    *fns*: list of (intfn, uncfn, maskfn) tuples
+
+    Yields (img, header, mask, unc) in the order of *fns*.  If *stats*
+    (a Duck) is given, sets stats.tread (total read time, summed over
+    threads) and stats.twait (time the consumer spent waiting for
+    reads).
+    '''
+    import time
+    from multiprocessing.pool import ThreadPool
+    from collections import deque
+
+    if stats is None:
+        stats = Duck()
+    stats.tread = 0.
+    stats.twait = 0.
+    pool = ThreadPool(nthreads)
+    pending = deque()
+    fns = iter(fns)
+    framebytes = 0
+    try:
+        while True:
+            n = depth
+            if maxmem and framebytes:
+                n = max(1, min(depth, int(maxmem / framebytes)))
+            while len(pending) < n:
+                try:
+                    fn = fns.next()
+                except StopIteration:
+                    break
+                pending.append(pool.apply_async(_read_l1b_frame, (fn,)))
+            if len(pending) == 0:
+                break
+            t0 = time.time()
+            X,dt = pending.popleft().get()
+            stats.twait += time.time() - t0
+            stats.tread += dt
+            framebytes = max(framebytes, sum([x.nbytes for x in X if hasattr(x, 'nbytes')]))
+            yield X
+    finally:
+        pool.terminate()
+
+def frame_noise_seed(scan_id, frame_num, band):
+    '''
+    Returns a random seed derived from the frame identity, so that the
+    noise added to frames for sky estimation is reproducible.
+    '''
+    import zlib
+    return zlib.crc32('%s %i %i' % (scan_id, frame_num, band)) & 0xffffffff
+
+def l1b_maskbits(phase, band):
+    '''
+    Returns the L1b mask bits that mark a pixel as bad, for the given
+    mission phase and band.
+    '''
+    badbits = [0,1,2,3,4,5,6,7, 9, 
+               10,11,12,13,14,15,16,17,18,
+               21,26,27,28]
+    if phase == 3:
+        # 3-band cryo phase:
+        ## 19 pixel is "hard-saturated"
+        ## 23 for W3 only: static-split droop residual present
+        badbits.append(19)
+        if band == 3:
+            badbits.append(23)
+    return sum([1<<bit for bit in badbits])
+
+def _frame_stats_one((i, N, wise, intfn)):
+    '''
+    For multiprocessing, computes the full-frame sky and sig1 of one
+    L1b frame (as _coadd_one_round1 does, without median filtering).
+    '''
+    if i % 100 == 0:
+        print 'Frame stats', i+1, 'of', N
+    intfn,uncfn,maskfn = _l1b_filenames(intfn)
+    try:
+        img  = fitsio.read(intfn)
+        mask = fitsio.read(maskfn)
+        unc  = fitsio.read(uncfn )
+    except:
+        print 'Failed to read', intfn
+        return np.nan, np.nan
+    ok = ((mask & l1b_maskbits(wise.phase, wise.band)) == 0)
+    ok[unc == 0] = False
+    ok[np.logical_not(np.isfinite(img))] = False
+    ok[np.logical_not(np.isfinite(unc))] = False
+    if not np.any(ok):
+        return np.nan, np.nan
+    sig1 = median_f(unc[ok])
+    # add some noise to smooth out "dynacal" artifacts
+    fim = img[ok]
+    rng = np.random.RandomState(frame_noise_seed(wise.scan_id, wise.frame_num, wise.band))
+    fim += rng.normal(scale=sig1, size=fim.shape)
+    sky = estimate_mode(fim)
+    return sky, sig1
+
+def update_frame_stats(fn, WISE, mp):
+    '''
+    Adds to the per-frame statistics table *fn* (created if needed) the
+    full-frame sky and sig1 (in L1b image units) of the frames in table
+    *WISE* that it does not yet contain.  Like the WCS store, rows are
+    keyed by the "row" column and lookups use the last row for a frame.
+    '''
+    if os.path.exists(fn):
+        S = fits_table(fn, columns=['row'])
+        I = np.flatnonzero(lookup_wcs_store(S, WISE) < 0)
+    else:
+        I = np.arange(len(WISE))
+    print 'Updating frame stats', fn, 'with', len(I), 'of', len(WISE), 'frames'
+    for c0 in range(0, len(I), 1000):
+        J = I[c0:c0+1000]
+        args = []
+        for k,i in enumerate(J):
+            wise = WISE[i]
+            intfn = get_l1b_file(wisedir, wise.scan_id, wise.frame_num, wise.band)
+            for d in wisedirs:
+                fn1 = get_l1b_file(d, wise.scan_id, wise.frame_num, wise.band)
+                if os.path.exists(fn1):
+                    intfn = fn1
+                    break
+            args.append((c0+k, len(I), wise, intfn))
+        stats = np.array(mp.map(_frame_stats_one, args))
+        R = fits_table()
+        R.row = WISE.row[J]
+        R.scan_id = WISE.scan_id[J]
+        R.frame_num = WISE.frame_num[J]
+        R.band = WISE.band[J]
+        # (float64, as the sky is used in _coadd_one_round1)
+        R.sky = stats[:,0]
+        R.sig1 = stats[:,1].astype(np.float32)
+        R.cut(np.isfinite(R.sky) * np.isfinite(R.sig1))
+        # Write out in chunks, so we don't lose work.
+        append_table(fn, R)
+    print 'Wrote', fn
+
+def read_frame_stats(fn, WISE):
+    '''
+    Returns (sky, sig1) arrays from the frame statistics table *fn* for
+    the rows of table *WISE*, NaN for frames not in the table.
+    '''
+    S = fits_table(fn, columns=['row', 'sky', 'sig1'])
+    J = lookup_wcs_store(S, WISE)
+    print 'Found frame stats for', np.sum(J >= 0), 'of', len(WISE), 'frames'
+    sky  = np.where(J >= 0, S.sky [np.maximum(J, 0)], np.nan)
+    sig1 = np.where(J >= 0, S.sig1[np.maximum(J, 0)], np.nan)
+    return sky, sig1
+
+def _round1_frame_products(intfn, uncfn, maskfn, maskbits, medfilt, seed=None):
+    '''
+    Computes the tile-independent round-1 products for one L1b frame:
+    zeropoint, full-frame sig1, sky, the good-pixel mask, the
+    uncertainty image (for the sig1 of the sub-image overlapping a
+    tile), the median-filter background (if *medfilt*), and the
+    unpatched image.  The sub-image overlapping a tile is patched, and
+    then has the median-filter background subtracted, in
+    _coadd_one_round1, as without the cache.  *seed*: for the noise
+    added for sky estimation (see frame_noise_seed).
+
+    Returns a Duck.
+    '''
+    img,ihdr = fitsio.read(intfn, header=True)
+    mask = fitsio.read(maskfn)
+    unc  = fitsio.read(uncfn )
+
+    fr = Duck()
+    fr.zp = ihdr['MAGZP']
+    goodmask = ((mask & maskbits) == 0)
+    goodmask[unc == 0] = False
+    goodmask[np.logical_not(np.isfinite(img))] = False
+    goodmask[np.logical_not(np.isfinite(unc))] = False
+    fr.sig1 = median_f(unc[goodmask])
+    fr.unc = unc
+    del mask
+
+    fr.medfilt = None
+    fim = img[goodmask]
+    if medfilt:
+        # (masked pixels are ignored, so this does not depend on the
+        # patching done per tile)
+        mf = np.zeros_like(img)
+        median_smooth(img, np.logical_not(goodmask), int(medfilt), mf)
+        fim -= mf[goodmask]
+        fr.medfilt = mf
+
+    # add some noise to smooth out "dynacal" artifacts
+    fim += np.random.RandomState(seed).normal(scale=fr.sig1, size=fim.shape)
+    fr.sky = estimate_mode(fim)
+    del fim
+
+    fr.img = img
+    fr.goodmask = goodmask
+    return fr
+
+# Running estimate of the size of each frame cache directory in this
+# process, and the number of puts since it was last scanned, as
+# dirnm -> (size, nput); see framecache.added.  (Module-level, since
+# the framecache object is pickled into every worker task.)
+_framecache_sizes = {}
 
+class framecache():
+    '''
+    On-disk cache of the tile-independent round-1 products of L1b
+    frames (see _round1_frame_products), shared between the tiles a
+    frame overlaps.
+
+    Entries are keyed by the input files (path, size, modification
+    time) and the processing parameters, and are evicted least-recently
+    used first when the cache grows beyond *maxsize* bytes.  The
+    directory is only scanned when the running estimate of its size
+    exceeds *maxsize*, or every *rescan* puts (to count other
+    processes' entries); eviction goes down to *lowwater* * maxsize,
+    so that scans stay rare once the cache is full.
+    '''
+    version = 3
+    lowwater = 0.9
+    rescan = 100
+
+    def __init__(self, dirnm, maxsize=0):
+        self.dirnm = dirnm
+        self.maxsize = maxsize
+        trymakedirs(dirnm)
+
+    def key(self, fns, band, maskbits, medfilt):
+        import hashlib
+        h = hashlib.md5()
+        h.update('v%i band %i maskbits %i medfilt %i' %
+                 (self.version, band, maskbits, int(medfilt or 0)))
+        for fn in fns:
+            st = os.stat(fn)
+            h.update(' %s %i %i' % (os.path.abspath(fn), st.st_size,
+                                    int(st.st_mtime)))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.dirnm, key + '.fits')
+
+    def get(self, key):
+        fn = self.filename(key)
+        try:
+            F = fitsio.FITS(fn)
+            fr = Duck()
+            fr.img,hdr = F[0].read(header=True)
+            fr.goodmask = (F[1].read() > 0)
+            fr.unc = F[2].read()
+            fr.medfilt = None
+            if len(F) > 3:
+                fr.medfilt = F[3].read()
+            F.close()
+            fr.zp = hdr['MAGZP']
+            fr.sig1 = hdr['SIG1']
+            fr.sky = hdr['SKY']
+            # Mark as recently used
+            os.utime(fn, None)
+        except (IOError, OSError):
+            return None
+        return fr
+
+    def put(self, key, fr):
+        fn = self.filename(key)
+        hdr = fitsio.FITSHDR()
+        hdr.add_record(dict(name='MAGZP', value=fr.zp, comment='Zeropoint'))
+        hdr.add_record(dict(name='SIG1', value=fr.sig1, comment='Median uncertainty (full frame)'))
+        hdr.add_record(dict(name='SKY', value=fr.sky, comment='Estimated sky'))
+        # Write to a temp file in the same directory, then rename, so
+        # that other processes never see a partial entry.
+        f,tmpfn = tempfile.mkstemp(dir=self.dirnm, suffix='.tmp')
+        os.close(f)
+        os.unlink(tmpfn)
+        fitsio.write(tmpfn, fr.img, header=hdr)
+        fitsio.write(tmpfn, fr.goodmask.astype(np.uint8))
+        fitsio.write(tmpfn, fr.unc)
+        if fr.medfilt is not None:
+            fitsio.write(tmpfn, fr.medfilt)
+        os.rename(tmpfn, fn)
+        self.added(os.path.getsize(fn))
+
+    def added(self, nbytes):
+        if not self.maxsize:
+            return
+        est = _framecache_sizes.get(self.dirnm)
+        if est is not None:
+            size,nput = est
+            size += nbytes
+            nput += 1
+            _framecache_sizes[self.dirnm] = (size, nput)
+            if size <= self.maxsize and nput < self.rescan:
+                return
+        self.evict()
+
+    def evict(self):
+        '''
+        Scans the cache; if it is larger than *maxsize*, removes the
+        least-recently used entries down to *lowwater* * maxsize.
+        Resets the running size estimate.
+        '''
+        if not self.maxsize:
+            return
+        ents = []
+        for fn in os.listdir(self.dirnm):
+            if not fn.endswith('.fits'):
+                continue
+            path = os.path.join(self.dirnm, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ents.append((st.st_mtime, st.st_size, path))
+        ents.sort()
+        total = sum([sz for t,sz,path in ents])
+        if total > self.maxsize:
+            for t,sz,path in ents:
+                if total <= self.lowwater * self.maxsize:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # (another process got it first)
+                    pass
+                total -= sz
+        _framecache_sizes[self.dirnm] = (total, 0)
+
+    def get_frame(self, intfn, uncfn, maskfn, band, maskbits, medfilt, seed=None):
+        '''
+        Returns the round-1 products for the given frame, from the cache
+        or freshly computed (and cached).
+        '''
+        key = self.key([intfn, uncfn, maskfn], band, maskbits, medfilt)
+        fr = self.get(key)
+        if fr is not None:
+            print 'Frame cache hit:', key
+            return fr
+        fr = _round1_frame_products(intfn, uncfn, maskfn, maskbits, medfilt,
+                                    seed=seed)
+        if fr is not None:
+            self.put(key, fr)
+        return fr
+
+def _bounce_one_round1(A):
+    rr = _coadd_one_round1(A)
+    # In a worker process, hand the result back as a compact record.
+    if rr is None or A[5] is not None or not _in_worker():
+        return rr
+    return round1_record(rr)
 
 def _coadd_one_round1((i, N, wise, table, L, ps, band, cowcs, medfilt,
-                       do_check_md5)):
+                       do_check_md5, cache, pre, stats)):
     '''
     For multiprocessing, the function called to do round 1 on a single
     input frame.
+
+    *pre*: optional (img, header, mask, unc) already read by
+    prefetch_l1b_frames.
+
+    *stats*: optional (sky, sig1) for this frame from the frame
+    statistics table; if given, only the sub-image is read.
+
+    In every mode, the frame weight comes from the sig1 (median
+    uncertainty) of the sub-image overlapping the tile, and the sky
+    from the full frame, dithered with noise of the full-frame sig1, so
+    that the frame cache and statistics table give the same results.
     '''
+    import time
+    tc0 = time.time()
     t00 = Time()
     print
     print 'Coadd round 1, image', (i+1), 'of', N
-    intfn = wise.intfn
-    uncfn = intfn.replace('-int-', '-unc-')
-    if unc_gz:
-        uncfn = uncfn + '.gz'
-    maskfn = intfn.replace('-int-', '-msk-')
-    if mask_gz:
-        maskfn = maskfn + '.gz'
+    intfn,uncfn,maskfn = _l1b_filenames(wise.intfn)
     print 'intfn', intfn
     print 'uncfn', uncfn
     print 'maskfn', maskfn
@@ -2070,135 +4567,206 @@ def _coadd_one_round1((i, N, wise, table, L, ps, band, cowcs, medfilt,
         if not check_one_md5(wise):
             raise RuntimeError('MD5 check failed for ' + intfn + ' or unc/msk')
 
-    # We read the full images for sky-estimation purposes -- really necessary?
-    fullimg,ihdr = fitsio.read(intfn, header=True)
-    fullmask = fitsio.read(maskfn)
-    fullunc  = fitsio.read(uncfn )
-    img  = fullimg [slc]
-    mask = fullmask[slc]
-    unc  = fullunc [slc]
-
-    zp = ihdr['MAGZP']
-    zpscale = 1. / zeropointToScale(zp)
-    print 'Zeropoint:', zp, '-> scale', zpscale
-
-    if band == 4:
-        # In W4, the WISE single-exposure images are binned down
-        # 2x2, so we are effectively splitting each pixel into 4
-        # sub-pixels.  Spread out the flux.
-        zpscale *= 0.25
-
-    badbits = [0,1,2,3,4,5,6,7, 9, 
-               10,11,12,13,14,15,16,17,18,
-               21,26,27,28]
-    if wise.phase == 3:
-        # 3-band cryo phase:
-        ## 19 pixel is "hard-saturated"
-        ## 23 for W3 only: static-split droop residual present
-        badbits.append(19)
-        if band == 3:
-            badbits.append(23)
-
-    maskbits = sum([1<<bit for bit in badbits])
-    goodmask = ((mask & maskbits) == 0)
-    goodmask[unc == 0] = False
-    goodmask[np.logical_not(np.isfinite(img))] = False
-    goodmask[np.logical_not(np.isfinite(unc))] = False
+    maskbits = l1b_maskbits(wise.phase, band)
 
-    sig1 = median_f(unc[goodmask])
-    print 'sig1:', sig1
-    del mask
-    del unc
+    fr = None
+    if cache is not None and not ps:
+        # Tile-independent products from the frame cache.
+        fr = cache.get_frame(intfn, uncfn, maskfn, band, maskbits, medfilt,
+                             seed=frame_noise_seed(wise.scan_id, wise.frame_num, band))
+        if fr is None:
+            return None
 
-    # our return value (quack):
-    rr = Duck()
-    # Patch masked pixels so we can interpolate
-    rr.npatched = np.count_nonzero(np.logical_not(goodmask))
-    print 'Pixels to patch:', rr.npatched
-    # Many of the post-cryo frames have ~160,000 masked!
-    if rr.npatched > 200000:
-        print 'WARNING: too many pixels to patch:', rr.npatched
-        return None
-    ok = patch_image(img, goodmask.copy())
-    if not ok:
-        print 'WARNING: Patching failed:'
-        print 'Image size:', img.shape
-        print 'Number to patch:', rr.npatched
-        return None
-    assert(np.all(np.isfinite(img)))
+    if fr is None and stats is not None and not ps and not medfilt:
+        # Sky from the frame statistics table: read just the sub-image
+        # overlapping the coadd.
+        sky,nil = stats
+        F = fitsio.FITS(intfn)
+        img = F[0][slc]
+        zp = F[0].read_header()['MAGZP']
+        F.close()
+        F = fitsio.FITS(maskfn)
+        mask = F[0][slc]
+        F.close()
+        F = fitsio.FITS(uncfn)
+        unc = F[0][slc]
+        F.close()
+        goodmask = ((mask & maskbits) == 0)
+        goodmask[unc == 0] = False
+        goodmask[np.logical_not(np.isfinite(img))] = False
+        goodmask[np.logical_not(np.isfinite(unc))] = False
+        sig1 = median_f(unc[goodmask])
+        del mask
+        del unc
+        print 'sig1:', sig1
+        print 'Estimated sky:', sky
+
+        rr = Duck()
+        rr.npatched = np.count_nonzero(np.logical_not(goodmask))
+        print 'Pixels to patch:', rr.npatched
+        if rr.npatched > 200000:
+            print 'WARNING: too many pixels to patch:', rr.npatched
+            return None
+        if not patch_image(img, goodmask.copy()):
+            print 'WARNING: Patching failed:'
+            print 'Image size:', img.shape
+            print 'Number to patch:', rr.npatched
+            return None
+        assert(np.all(np.isfinite(img)))
+
+    elif fr is not None:
+        img = fr.img[slc].copy()
+        goodmask = fr.goodmask[slc]
+        sig1 = median_f(fr.unc[slc][goodmask])
+        sky = fr.sky
+        zp = fr.zp
+        print 'sig1:', sig1
+        print 'Estimated sky:', sky
+
+        # Patch the sub-image, then subtract the median-filter
+        # background, as below.
+        rr = Duck()
+        rr.npatched = np.count_nonzero(np.logical_not(goodmask))
+        print 'Pixels to patch:', rr.npatched
+        if rr.npatched > 200000:
+            print 'WARNING: too many pixels to patch:', rr.npatched
+            return None
+        if not patch_image(img, goodmask.copy()):
+            print 'WARNING: Patching failed:'
+            print 'Image size:', img.shape
+            print 'Number to patch:', rr.npatched
+            return None
+        assert(np.all(np.isfinite(img)))
+        if fr.medfilt is not None:
+            img -= fr.medfilt[slc]
+        del fr
+    else:
+        # We read the full images for sky-estimation purposes -- really necessary?
+        if pre is not None:
+            fullimg,ihdr,fullmask,fullunc = pre
+            del pre
+        else:
+            fullimg,ihdr = fitsio.read(intfn, header=True)
+            fullmask = fitsio.read(maskfn)
+            fullunc  = fitsio.read(uncfn )
+        zp = ihdr['MAGZP']
+        img  = fullimg [slc]
+        mask = fullmask[slc]
+        unc  = fullunc [slc]
+
+        goodmask = ((mask & maskbits) == 0)
+        goodmask[unc == 0] = False
+        goodmask[np.logical_not(np.isfinite(img))] = False
+        goodmask[np.logical_not(np.isfinite(unc))] = False
+
+        sig1 = median_f(unc[goodmask])
+        print 'sig1:', sig1
+        del mask
+        del unc
+
+        # our return value (quack):
+        rr = Duck()
+        # Patch masked pixels so we can interpolate
+        rr.npatched = np.count_nonzero(np.logical_not(goodmask))
+        print 'Pixels to patch:', rr.npatched
+        # Many of the post-cryo frames have ~160,000 masked!
+        if rr.npatched > 200000:
+            print 'WARNING: too many pixels to patch:', rr.npatched
+            return None
+        ok = patch_image(img, goodmask.copy())
+        if not ok:
+            print 'WARNING: Patching failed:'
+            print 'Image size:', img.shape
+            print 'Number to patch:', rr.npatched
+            return None
+        assert(np.all(np.isfinite(img)))
 
-    # Estimate sky level
-    fullok = ((fullmask & maskbits) == 0)
-    fullok[fullunc == 0] = False
-    fullok[np.logical_not(np.isfinite(fullimg))] = False
-    fullok[np.logical_not(np.isfinite(fullunc))] = False
+        # Estimate sky level
+        fullok = ((fullmask & maskbits) == 0)
+        fullok[fullunc == 0] = False
+        fullok[np.logical_not(np.isfinite(fullimg))] = False
+        fullok[np.logical_not(np.isfinite(fullunc))] = False
 
-    if medfilt:
-        tmf0 = Time()
-        mf = np.zeros_like(fullimg)
-        ok = median_smooth(fullimg, np.logical_not(fullok), int(medfilt), mf)
-        fullimg -= mf
-        img = fullimg[slc]
-        print 'Median filtering with box size', medfilt, 'took', Time()-tmf0
+        if medfilt:
+            tmf0 = Time()
+            mf = np.zeros_like(fullimg)
+            ok = median_smooth(fullimg, np.logical_not(fullok), int(medfilt), mf)
+            fullimg -= mf
+            img = fullimg[slc]
+            print 'Median filtering with box size', medfilt, 'took', Time()-tmf0
+            if ps:
+                # save for later (scaled to nanomaggies below)...
+                rr.medfilt = mf
+            del mf
+
+        # add some noise to smooth out "dynacal" artifacts (of the
+        # full-frame sig1, so that the sky is a property of the frame)
+        fim = fullimg[fullok]
+        rng = np.random.RandomState(frame_noise_seed(wise.scan_id, wise.frame_num, band))
+        fim += rng.normal(scale=median_f(fullunc[fullok]), size=fim.shape)
         if ps:
-            # save for later...
-            rr.medfilt = mf * zpscale
-        del mf
-        
-    # add some noise to smooth out "dynacal" artifacts
-    fim = fullimg[fullok]
-    fim += np.random.normal(scale=sig1, size=fim.shape) 
-    if ps:
-        vals,counts,fitcounts,sky,warn,be1,bc1 = estimate_mode(fim, return_fit=True)
-        rr.hist = np.histogram(fullimg[fullok], range=(vals[0],vals[-1]), bins=100)
-        rr.skyest = sky
-        rr.skyfit = (vals, counts, fitcounts)
+            vals,counts,fitcounts,sky,warn,be1,bc1 = estimate_mode(fim, return_fit=True)
+            rr.hist = np.histogram(fullimg[fullok], range=(vals[0],vals[-1]), bins=100)
+            rr.skyest = sky
+            rr.skyfit = (vals, counts, fitcounts)
         
-        if warn:
-            # Background estimation plot
-            plt.clf()
+            if warn:
+                # Background estimation plot
+                plt.clf()
 
-            # first-round histogram
-            ee1 = be1.repeat(2)[1:-1]
-            nn1 = bc1.repeat(2)
-            plt.plot(ee1, nn1, 'b-', alpha=0.5)
+                # first-round histogram
+                ee1 = be1.repeat(2)[1:-1]
+                nn1 = bc1.repeat(2)
+                plt.plot(ee1, nn1, 'b-', alpha=0.5)
+
+                # full-image histogram
+                n,e = rr.hist
+                ee = e.repeat(2)[1:-1]
+                nn = n.repeat(2)
+                plt.plot(ee, nn, 'm-', alpha=0.5)
+
+                # extended range
+                n,e = np.histogram(fim, range=(np.percentile(fim, 1),
+                                               np.percentile(fim, 90)), bins=100)
+                ee = e.repeat(2)[1:-1]
+                nn = n.repeat(2)
+                plt.plot(ee, nn, 'g-', alpha=0.5)
+
+                plt.twinx()
+                plt.plot(vals, counts, 'm-', alpha=0.5)
+                plt.plot(vals, fitcounts, 'r-', alpha=0.5)
+                plt.axvline(sky, color='r')
+                plt.title('%s %i' % (wise.scan_id, wise.frame_num))
+                ps.savefig()
 
-            # full-image histogram
-            n,e = rr.hist
-            ee = e.repeat(2)[1:-1]
-            nn = n.repeat(2)
-            plt.plot(ee, nn, 'm-', alpha=0.5)
+                plt.xlim(ee1[0], ee1[-1])
+                ps.savefig()
+            
 
-            # extended range
-            n,e = np.histogram(fim, range=(np.percentile(fim, 1),
-                                           np.percentile(fim, 90)), bins=100)
-            ee = e.repeat(2)[1:-1]
-            nn = n.repeat(2)
-            plt.plot(ee, nn, 'g-', alpha=0.5)
+        else:
+            sky = estimate_mode(fim)
 
-            plt.twinx()
-            plt.plot(vals, counts, 'm-', alpha=0.5)
-            plt.plot(vals, fitcounts, 'r-', alpha=0.5)
-            plt.axvline(sky, color='r')
-            plt.title('%s %i' % (wise.scan_id, wise.frame_num))
-            ps.savefig()
+        print 'Estimated sky:', sky
+        print 'Image median:', np.median(fullimg[fullok])
+        print 'Image median w/ noise:', np.median(fim)
 
-            plt.xlim(ee1[0], ee1[-1])
-            ps.savefig()
-            
+        del fim
+        del fullunc
+        del fullok
+        del fullimg
+        del fullmask
 
-    else:
-        sky = estimate_mode(fim)
+    zpscale = 1. / zeropointToScale(zp)
+    print 'Zeropoint:', zp, '-> scale', zpscale
 
-    print 'Estimated sky:', sky
-    print 'Image median:', np.median(fullimg[fullok])
-    print 'Image median w/ noise:', np.median(fim)
+    if band == 4:
+        # In W4, the WISE single-exposure images are binned down
+        # 2x2, so we are effectively splitting each pixel into 4
+        # sub-pixels.  Spread out the flux.
+        zpscale *= 0.25
 
-    del fim
-    del fullunc
-    del fullok
-    del fullimg
-    del fullmask
+    if ps and medfilt:
+        rr.medfilt *= zpscale
 
     # Convert to nanomaggies
     img -= sky
@@ -2274,38 +4842,652 @@ def _coadd_one_round1((i, N, wise, table, L, ps, band, cowcs, medfilt,
         ps.savefig()
 
     print Time() - t00
+    rr.tcompute = time.time() - tc0
+    rr.peakmem = get_peak_mem()
+    return rr
+
+
+def pack_mask_bits(mask, nbits):
+    '''
+    Bit-packs the lowest *nbits* bit planes of uint8 (or bool) array
+    *mask*; see unpack_mask_bits.
+    '''
+    m = mask.ravel().astype(np.uint8)
+    return np.hstack([np.packbits((m >> b) & 1) for b in range(nbits)])
+
+def unpack_mask_bits(packed, shape, nbits, rows=None):
+    '''
+    Inverse of pack_mask_bits for a mask of *shape*; with *rows* =
+    (r0,r1), only those rows are unpacked.
+    '''
+    n = int(np.prod(shape))
+    nb = (n + 7) / 8
+    i0,i1 = 0,n
+    if rows is not None:
+        r0,r1 = rows
+        i0,i1 = r0 * shape[1], r1 * shape[1]
+        shape = (r1 - r0, shape[1])
+    b0,b1 = i0 / 8, (i1 + 7) / 8
+    mask = np.zeros(i1 - i0, np.uint8)
+    for b in range(nbits):
+        bits = np.unpackbits(packed[b*nb + b0: b*nb + b1])
+        mask |= (bits[i0 - b0*8: i1 - b0*8] << b)
+    return mask.reshape(shape)
+
+def wcs_to_params(wcs):
+    '''
+    Serializes a Tan or Sip WCS into a flat float64 array; see
+    wcs_from_params.
+    '''
+    sip = hasattr(wcs, 'wcstan')
+    tan = wcs
+    if sip:
+        tan = wcs.wcstan
+    p = ([float(sip), wcs.get_width(), wcs.get_height()] +
+         list(tan.crval[:2]) + list(tan.crpix[:2]) + list(tan.cd[:4]) +
+         [float(tan.sin)])
+    nt = len(sip_store_terms)
+    if not sip:
+        return np.array(p + [0.] * (4 + 4*nt))
+    orders = [wcs.a_order, wcs.b_order, wcs.ap_order, wcs.bp_order]
+    assert(max(orders) <= sip_store_maxorder)
+    p += orders
+    for order,get in [(wcs.a_order,  wcs.get_a_term),
+                      (wcs.b_order,  wcs.get_b_term),
+                      (wcs.ap_order, wcs.get_ap_term),
+                      (wcs.bp_order, wcs.get_bp_term)]:
+        p += [get(pp,q) if pp+q <= order else 0. for pp,q in sip_store_terms]
+    return np.array(p)
+
+def wcs_from_params(p):
+    tan = Tan(*([float(x) for x in p[3:11]] + [float(p[1]), float(p[2])]))
+    tan.sin = bool(p[11])
+    if not p[0]:
+        return tan
+    wcs = Sip(tan)
+    wcs.a_order, wcs.b_order, wcs.ap_order, wcs.bp_order = [
+        int(x) for x in p[12:16]]
+    nt = len(sip_store_terms)
+    for k,(order,set_term) in enumerate([(wcs.a_order,  wcs.set_a_term),
+                                         (wcs.b_order,  wcs.set_b_term),
+                                         (wcs.ap_order, wcs.set_ap_term),
+                                         (wcs.bp_order, wcs.set_bp_term)]):
+        terms = p[16 + k*nt: 16 + (k+1)*nt]
+        for (pp,q),t in zip(sip_store_terms, terms):
+            if pp + q <= order:
+                set_term(pp, q, float(t))
+    return wcs
+
+# Record buffer files of this job (see pack_record) are named with this
+# prefix, which includes the process id of the job (set on import, so
+# forked worker processes share it).  Tmpfs is RAM, so the records are
+# counted in the memory model (see fit_memory_model), and are swept up
+# when the job exits or a tile fails, and when the job that wrote them
+# is gone (see sweep_records).
+record_pid = os.getpid()
+record_prefix = 'unwise-rec-%i-' % record_pid
+
+def record_dir():
+    # shared memory, where available
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def _record_files(stale=False):
+    '''
+    Returns the record buffer files of this job or, with *stale*, those
+    of jobs that no longer run.
+    '''
+    import errno
+    dirnm = record_dir()
+    fns = []
+    for fn in os.listdir(dirnm):
+        if not fn.startswith('unwise-rec-'):
+            continue
+        try:
+            pid = int(fn.split('-')[2])
+        except ValueError:
+            continue
+        if stale:
+            if pid == record_pid:
+                continue
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    continue
+        elif pid != record_pid:
+            continue
+        fns.append(os.path.join(dirnm, fn))
+    return fns
+
+def records_footprint():
+    '''
+    Returns the size in GB of this job's record buffer files.
+    '''
+    total = 0
+    for fn in _record_files():
+        try:
+            total += os.path.getsize(fn)
+        except OSError:
+            pass
+    return total / 1e9
+
+def sweep_records(stale=False):
+    '''
+    Removes this job's record buffer files or, with *stale*, those left
+    by jobs that were killed.
+    '''
+    if os.getpid() != record_pid:
+        # (not in worker processes)
+        return
+    fns = _record_files(stale=stale)
+    if len(fns):
+        print 'Removing', len(fns), ('stale' if stale else 'leftover'), 'record files'
+    for fn in fns:
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+atexit.register(sweep_records)
+
+def pack_record(arrays, scalars, dirnm=None):
+    '''
+    Writes the (name, array) pairs *arrays* into one buffer file -- in
+    shared memory (/dev/shm) where available; see record_prefix -- and
+    returns a compact record (filename, layout, scalars) that pickles to
+    a few hundred bytes.  *scalars* is a dict of numbers.  See
+    unpack_record, free_record.
+    '''
+    if dirnm is None:
+        dirnm = record_dir()
+    f,fn = tempfile.mkstemp(dir=dirnm, prefix=record_prefix, suffix='.dat')
+    f = os.fdopen(f, 'wb')
+    layout = []
+    offset = 0
+    for name,a in arrays:
+        a = np.ascontiguousarray(a)
+        layout.append((name, a.dtype.str, a.shape, offset))
+        a.tofile(f)
+        offset += a.nbytes
+    f.close()
+    return (fn, layout, scalars)
+
+def unpack_record(rec, mode='c'):
+    '''
+    Memory-maps the arrays of record *rec* (copy-on-write by default;
+    mode='r+' to write through to the buffer).  Returns (dict of arrays,
+    dict of scalars).
+    '''
+    fn,layout,scalars = rec
+    arrays = {}
+    for name,dt,shape,offset in layout:
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dt)
+        else:
+            arrays[name] = np.memmap(fn, dtype=dt, mode=mode, offset=offset,
+                                     shape=shape)
+    return arrays, scalars
+
+def free_record(rec):
+    try:
+        os.unlink(rec[0])
+    except OSError:
+        pass
+
+def _in_worker():
+    import multiprocessing
+    return multiprocessing.current_process().name != 'MainProcess'
+
+round1_record_scalars = ['w', 'sky', 'zpscale', 'zp', 'ncopix', 'npatched',
+                         'tcompute', 'peakmem', 'bgmatch']
+
+def round1_record(rr):
+    '''
+    Converts a round-1 result (without plotting extras) into a compact
+    record: float32 image, bit-packed mask, serialized WCSes and scalars.
+    '''
+    if rr is None:
+        return None
+    scalars = dict([(k, getattr(rr, k)) for k in round1_record_scalars
+                    if hasattr(rr, k)])
+    scalars.update(coextent=[int(x) for x in rr.coextent])
+    return pack_record([('rimg', rr.rimg.astype(np.float32)),
+                        ('rmask', pack_mask_bits(rr.rmask, 2)),
+                        ('wcs', wcs_to_params(rr.wcs)),
+                        ('cosubwcs', wcs_to_params(rr.cosubwcs))], scalars)
+
+def round1_from_record(rec, mode='c'):
+    '''
+    Rebuilds a round-1 result from its record; rr.record is set to
+    *rec*.
+    '''
+    A,scalars = unpack_record(rec, mode=mode)
+    rr = Duck()
+    for k,v in scalars.items():
+        setattr(rr, k, v)
+    rr.rimg = A['rimg']
+    rr.rmask = unpack_mask_bits(A['rmask'], rr.rimg.shape, 2)
+    rr.wcs = wcs_from_params(A['wcs'])
+    rr.cosubwcs = wcs_from_params(A['cosubwcs'])
+    rr.record = rec
     return rr
 
+round2_record_scalars = ['npatched', 'ncopix', 'sky', 'zp', 'w', 'included',
+                         'nrchipix', 'dsky']
+
+def round2_record(mm):
+    '''
+    Converts a round-2 result (without plotting extras) into a compact
+    record.  Only the patched image and the masks are kept; the
+    accumulation arrays are rebuilt by round2_from_record.
+    '''
+    if mm is None:
+        return None
+    scalars = dict([(k, getattr(mm, k)) for k in round2_record_scalars])
+    arrays = [('omask', pack_mask_bits(mm.omask, 2))]
+    scalars.update(omask_shape=mm.omask.shape)
+    em = getattr(mm, 'epoch', None)
+    for m in [mm, em]:
+        if m is not None and m.included:
+            sy,sx = m.coslc
+            scalars.update(coextent=[sx.start, sx.stop-1, sy.start, sy.stop-1])
+    if mm.included:
+        arrays += [('rimg', mm.rimg),
+                   ('masks', pack_mask_bits(mm.con + 2*mm.rmask2, 2))]
+    if em is not None:
+        # The epoch result (see _round2_epoch)
+        scalars.update(eincluded=em.included)
+        if em.included:
+            arrays += [('erimg', em.rimg),
+                       ('emasks', pack_mask_bits(em.con + 2*em.rmask2, 2))]
+    return pack_record(arrays, scalars)
+
+# Rows of round-2 frames are processed in blocks of about this many
+# pixels, so that the temporaries stay in cache.
+round2_block_pixels = 16384
+
+def _row_blocks(H, W, blockpix=None):
+    if blockpix is None:
+        blockpix = round2_block_pixels
+    n = max(1, blockpix // max(W, 1))
+    for y0 in range(0, H, n):
+        yield slice(y0, min(H, y0 + n))
+
+def _round2_loo_mean(rimg, w, cow1, cowimg1, tinyw):
+    subw  = np.maximum(cow1 - w, tinyw)
+    subco = (cowimg1   - (w * rimg   )) / subw
+    return subw, subco
+
+def _round2_loo(rimg, w, cow1, cowimg1, cowimgsq1, tinyw):
+    '''
+    Removes a frame (image *rimg*, weight *w*) from the round-1 sums,
+    returning the leave-one-out weight (subw), mean (subco) and noise
+    estimate (subpp).  Works elementwise, so it can be called on blocks
+    of rows.
+    '''
+    # Remove this image from the per-pixel std calculation...
+    subw,subco = _round2_loo_mean(rimg, w, cow1, cowimg1, tinyw)
+    subsq = (cowimgsq1 - (w * rimg**2)) / subw
+    subv = np.maximum(0, subsq - subco**2)
+    # previously, no prior:
+    # subp = np.sqrt(np.maximum(0, subsq - subco**2))
+
+    # "prior" estimate of per-pixel noise: sig1 + 3% flux in quadrature
+    # w = 1./sig1**2 for this image.
+    priorv = 1./w + (0.03 * np.maximum(subco, 0))**2
+    # Weight that prior equal to the 'subv' estimate from nprior exposures
+    nprior = 5
+    priorw = nprior * w
+    subpp = np.sqrt((subv * subw + priorv * priorw) / (subw + priorw))
+    return subw, subco, subpp
+
+def _round2_rchi(rimg, mask, dsky, subw, subco, subpp):
+    return ((rimg - dsky - subco) * mask * (subw > 0) * (subpp > 0) /
+            np.maximum(subpp, 1e-6))
+
+def round2_rchi(rimg, mask, w, refs, tinyw, do_dsky):
+    '''
+    Round-2 outlier statistics of a frame: image *rimg*, good-pixel
+    *mask*, weight *w*, against the round-1 sums *refs* = (cow1,
+    cowimg1, cowimgsq1) cut out to the frame's extent.
+
+    Returns (dsky, subco, subpp, rchi), with full-size arrays; see
+    round2_badpix_blocked for the version used when not plotting.
+    '''
+    cow1,cowimg1,cowimgsq1 = refs
+    subw,subco,subpp = _round2_loo(rimg, w, cow1, cowimg1, cowimgsq1, tinyw)
+    # like in the WISE Atlas Images, estimate sky difference via
+    # median difference in the overlapping area.
+    if do_dsky:
+        dsky = median_f((rimg[mask] - subco[mask]).astype(np.float32))
+    else:
+        dsky = 0.
+    rchi = _round2_rchi(rimg, mask, dsky, subw, subco, subpp)
+    assert(np.all(np.isfinite(rchi)))
+    return dsky, subco, subpp, rchi
+
+def round2_badpix_blocked(rimg, mask, w, refs, tinyw, do_dsky, blockpix=None):
+    '''
+    Same as round2_rchi, but computed in blocks of rows that fit in
+    cache, returning only (dsky, badpix), where badpix = |rchi| >= 5.
+    The results are identical, without a dozen full-size temporaries.
+    '''
+    cow1,cowimg1,cowimgsq1 = refs
+    H,W = rimg.shape
+    blocks = list(_row_blocks(H, W, blockpix))
+    dsky = 0.
+    if do_dsky:
+        # First pass: the median difference needs subco everywhere.
+        diff = np.empty(np.count_nonzero(mask), np.float32)
+        i = 0
+        for b in blocks:
+            m = mask[b]
+            subw,subco = _round2_loo_mean(rimg[b], w, cow1[b], cowimg1[b],
+                                          tinyw)
+            n = np.count_nonzero(m)
+            diff[i:i+n] = rimg[b][m] - subco[m]
+            i += n
+        dsky = median_f(diff)
+        del diff
+    badpix = np.empty((H,W), bool)
+    for b in blocks:
+        subw,subco,subpp = _round2_loo(rimg[b], w, cow1[b], cowimg1[b],
+                                       cowimgsq1[b], tinyw)
+        rchi = _round2_rchi(rimg[b], mask[b], dsky, subw, subco, subpp)
+        assert(np.all(np.isfinite(rchi)))
+        np.greater_equal(np.abs(rchi), 5., out=badpix[b])
+    return dsky, badpix
+
+def round2_contributions(rimg, mask, w, blockpix=None):
+    '''
+    Returns a round-2 frame's masked, weighted contributions to the
+    coadd sums: (mask * w * rimg**2, mask * w * rimg, mask * w),
+    computed in blocks of rows into preallocated arrays.
+    '''
+    H,W = rimg.shape
+    # (result types, as for the full-size expressions)
+    m1,r1 = mask[:1,:1], rimg[:1,:1]
+    out = [np.empty((H,W), (m1 * w * r1**2).dtype),
+           np.empty((H,W), (m1 * w * r1).dtype),
+           np.empty((H,W), (m1 * w).dtype)]
+    coimgsq,coimg,cow = out
+    for b in _row_blocks(H, W, blockpix):
+        cow[b] = mask[b] * w
+        coimg[b] = cow[b] * rimg[b]
+        coimgsq[b] = cow[b] * rimg[b]**2
+    return coimgsq, coimg, cow
+
+def _round2_acc_arrays(rimg, masks, w):
+    # (as in _coadd_one_round2)
+    mask = (masks & 1).astype(bool)
+    return round2_contributions(rimg, mask, w) + (mask,
+                                                  (masks & 2).astype(bool))
+
+def round2_from_record(rec, arrays=True):
+    '''
+    Rebuilds a round-2 result from its record, and frees the record.
+    With arrays=False, the accumulation arrays are not rebuilt (see
+    coaddacc.acc_records).
+    '''
+    A,scalars = unpack_record(rec)
+    mm = Duck()
+    for k,v in scalars.items():
+        setattr(mm, k, v)
+    mm.omask = unpack_mask_bits(A['omask'], mm.omask_shape, 2)
+    del mm.omask_shape
+    coslc = None
+    if hasattr(mm, 'coextent'):
+        x0,x1,y0,y1 = mm.coextent
+        del mm.coextent
+        coslc = slice(y0, y1+1), slice(x0, x1+1)
+    if mm.included:
+        mm.coslc = coslc
+    if mm.included and arrays:
+        rimg = np.array(A['rimg'])
+        masks = unpack_mask_bits(A['masks'], rimg.shape, 2)
+        (mm.coimgsq, mm.coimg, mm.cow, mm.con,
+         mm.rmask2) = _round2_acc_arrays(rimg, masks, mm.w)
+    if hasattr(mm, 'eincluded'):
+        em = Duck()
+        em.w = mm.w
+        em.included = mm.eincluded
+        del mm.eincluded
+        if em.included:
+            em.coslc = coslc
+        if em.included and arrays:
+            rimg = np.array(A['erimg'])
+            masks = unpack_mask_bits(A['emasks'], rimg.shape, 2)
+            (em.coimgsq, em.coimg, em.cow, em.con,
+             em.rmask2) = _round2_acc_arrays(rimg, masks, em.w)
+        mm.epoch = em
+    del A
+    free_record(rec)
+    return mm
+
+def _round2_result(mm):
+    if isinstance(mm, tuple):
+        return round2_from_record(mm)
+    return mm
+
+class round1store():
+    '''
+    Holds the round-1 results ("rr" Ducks, or None for frames that
+    failed) of a tile's frames, in input order, until round 2 is done
+    with them.  Results that arrived from a worker as a compact record
+    (see round1_record) are kept in that form.
+    '''
+    def __init__(self):
+        self.rr = []
+
+    def add(self, rr):
+        if rr is not None and hasattr(rr, 'record'):
+            rr = rr.record
+        self.rr.append(rr)
+
+    def __len__(self):
+        return len(self.rr)
+
+    def __getitem__(self, i):
+        rr = self.rr[i]
+        if isinstance(rr, tuple):
+            rr = round1_from_record(rr)
+        return rr
+
+    def record(self, i):
+        '''
+        Returns frame *i* in the form to send to a round-2 worker: the
+        compact record if there is one.
+        '''
+        rr = self.rr[i]
+        if isinstance(rr, tuple):
+            return rr
+        return self[i]
+
+    def take(self, i):
+        '''
+        Returns frame *i* and releases it from the store.
+        '''
+        rr = self[i]
+        if isinstance(self.rr[i], tuple):
+            free_record(self.rr[i])
+        self.rr[i] = None
+        return rr
+
+    def close(self):
+        for rr in self.rr:
+            if isinstance(rr, tuple):
+                free_record(rr)
+        self.rr = []
+
+class round1metastore(round1store):
+    '''
+    A round1store that keeps only the per-frame scalar values (weight,
+    sky, bgmatch offset, ...), dropping the resampled arrays; round 2
+    then recomputes the round-1 frames (see coadd_wise *lowmem*).
+    '''
+    def add(self, rr):
+        if rr is None:
+            self.rr.append(None)
+            return
+        meta = Duck()
+        for k,v in rr.__dict__.items():
+            if k == 'record':
+                free_record(v)
+            elif not isinstance(v, np.ndarray) or v.size <= 4:
+                setattr(meta, k, v)
+        self.rr.append(meta)
+
+class round1diskstore(round1store):
+    '''
+    A round1store that writes each frame's resampled image and mask to
+    a scratch file in directory *dirnm*, and memory-maps them back
+    (copy-on-write) one frame at a time; only the small per-frame values
+    and the offset index stay in memory.
+    '''
+    arrays = ['rimg', 'rmask']
+
+    def __init__(self, dirnm, prefix='round1-'):
+        round1store.__init__(self)
+        trymakedirs(dirnm)
+        f,self.fn = tempfile.mkstemp(dir=dirnm, prefix=prefix, suffix='.dat')
+        self.f = os.fdopen(f, 'wb')
+        self.offset = 0
+
+    def add(self, rr):
+        if rr is None:
+            self.rr.append(None)
+            return
+        meta = Duck()
+        meta.__dict__.update(rr.__dict__)
+        rec = meta.__dict__.pop('record', None)
+        meta.index = []
+        for c in self.arrays:
+            a = np.ascontiguousarray(getattr(meta, c))
+            delattr(meta, c)
+            meta.index.append((c, self.offset, a.dtype.str, a.shape))
+            a.tofile(self.f)
+            self.offset += a.nbytes
+        self.rr.append(meta)
+        if rec is not None:
+            free_record(rec)
+
+    def __getitem__(self, i):
+        meta = self.rr[i]
+        if meta is None:
+            return None
+        if self.f is not None:
+            self.f.flush()
+        rr = Duck()
+        rr.__dict__.update(meta.__dict__)
+        del rr.index
+        for c,offset,dt,shape in meta.index:
+            if np.prod(shape) == 0:
+                a = np.zeros(shape, dt)
+            else:
+                a = np.memmap(self.fn, dtype=dt, mode='c', offset=offset,
+                              shape=shape)
+            setattr(rr, c, a)
+        return rr
+
+    def close(self):
+        round1store.close(self)
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.fn):
+            os.unlink(self.fn)
+
+def _round1_stats(WISE, medfilt):
+    '''
+    Returns the per-frame (sky, sig1) from the frame statistics table
+    columns of *WISE* (see read_frame_stats), or None, for each frame.
+    '''
+    stats = [None] * len(WISE)
+    if 'frame_sky' in WISE.get_columns() and not medfilt:
+        stats = [(sky,sig1) if np.isfinite(sky) and np.isfinite(sig1) else None
+                 for sky,sig1 in zip(WISE.frame_sky, WISE.frame_sig1)]
+    return stats
 
 def _coadd_wise_round1(cowcs, WISE, ps, band, table, L, tinyw, mp, medfilt,
-                       checkmd5, bgmatch, cube1):
+                       checkmd5, bgmatch, cube1, cache=None, prefetch=None,
+                       store=None, acc32=False, epochs=None, esums=None):
                        
     '''
     Do round-1 coadd.
+
+    Returns the per-frame results in *store* (a round1store, created if
+    not given), along with the round-1 coadd arrays.
+
+    *prefetch*: optional dict of arguments for prefetch_l1b_frames, to
+    read input frames ahead on I/O threads.
+
+    *acc32*: accumulate in float32 (see coaddacc).
+
+    *cube1*: optional file name to which the frames are written as an
+    image cube (see cubewriter); the closed cubewriter is returned.
+
+    *epochs*: optional epoch number of each frame; *esums* (a Duck) is
+    then filled with the per-epoch sums cow, cowimg and cowimgsq, as
+    float64 arrays of shape (nepochs, H, W).
     '''
     W = cowcs.get_width()
     H = cowcs.get_height()
-    coimg   = np.zeros((H,W))
-    coimgsq = np.zeros((H,W))
-    cow     = np.zeros((H,W))
+    dt = np.float32 if acc32 else float
+    coimg   = np.zeros((H,W), dt)
+    coimgsq = np.zeros((H,W), dt)
+    cow     = np.zeros((H,W), dt)
+    if acc32:
+        # Kahan compensation term
+        coimgsqc = np.zeros((H,W), dt)
+    if epochs is not None:
+        E = (max(epochs) + 1) if len(epochs) else 0
+        esums.cow      = np.zeros((E,H,W))
+        esums.cowimg   = np.zeros((E,H,W))
+        esums.cowimgsq = np.zeros((E,H,W))
+
+    stats = _round1_stats(WISE, medfilt)
+    nstats = len([x for x in stats if x is not None])
+    if nstats:
+        print 'Reading sub-images for', nstats, 'frames with frame stats'
+
+    tr0 = Time()
+    iostats = None
+    if prefetch and (cache is None or ps) and nstats == 0:
+        from itertools import izip
+        iostats = Duck()
+        reads = prefetch_l1b_frames([_l1b_filenames(intfn) for intfn in WISE.intfn],
+                                    stats=iostats, **prefetch)
+        args = ((wi, len(WISE), wise, table, L, ps, band, cowcs, medfilt,
+                 checkmd5, cache, pre, None)
+                for (wi,wise),pre in izip(enumerate(WISE), reads))
+    else:
+        args = []
+        for wi,wise in enumerate(WISE):
+            args.append((wi, len(WISE), wise, table, L, ps, band, cowcs, medfilt,
+                         checkmd5, cache, None, stats[wi]))
 
-    args = []
-    for wi,wise in enumerate(WISE):
-        args.append((wi, len(WISE), wise, table, L, ps, band, cowcs, medfilt,
-                     checkmd5))
-    rimgs = mp.map(_coadd_one_round1, args)
-    del args
+    if store is None:
+        store = round1store()
+    rimgs = store
 
-    print 'Accumulating first-round coadds...'
+    # Accumulate the first-round coadds as frames finish (in input
+    # order, so that bgmatch is deterministic), handing each one to
+    # the round-2 store.
     cube = None
     if cube1:
-        cube = np.zeros((len([rr for rr in rimgs if rr is not None]), H, W),
-                        np.float32)
-        z = 0
-    t0 = Time()
-    for wi,rr in enumerate(rimgs):
+        cube = cubewriter(cube1, H, W)
+    tcompute = 0.
+    for wi,rr in enumerate(mp.imap(_bounce_one_round1, args)):
         if rr is None:
+            rimgs.add(rr)
             continue
+        if isinstance(rr, tuple):
+            # bgmatch edits write through to the record's buffer.
+            rr = round1_from_record(rr, mode='r+')
+        tcompute += rr.tcompute
         cox0,cox1,coy0,coy1 = rr.coextent
         slc = slice(coy0,coy1+1), slice(cox0,cox1+1)
 
@@ -2319,16 +5501,28 @@ def _coadd_wise_round1(cowcs, WISE, ps, band, table, L, tinyw, mp, medfilt,
                 print 'Matched bg:', bg
                 rr.rimg[(rr.rmask & 1) > 0] += bg
                 rr.bgmatch = bg
-                
+            if hasattr(rr, 'record'):
+                rr.record[2]['bgmatch'] = rr.bgmatch
+
         # note, rr.w is a scalar.
-        coimgsq[slc] += rr.w * (rr.rimg**2)
+        if acc32:
+            kahan_add(coimgsq[slc], coimgsqc[slc], rr.w * (rr.rimg**2))
+        else:
+            coimgsq[slc] += rr.w * (rr.rimg**2)
         coimg  [slc] += rr.w *  rr.rimg
         cow    [slc] += rr.w * (rr.rmask & 1)
+        if epochs is not None:
+            e = epochs[wi]
+            esums.cowimgsq[e][slc] += rr.w * (rr.rimg**2)
+            esums.cowimg  [e][slc] += rr.w *  rr.rimg
+            esums.cow     [e][slc] += rr.w * (rr.rmask & 1)
 
         if cube1:
-            cube[(z,)+slc] = rr.rimg.astype(np.float32)
-            z += 1
-            
+            cube.add(rr.rimg, slc, wi)
+
+        rimgs.add(rr)
+        del rr
+
         # if ps:
         #     # Show the coadd as it's accumulated
         #     plt.clf()
@@ -2338,13 +5532,22 @@ def _coadd_wise_round1(cowcs, WISE, ps, band, table, L, tinyw, mp, medfilt,
         #                origin='lower', vmin=-2.*s1, vmax=5.*s1)
         #     plt.title('%s %i' % (WISE.scan_id[wi], WISE.frame_num[wi]))
         #     ps.savefig()
+    del args
+    if cube1:
+        cube.close()
 
-    print Time()-t0
+    if iostats is not None:
+        print 'Round-1 I/O: read %.1f s, waited for reads %.1f s; compute %.1f s' % (
+            iostats.tread, iostats.twait, tcompute)
+    print 'Round 1:', Time()-tr0
 
+    if acc32:
+        coimgsq = coimgsq.astype(float) - coimgsqc
+        del coimgsqc
     coimg /= np.maximum(cow, tinyw)
     # Per-pixel std
-    coppstd = np.sqrt(np.maximum(0, coimgsq / np.maximum(cow, tinyw)
-                                 - coimg**2))
+    coppstd = np.sqrt(np.maximum(0, coimgsq / np.maximum(cow, tinyw).astype(float)
+                                 - coimg.astype(float)**2))
 
     if ps:
         # plt.clf()
@@ -2472,27 +5675,62 @@ def _bounce_one_coadd(A):
         return -1
 
 def todo(T, W, H, pixscale, outdirs, r0,r1,d0,d1, ps, dataset, bands=[1,2,3,4],
-         margin=1.05, allsky=False, pargs={}, justdir=False):
-    # Check which tiles still need to be done.
+         margin=1.05, allsky=False, pargs={}, justdir=False, verify=False):
+    # Check which tiles still need to be done.  Tile-bands are complete
+    # if they are in an output directory's completion index and their
+    # tile directory has not changed since (one stat per tile
+    # directory), or if their manifest checks out (they are then added
+    # to the index); tile-bands without a manifest, or with incomplete
+    # or stale outputs, are needed.  With *verify*, the manifests of
+    # indexed tile-bands are checked too, to catch files changed in
+    # place.
+    indexes = [read_todo_index(outdir) for outdir in outdirs]
+    changed = [False for outdir in outdirs]
+    dirmtimes = {}
     need = []
     for band in bands:
         tiles = []
         for i in range(len(T)):
             found = False
-            for outdir in outdirs:
+            for j,(outdir,index) in enumerate(zip(outdirs, indexes)):
                 thisdir = get_dir_for_coadd(outdir, T.coadd_id[i])
                 if justdir:
                     ofn = thisdir
-                else:
-                    tag = 'unwise-%s-w%i' % (T.coadd_id[i], band)
-                    prefix = os.path.join(thisdir, tag)
-                    #ofn = prefix + '-img-m.fits'
-                    ofn = prefix + '-frames.fits'
-
-                if os.path.exists(ofn):
-                    print 'Output file exists:', ofn
+                    if os.path.exists(ofn):
+                        print 'Output directory exists:', ofn
+                        found = True
+                        break
+                    continue
+                if thisdir not in dirmtimes:
+                    try:
+                        dirmtimes[thisdir] = os.stat(thisdir).st_mtime
+                    except OSError:
+                        dirmtimes[thisdir] = None
+                mtime = dirmtimes[thisdir]
+                key = (T.coadd_id[i], band)
+                tag = 'unwise-%s-w%i' % (T.coadd_id[i], band)
+                prefix = os.path.join(thisdir, tag)
+                ofn = prefix + '-manifest.fits'
+                if key in index:
+                    dver,t = index[key]
+                    # (dver 0: legacy outputs; see manifest_status)
+                    if ((dver >= unwise_data_model_version or dver == 0)
+                        and t == mtime and not verify):
+                        found = True
+                        break
+                    del index[key]
+                    changed[j] = True
+                if mtime is None:
+                    continue
+                status,hdr = manifest_status(prefix)
+                if status == 'done':
+                    print 'Outputs complete:', ofn
+                    index[key] = (hdr.get('UNW_DVER', 0), mtime)
+                    changed[j] = True
                     found = True
                     break
+                if status != 'missing':
+                    print 'Outputs', status + ':', ofn
             if found:
                 tiles.append(T.coadd_id[i])
                 continue
@@ -2511,6 +5749,10 @@ def todo(T, W, H, pixscale, outdirs, r0,r1,d0,d1, ps, dataset, bands=[1,2,3,4],
                         margin=margin, allsky=allsky, tiles=tiles, **pargs)
     print ' '.join('%i' %i for i in need)
 
+    for outdir,index,ch in zip(outdirs, indexes, changed):
+        if ch:
+            write_todo_index(outdir, index)
+
     # write out scripts
     if False:
         for i in need:
@@ -2554,7 +5796,8 @@ def todo(T, W, H, pixscale, outdirs, r0,r1,d0,d1, ps, dataset, bands=[1,2,3,4],
 
 
 def get_wise_frames_for_dataset(dataset, r0,r1,d0,d1,
-                                randomize=False, cache=True, dirnm=None):
+                                randomize=False, cache=True, dirnm=None,
+                                frame_index=None):
     fn = '%s-frames.fits' % dataset
     if dirnm is not None:
         fn = os.path.join(dirnm, fn)
@@ -2562,7 +5805,10 @@ def get_wise_frames_for_dataset(dataset, r0,r1,d0,d1,
         print 'Reading', fn
         WISE = fits_table(fn)
     else:
-        WISE = get_wise_frames(r0,r1,d0,d1)
+        if frame_index is not None:
+            WISE = read_frame_index_box(frame_index, r0,r1,d0,d1)
+        else:
+            WISE = get_wise_frames(r0,r1,d0,d1)
         # bool -> uint8 to avoid confusing fitsio
         WISE.moon_masked = WISE.moon_masked.astype(np.uint8)
         if randomize:
@@ -2589,6 +5835,8 @@ def main():
                       default=False, help='Print and plot fields to-do')
     parser.add_option('--just-dir', dest='justdir', action='store_true',
                       default=False, help='With --todo, just check for directory, not image file')
+    parser.add_option('--todo-verify', dest='todo_verify', action='store_true',
+                      default=False, help='With --todo, recheck the manifests of tiles in the completion index')
                       
     parser.add_option('-w', dest='wishlist', action='store_true',
                       default=False, help='Print needed frames and exit?')
@@ -2636,7 +5884,7 @@ def main():
                       help='Run even if output file already exists?')
 
     parser.add_option('--maxmem', dest='maxmem', type=float, default=0,
-                      help='Quit if predicted memory usage > n GB')
+                      help='Memory budget in GB: use fewer workers (or --lowmem) to fit, quit if predicted memory usage is still > n GB')
 
     parser.add_option('--dsky', dest='dsky', action='store_true',
                       default=False,
@@ -2653,7 +5901,7 @@ def main():
                       help='Read frames in order of distance from center; for debugging.')
 
     parser.add_option('--minmax', action='store_true',
-                      help='Record the minimum and maximum values encountered during coadd?')
+                      help='Also write per-pixel min, max, min/max-rejected mean and median estimate of the frames (-min, -max, -rejmean, -med)')
 
     parser.add_option('--md5', dest='md5', action='store_true', default=False,
                       help='Check md5sums on all input files?')
@@ -2671,6 +5919,65 @@ def main():
     parser.add_option('--tile', dest='tile', type=str, default=None,
                       help='Run a single tile, eg, 0832p196')
 
+    parser.add_option('--build-metadata', dest='build_metadata', action='store_true',
+                      default=False,
+                      help='Build the pre-joined L1b index + metadata table (%s) and exit' % frame_metadata_fn)
+    parser.add_option('--append-metadata', dest='append_metadata', default=None,
+                      help='Join the 2-band WISE-l1b-metadata-NAME.fits table to new L1b index frames, append to the pre-joined table, and exit')
+
+    parser.add_option('--frame-index', dest='frame_index', default=None,
+                      help='Read WISE frames for each tile from this Dec-zone frame index file (built if it does not exist)')
+
+    parser.add_option('--wcs-store', dest='wcs_store', default=None,
+                      help='Per-frame WCS store file: take L1b frame WCS and file existence from here')
+    parser.add_option('--update-wcs-store', dest='update_wcs_store', action='store_true',
+                      default=False,
+                      help='Add the dataset\'s frames to the --wcs-store file and exit')
+
+    parser.add_option('--frame-cache', dest='frame_cache', default=None,
+                      help='Directory for caching per-frame round-1 products between tiles')
+    parser.add_option('--frame-cache-size', dest='frame_cache_size', type=float,
+                      default=0, help='Maximum --frame-cache size in GB (default: unlimited)')
+
+    parser.add_option('--frame-stats', dest='frame_stats', default=None,
+                      help='Per-frame sky/sig1 table: read only the overlapping sub-image of frames found here (no --medfilt)')
+    parser.add_option('--update-frame-stats', dest='update_frame_stats', action='store_true',
+                      default=False,
+                      help='Add the dataset\'s frames to the --frame-stats file and exit')
+
+    parser.add_option('--round1-dir', dest='round1_dir', default=None,
+                      help='Scratch directory: keep resampled round-1 frames in a memory-mapped file here, rather than in memory')
+
+    parser.add_option('--mem-log', dest='mem_log', default=None,
+                      help='Log measured memory use per tile to this FITS table, and fit the --maxmem memory model to it')
+
+    parser.add_option('--sums', dest='sumstats', action='store_true', default=False,
+                      help='Also write the raw coadd sums (-sums.fits), for --incremental updates')
+    parser.add_option('--incremental', action='store_true', default=False,
+                      help='Add only frames not already in an existing coadd with -sums.fits, and rewrite its outputs (not with --minmax, --cube or --cube1)')
+    parser.add_option('--rebuild', action='store_true', default=False,
+                      help='Redo tiles with complete outputs only if their input hash (selected frames, options, data model version) changed')
+
+    parser.add_option('--multi-epoch', dest='multiepoch', action='store_const',
+                      const=True, default=None,
+                      help='Also write a coadd of each epoch (-e<N>-*.fits), resampling each frame once')
+
+    parser.add_option('--mef', action='store_true', default=False,
+                      help='Write the coadd images as extensions of one tile-compressed file per tile and band (already compressed; merge.py copies it as is)')
+
+    parser.add_option('--float32-acc', dest='acc32', action='store_true', default=False,
+                      help='Accumulate coadds in float32 with compensated summation (less memory; see acc32.py for tolerances)')
+
+    parser.add_option('--lowmem', dest='lowmem', action='store_true', default=False,
+                      help='Recompute round-1 frames for round 2 rather than keeping them in memory (same results; no --maxmem limit)')
+
+    parser.add_option('--prefetch', dest='prefetch', type=int, default=0,
+                      help='Read up to this many L1b frames ahead on I/O threads in round 1 (default: off)')
+    parser.add_option('--prefetch-mem', dest='prefetch_mem', type=float, default=0,
+                      help='Maximum memory for --prefetch frames, in GB (default: unlimited)')
+    parser.add_option('--io-threads', dest='io_threads', type=int, default=2,
+                      help='Number of I/O threads for --prefetch (default %default)')
+
     parser.add_option('--preprocess', dest='preprocess', action='store_true',
                       default=False, help='Preprocess (write *-atlas, *-frames.fits) only')
 
@@ -2693,6 +6000,13 @@ def main():
     else:
         mp1 = multiproc(opt.threads1)
 
+    if opt.build_metadata:
+        build_frame_metadata()
+        return 0
+    if opt.append_metadata is not None:
+        append_frame_metadata(opt.append_metadata)
+        return 0
+
     batch = False
     arr = os.environ.get('PBS_ARRAYID')
     if arr is not None:
@@ -2701,7 +6015,8 @@ def main():
 
     radec = opt.ra is not None and opt.dec is not None
 
-    if len(args) == 0 and arr is None and not (opt.todo or opt.allmd5 or radec or opt.tile or opt.preprocess):
+    if len(args) == 0 and arr is None and not (opt.todo or opt.allmd5 or radec or opt.tile or opt.preprocess
+                                               or opt.update_wcs_store or opt.update_frame_stats):
         print 'No tile(s) specified'
         parser.print_help()
         sys.exit(-1)
@@ -2920,13 +6235,24 @@ def main():
             odirs.append(opt.outdir2)
         todo(T, W, H, opt.pixscale, odirs, r0,r1,d0,d1, ps, dataset,
              margin=pmargin, allsky=pallsky, pargs=plotargs, justdir=opt.justdir,
-             **todoargs)
+             verify=opt.todo_verify, **todoargs)
         return 0
 
     if not opt.plots:
         ps = None
 
-    WISE = get_wise_frames_for_dataset(dataset, r0,r1,d0,d1)
+    if opt.frame_index is not None and not os.path.exists(opt.frame_index):
+        print 'Building frame index', opt.frame_index
+        write_frame_index(get_wise_frames(0., 360., -90., 90.), opt.frame_index)
+
+    if opt.frame_index is not None and not (opt.allmd5 or opt.preprocess or
+                                            opt.update_wcs_store or
+                                            opt.update_frame_stats):
+        # Frames get read from the index for each tile, below.
+        WISE = None
+    else:
+        WISE = get_wise_frames_for_dataset(dataset, r0,r1,d0,d1,
+                                           frame_index=opt.frame_index)
 
     if opt.allmd5:
         Ibad = check_md5s(WISE)
@@ -2947,6 +6273,14 @@ def main():
                 print 'os.makedirs failed, and', opt.outdir, 'does not exist'
                 raise
 
+    if opt.update_wcs_store:
+        update_wcs_store(opt.wcs_store, WISE)
+        sys.exit(0)
+
+    if opt.update_frame_stats:
+        update_frame_stats(opt.frame_stats, WISE, mp1)
+        sys.exit(0)
+
     if opt.preprocess:
         print 'Preprocessing done'
         sys.exit(0)
@@ -2967,6 +6301,19 @@ def main():
             else:
                 tiles.append(int(term))
 
+    fcache = None
+    if opt.frame_cache is not None:
+        fcache = framecache(opt.frame_cache, maxsize=int(opt.frame_cache_size * 1e9))
+
+    prefetch = None
+    if opt.prefetch:
+        prefetch = dict(depth=opt.prefetch, maxmem=opt.prefetch_mem * 1e9,
+                        nthreads=opt.io_threads)
+
+    memmodel = None
+    if opt.maxmem:
+        memmodel = fit_memory_model(opt.mem_log)
+
     for tileid in tiles:
         band   = tileid / arrayblock
         tileid = tileid % arrayblock
@@ -2981,12 +6328,27 @@ def main():
             else:
                 medfilt = 0
 
-        if one_coadd(T[tileid], band, W, H, opt.pixscale, WISE, ps,
+        WI = WISE
+        if WI is None:
+            WI = read_frame_index_near(opt.frame_index, T.ra[tileid], T.dec[tileid],
+                                       get_frame_search_radius(W, H, opt.pixscale))
+
+        wcsstore = None
+        if opt.wcs_store is not None and os.path.exists(opt.wcs_store):
+            wcsstore = read_wcs_store(opt.wcs_store, WI[WI.band == band])
+
+        if one_coadd(T[tileid], band, W, H, opt.pixscale, WI, ps,
                      opt.wishlist, opt.outdir, mp1, mp2,
                      opt.cube, opt.plots2, opt.frame0, opt.nframes, opt.force,
                      medfilt, opt.maxmem, opt.dsky, opt.md5, opt.bgmatch,
                      opt.center, opt.minmax, opt.rchi_fraction, opt.cube1,
-                     opt.epoch, opt.before, opt.after):
+                     opt.epoch, opt.before, opt.after, wcsstore=wcsstore,
+                     framecache=fcache, prefetch=prefetch,
+                     framestats=opt.frame_stats, round1dir=opt.round1_dir,
+                     lowmem=opt.lowmem, memmodel=memmodel, memlog=opt.mem_log,
+                     acc32=opt.acc32, sumstats=opt.sumstats,
+                     incremental=opt.incremental, multiepoch=opt.multiepoch,
+                     mef=opt.mef, rebuild=opt.rebuild):
             return -1
         print 'Tile', T.coadd_id[tileid], 'band', band, 'took:', Time()-t0
     return 0
@@ -9,8 +9,29 @@ from astrometry.libkd.spherematch import *
 def main():
     import optparse
     parser = optparse.OptionParser('%prog [options] <ra> <dec>')
+    parser.add_option('--catalog', dest='catalog', default=None,
+                      help='Look up the tile for each "ra","dec" row of this FITS table')
+    parser.add_option('--out', dest='out', default=None,
+                      help='With --catalog: write the table with coadd_id,x,y columns added')
 
     opt,args = parser.parse_args()
+
+    from unwise_coadd import (get_atlas_tiles, read_atlas_tile_index,
+                              lookup_atlas_tiles)
+
+    if opt.catalog is not None:
+        A = read_atlas_tile_index()
+        T = fits_table(opt.catalog)
+        tile,x,y = lookup_atlas_tiles(A, T.ra, T.dec)
+        T.coadd_id = np.array([''] + list(A.coadd_id))[tile + 1]
+        T.x = x
+        T.y = y
+        print 'Found tiles for', np.sum(tile >= 0), 'of', len(T), 'RA,Dec points'
+        if opt.out is not None:
+            T.writeto(opt.out)
+            print 'Wrote', opt.out
+        return 0
+
     if len(args) != 2:
         parser.print_help()
         return -1
@@ -18,14 +39,17 @@ def main():
     ra = float(args[0])
     dec = float(args[1])
 
-    from unwise_coadd import get_atlas_tiles
-
     T = get_atlas_tiles(ra, ra, dec, dec)
     print 'Found', len(T), 'atlas tiles touching RA,Dec', ra, dec
     print T.coadd_id
 
+    A = read_atlas_tile_index()
+    tile,x,y = lookup_atlas_tiles(A, ra, dec)
+    if tile[0] >= 0:
+        print 'Nearest tile:', A.coadd_id[tile[0]], 'x,y', x[0], y[0]
+
     return 0
 
 if __name__ == '__main__':
     sys.exit(main())
-        
+